@@ -25,25 +25,17 @@ from locale import getdefaultlocale
 
 from pmvcommon import *
 from pmvconfig import *
+from pmvjob import PMVJob, JobUI
+from pmvreport import JournalReport
 
 
-def process_files(env):
-    """Обработка исходных каталогов.
-
-    env     - экземпляр pmvconfig.Environment
+class ConsoleJobUI(JobUI):
+    """Вывод сообщений о ходе обработки файлов на консоль."""
 
-    Возвращает список строк, содержащих сообщения
-    (кол-во обработанных файлов и т.п.)."""
+    def show_dir(self, dirname):
+        print(dirname, file=sys.stderr)
 
-    statTotalFiles = 0
-    statProcessedFiles = 0
-    statSkippedFiles = 0
-
-    def job_show_dir(dirname=''):
-        if env.showSrcDir and dirname:
-            print(dirname, file=sys.stderr)
-
-    def job_progress(progress:float, msg=''):
+    def progress(self, progress, msg=''):
         pg = '' if progress < 0.0 else '%3.1f%% ' % progress
 
         if msg:
@@ -52,212 +44,50 @@ def process_files(env):
         if pg:
             print(msg, file=sys.stderr)
 
-    def job_error(msg):
+    def error(self, msg):
         print('* Ошибка: %s' % msg, file=sys.stderr)
 
-    def job_warning(msg):
+    def warning(self, msg):
         print('* Предупреждение: %s' % msg, file=sys.stderr)
 
-    #
-    # 1й проход - подсчет общего количества файлов для индикации прогресса
-    # во втором проходе
-    #
-    env.logger.write_msg(None, 'подготовка')
-
-    srcDirs = env.sourceDirs
-
-    # с этим списком будет работать 2й проход
-    # содержит он кортежи вида ('каталог', [список файлов]),
-    # где список файлов - список строк с именами файлов;
-    # да, оно память жрёть, а шо таки делать?
-    # а кто натравит photomv на гигантскую файлопомойку -
-    # сам себе злой буратино
-    sourcedirs = []
-
-    job_progress(0.0, 'Поиск файлов...')
-
-    for srcdir in srcDirs:
-        if srcdir.ignore:
-            continue
-
-        srcdir = srcdir.path
-
-        if not os.path.exists(srcdir) or not os.path.isdir(srcdir):
-            emsg = 'путь "%s" не существует или указывает не на каталог' % srcdir
-            job_error(emsg)
-            env.logger.write_error(None, emsg)
-        else:
-            for srcroot, dirs, files in os.walk(srcdir):
-                # "скрытые" (в *nix-образных ОС) каталоги игнорируем нахрен
-                if srcroot.startswith('.'):
-                    continue
-
-                flist = [] # список файлов допустимых типов из текущего каталога
-
-                for fname in files:
-                    # "скрытые" (в *nix-образных ОС) файлы игнорируем нахрен
-                    if fname.startswith('.'):
-                        continue
-
-                    # файлы неизвестных типов отсеиваем заранее
-                    ftype = env.knownFileTypes.get_file_type_by_name(fname)
-                    if ftype is None:
-                        continue
-
-                    flist.append(fname)
-
-                nfiles = len(flist)
-                if nfiles:
-                    sourcedirs.append((srcroot, flist))
-                    statTotalFiles += nfiles
-
-    if statTotalFiles == 0:
-        return ['не с чем работать - нет файлов']
-
-    #
-    # проход 1.5 - проверка каталога назначения
-    # можно было проверить до прохода 1, но с другой стороны -
-    # какая нам разница, есть ли каталог назначения, если кидать туда
-    # нечего?
-    # а вот ща уже есть разница...
-    #
-
-    if not env.destinationDir:
-        emsg = 'Каталог назначения не указан'
-        env.logger.write_error(None, emsg)
-        job_error(emsg)
-        return
-
-    if env.check_dest_is_same_with_src_dir():
-        emsg = 'Каталог назначения совпадает с одним из исходных каталогов'
-        env.logger.write_error(None, emsg)
-        job_error(emsg)
-        return
-
-    # если каталога назначения нет - пытаемся создать.
-    # если не удаётся - тогда уже лаемся
-
-    if not os.path.exists(env.destinationDir):
-        emsg = make_dirs(destPath, None)
-        if emsg:
-            env.logger.write(None, env.logger.KW_MKDIR, False, emsg, '')
-            job_error(emsg)
-            return
-
-    #
-    # 2й проход - собственно обработка файлов
-    #
-    if statTotalFiles:
-        nFileIx = 0
-
-        for srcdir, flist in sourcedirs:
-            job_show_dir(srcdir)
-
-            for fname in flist:
-                nFileIx += 1
-
-                # метка времени для нескольких сообщений при файловых операциях должна быть одинаковой
-                timestamp = datetime.datetime.now()
-
-                srcPathName = os.path.join(srcdir, fname)
-                if os.path.isfile(srcPathName):
-                    # всякие там символические ссылки пока нафиг
-                    try:
-                        metadata = FileMetadata(srcPathName, env.knownFileTypes)
-                    except Exception as ex:
-                        statSkippedFiles += 1
-
-                        emsg = 'не удалось получить метаданные файла "%s" - %s' % (fname, str(ex))
-                        env.logger.write_error(timestamp, emsg)
-                        job_error(emsg)
-                        # с кривыми файлами ничего не делаем
-                        continue
-
-                    #
-                    # выясняем, каким шаблоном создавать новое имя файла
-                    #
-
-                    fntemplate = env.get_template(metadata.fields[metadata.MODEL])
-
-                    newSubDir, newFileName, newFileExt = fntemplate.get_new_file_name(env, metadata)
-
-                    destPath = os.path.join(env.destinationDir, newSubDir)
-
-                    emsg = make_dirs(destPath, None)
-                    if emsg:
-                        env.logger.write(timestamp, env.logger.KW_MKDIR, False, emsg, '')
-                        job_error(emsg)
-                        return
-
-                    newFileNameExt = newFileName + newFileExt
-
-                    job_progress(float(nFileIx) / statTotalFiles, '%s -> %s' % (fname, newFileNameExt))
-
-                    destPathName = os.path.join(destPath, newFileNameExt)
-
-                    if os.path.exists(destPathName):
-                        if env.ifFileExists == env.FEXIST_SKIP:
-                            smsg = 'файл "%s" уже существует, пропускаю' % newFileNameExt
-                            job_warning(smsg)
-                            env.logger.write(timestamp,
-                                env.logger.KW_MSG, True, smsg, '')
-                            statSkippedFiles += 1
-                            continue
-                        elif env.ifFileExists == env.FEXIST_RENAME:
-                            # пытаемся подобрать незанятое имя
-
-                            canBeRenamed = False
-
-                            # нефиг больше 10 повторов... и 10-то много
-                            for unum in range(1, 11):
-                                destPathName = os.path.join(destPath, '%s-%d%s' % (newFileName, unum, newFileExt))
-
-                                if not os.path.exists(destPathName):
-                                    canBeRenamed = True
-                                    break
-
-                            if not canBeRenamed:
-                                emsg = 'в каталоге "%s" слишком много файлов с именем %s*%s' % (destPath, newFileName, newFileExt)
-                                job_error(emsg)
-                                env.logger.write(timestamp, env.logger.KW_MSG, True, emsg, '')
-
-                                statSkippedFiles += 1
-                                continue
-
-                        # else:
-                        # env.FEXIST_OVERWRITE - перезаписываем
 
-                    #
-                    # а вот теперь копируем или перемещаем файл
-                    #
+def process_files(env):
+    """Обработка исходных каталогов.
 
-                    fops = env.logger.KW_MV if env.modeMoveFiles else env.logger.KW_CP
+    env     - экземпляр pmvconfig.Environment
 
-                    try:
-                        env.modeFileOp(srcPathName, destPathName)
-                        fopok = True
-                        statProcessedFiles += 1
-                    except (IOError, os.error) as emsg:
-                        print_exception()
-                        statSkippedFiles += 1
-                        fopok = False
-                        emsg = 'не удалось %s файл - %s' % (env.modeMessages.errmsg, repr(emsg))
-                        job_error(emsg)
-                        env.logger.write_error(timestamp, emsg)
+    Возвращает список строк, содержащих сообщения
+    (кол-во обработанных файлов и т.п.)."""
 
-                    env.logger.write(timestamp, fops, fopok, srcPathName, destPathName)
+    job = PMVJob(env, ConsoleJobUI())
 
-    return ('Всего файлов: %d\n%s: %d\nпропущено: %d' % (statTotalFiles,
-        env.modeMessages.statmsg, statProcessedFiles,
-        statSkippedFiles),)
+    # всё, что надо сообщить о файлах, ConsoleJobUI уже вывел
+    for result in job.run():
+        pass
 
+    return job.messages if job.messages else None
 
-def main(args):
-    print('%s\n' % TITLE_VERSION)
 
+def print_report(env):
+    """Вывод сводки по журналу операций (ключ --report)."""
+
+    report = JournalReport()
+    report.read_log(env.logger.logPath, env.logger.logOldPath)
+
+    print(report.get_report(env.reportFormat))
+
+
+def main(args):
     try:
         env = Environment()
 
+        if env.reportFormat is not None:
+            # заголовок не выводим - JSON может читать другая программа
+            print_report(env)
+            return 0
+
+        print('%s\n' % TITLE_VERSION)
+
         #
         # а вот всё последующее логируем
         #
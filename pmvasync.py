@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from pmvjob import PMVJob
+
+
+# стадии обработки и кол-во одновременно обрабатываемых на каждой
+# из них файлов (по умолчанию)
+STAGE_METADATA = 'metadata'
+STAGE_MKDIR = 'mkdir'
+STAGE_TRANSFER = 'transfer'
+
+DEFAULT_CONCURRENCY = {STAGE_METADATA:4, STAGE_MKDIR:1, STAGE_TRANSFER:2}
+
+# размер очередей между стадиями (по умолчанию)
+DEFAULT_QUEUE_SIZE = 16
+
+
+async def process_files_async(env, ui=None, concurrency=None, queueSize=DEFAULT_QUEUE_SIZE):
+    """Асинхронный вариант photomv.process_files - для встраивания
+    photomv в программы на asyncio.
+
+    env         - экземпляр pmvconfig.Environment (с открытым журналом -
+                  см. photomv.main);
+    ui          - экземпляр pmvjob.JobUI или None;
+    concurrency, queueSize - см. run_job_async.
+
+    Возвращает то же, что и photomv.process_files."""
+
+    job = PMVJob(env, ui)
+
+    await run_job_async(job, concurrency, queueSize)
+
+    return job.messages if job.messages else None
+
+
+async def run_job_async(job, concurrency=None, queueSize=DEFAULT_QUEUE_SIZE, onresult=None):
+    """Асинхронный вариант pmvjob.PMVJob.run.
+
+    job         - экземпляр pmvjob.PMVJob;
+    concurrency - None или словарь, где ключи - STAGE_xxx, а значения -
+                  кол-во одновременно обрабатываемых на этой стадии
+                  файлов (недостающие берутся из DEFAULT_CONCURRENCY);
+    queueSize   - размер очередей между стадиями;
+    onresult    - None или функция, которой (в потоке цикла событий)
+                  передаются результаты обработки файлов - экземпляры
+                  pmvjob.FileResult.
+
+    Стадии обработки (извлечение метаданных, создание каталогов
+    и резервирование имён, копирование/перемещение) связаны очередями
+    ограниченного размера: если следующая стадия не успевает, предыдущая
+    ждёт. Всё, что блокирует, выполняется в пуле потоков; журнал
+    и контрольная точка пишутся только из потока цикла событий.
+
+    Поиск файлов выполняется целиком до начала обработки (в пуле
+    потоков), т.к. очередь нужна полностью для контрольной точки.
+
+    Файлы обрабатываются не строго по порядку, поэтому при
+    if-exists=rename суффиксы "-N" могут достаться не тем файлам,
+    что при синхронной обработке.
+
+    Возвращает итоги обработки - экземпляр pmvjob.JobStats;
+    сообщения для пользователя - в job.messages (см. PMVJob.run)."""
+
+    stageConcurrency = dict(DEFAULT_CONCURRENCY)
+    if concurrency:
+        stageConcurrency.update(concurrency)
+
+    loop = asyncio.get_running_loop()
+
+    executor = ThreadPoolExecutor(max_workers=sum(stageConcurrency.values()) + 1)
+
+    def run_blocking(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    # True, если начат 2й проход
+    opened = False
+    # True, если очередь обработана полностью
+    completed = False
+
+    try:
+        #
+        # 1й проход
+        #
+        msgs = await run_blocking(job.prepare)
+        if msgs is not None:
+            job.messages = msgs
+            return job.get_stats()
+
+        #
+        # 2й проход
+        #
+        # close закрывает и то, что успел открыть неудачный open
+        opened = True
+        job.open()
+
+        planQueue = asyncio.Queue(queueSize)
+        placeQueue = asyncio.Queue(queueSize)
+        transferQueue = asyncio.Queue(queueSize)
+
+        def file_done(ix, result):
+            job.finish_file(ix)
+
+            if onresult is not None:
+                onresult(result)
+
+        async def feed_stage():
+            for ix in job.pending_indexes():
+                await planQueue.put(ix)
+
+        async def metadata_stage():
+            while True:
+                ix = await planQueue.get()
+                try:
+                    plan = await run_blocking(job.plan_file, ix)
+
+                    if plan is None:
+                        file_done(ix, job.resumed_file(ix))
+                    else:
+                        await placeQueue.put(plan)
+                except job.Skipped as ex:
+                    file_done(ix, job.skip_file(ix, ex))
+                finally:
+                    planQueue.task_done()
+
+        async def mkdir_stage():
+            while True:
+                plan = await placeQueue.get()
+                try:
+                    await run_blocking(job.place_file, plan)
+
+                    job.begin_file(plan)
+                    await transferQueue.put(plan)
+                except job.Skipped as ex:
+                    file_done(plan.ix, job.skip_file(plan.ix, ex, plan))
+                finally:
+                    placeQueue.task_done()
+
+        async def transfer_stage():
+            while True:
+                plan = await transferQueue.get()
+                try:
+                    result = job.end_file(plan, await run_blocking(job.transfer_file, plan))
+                    job.report_sync(plan.timestamp, await run_blocking(job.sync_transfers))
+
+                    file_done(plan.ix, result)
+                except job.Skipped as ex:
+                    file_done(plan.ix, job.skip_file(plan.ix, ex, plan))
+                finally:
+                    transferQueue.task_done()
+
+        async def drain():
+            await feed_stage()
+
+            for q in (planQueue, placeQueue, transferQueue):
+                await q.join()
+
+        workers = []
+
+        for stage, count in ((metadata_stage, stageConcurrency[STAGE_METADATA]),
+                (mkdir_stage, stageConcurrency[STAGE_MKDIR]),
+                (transfer_stage, stageConcurrency[STAGE_TRANSFER])):
+            workers += [asyncio.ensure_future(stage()) for i in range(max(1, count))]
+
+        drainer = asyncio.ensure_future(drain())
+
+        try:
+            # стадии крутятся до отмены; если какая-то из них
+            # завершилась - значит, с исключением (в т.ч. PMVJob.Fatal)
+            done, pending = await asyncio.wait(workers + [drainer],
+                return_when=asyncio.FIRST_COMPLETED)
+
+            if drainer in done:
+                drainer.result()
+                completed = True
+            else:
+                for task in done:
+                    ex = task.exception()
+
+                    if isinstance(ex, job.Fatal):
+                        job.report_fatal(None, ex)
+                        job.messages = []
+                        return job.get_stats()
+
+                    raise ex
+        finally:
+            for task in workers + [drainer]:
+                task.cancel()
+
+            await asyncio.gather(*workers, drainer, return_exceptions=True)
+    finally:
+        # дожидаемся операций, начатых в потоках до отмены стадий
+        executor.shutdown(wait=True)
+
+        if opened:
+            job.close(completed)
+
+    job.messages = list(job.stats_text())
+
+    return job.get_stats()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path
+import json
+import csv
+import threading
+
+
+class PMVCheckpoint():
+    """Контрольная точка для продолжения прерванного запуска.
+
+    Состоит из двух файлов в каталоге журналов:
+    - checkpoint.json - параметры запуска и очередь обработки
+      (список кортежей вида ('каталог', 'имя файла') или ('каталог',
+      'имя файла', (сопроводительные файлы))), записывается один раз
+      в начале работы;
+    - checkpoint.log - CSV с записями о ходе обработки очереди,
+      дописывается по мере работы; поля:
+      1: индекс элемента очереди,
+      2: KW_BEGIN, KW_CANCEL или KW_DONE,
+      3 и 4: для KW_BEGIN - исходный файл и файл назначения,
+             для KW_CANCEL и KW_DONE - пустые строки.
+
+    Запись KW_BEGIN делается перед копированием (перемещением) файла,
+    KW_DONE - после завершения обработки элемента очереди (в т.ч.
+    неудачного, или если файл был пропущен).
+    Для элементов, по которым есть только KW_BEGIN, при продолжении
+    используется записанное имя файла назначения - иначе в режиме
+    if-exists=rename недописанный файл породил бы дубликат с суффиксом.
+    Запись KW_CANCEL отменяет KW_BEGIN (имя файла назначения оказалось
+    занято другим процессом, и файл был пропущен или будет записан
+    под другим именем).
+
+    Записи KW_BEGIN и KW_CANCEL передаются ОС сразу, до начала
+    копирования (без KW_BEGIN при продолжении имя файла назначения было
+    бы подобрано заново), но fsync для них делается, только если
+    syncBegin=True (durability=file) - иначе они попадают на диск вместе
+    с очередной пачкой KW_DONE.
+    Записи KW_DONE накапливаются в памяти и пишутся в файл (с fsync)
+    только методом sync - каждые syncInterval элементов очереди; sync
+    следует вызывать лишь после того, как на диске оказались сами файлы
+    (см. PMVJob.report_sync). Потерянная KW_DONE лишь заставит проверить
+    файл ещё раз."""
+
+    QUEUE_FNAME = 'checkpoint.json'
+    DONE_FNAME = 'checkpoint.log'
+
+    KW_BEGIN = 'begin'
+    KW_CANCEL = 'cancel'
+    KW_DONE = 'done'
+
+    DEFAULT_SYNC_INTERVAL = 100
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, cacheDir, syncInterval=DEFAULT_SYNC_INTERVAL, syncBegin=False):
+        """cacheDir     - полный путь к каталогу, где хранятся файлы
+                          контрольной точки;
+        syncInterval    - кол-во обработанных элементов очереди между
+                          сбросами записей на диск;
+        syncBegin       - делать ли fsync после каждой записи KW_BEGIN
+                          и KW_CANCEL."""
+
+        self.queuePath = os.path.join(cacheDir, self.QUEUE_FNAME)
+        self.donePath = os.path.join(cacheDir, self.DONE_FNAME)
+
+        self.syncInterval = max(1, syncInterval)
+        self.syncBegin = syncBegin
+
+        # индексы полностью обработанных элементов очереди
+        self.done = set()
+
+        # файлы назначения для начатых, но не завершённых элементов
+        # ключи - индексы элементов, значения - полные пути
+        self.pending = {}
+
+        self.donef = None
+        self.donewriter = None
+
+        # записи KW_DONE, ещё не записанные в файл
+        self.unsyncedRows = []
+
+        # кол-во элементов, завершённых после последнего сброса на диск
+        self.nUnsynced = 0
+
+        # begin и cancel могут вызываться из потока, где копируется
+        # файл (см. PMVJob.transfer_file)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(queuePath="%s", donePath="%s", syncInterval=%d, syncBegin=%s)' % (
+            self.__class__.__name__,
+            self.queuePath,
+            self.donePath,
+            self.syncInterval,
+            self.syncBegin)
+
+    def exists(self):
+        """Возвращает True, если есть сохранённая контрольная точка."""
+
+        return os.path.exists(self.queuePath)
+
+    def __open_done(self, mode):
+        self.donef = open(self.donePath, mode, newline='')
+        self.donewriter = csv.writer(self.donef, delimiter=';', dialect=csv.excel)
+
+    def create(self, params, queue):
+        """Создание новой контрольной точки.
+
+        params  - словарь с параметрами запуска (для проверки
+                  при продолжении), должен сериализоваться в JSON;
+        queue   - очередь обработки."""
+
+        tmppath = self.queuePath + '.tmp'
+
+        os.makedirs(os.path.dirname(self.queuePath), exist_ok=True)
+
+        with open(tmppath, 'w') as f:
+            json.dump({'params':params, 'queue':queue}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmppath, self.queuePath)
+
+        self.done.clear()
+        self.pending.clear()
+        self.unsyncedRows.clear()
+        self.nUnsynced = 0
+        self.__open_done('w')
+
+    def load(self):
+        """Загрузка сохранённой контрольной точки для продолжения работы.
+        Возвращает кортеж из двух элементов - словарь с параметрами
+        запуска и очередь обработки.
+        В случае ошибок генерирует исключение PMVCheckpoint.Error."""
+
+        try:
+            with open(self.queuePath, 'r') as f:
+                cp = json.load(f)
+
+            params = cp['params']
+            # JSON превращает кортежи в списки
+            queue = [(e[0], e[1], tuple(e[2])) if len(e) > 2 else tuple(e) for e in cp['queue']]
+
+            self.done.clear()
+            self.pending.clear()
+            self.unsyncedRows.clear()
+            self.nUnsynced = 0
+
+            if os.path.exists(self.donePath):
+                with open(self.donePath, 'r', newline='') as f:
+                    for rec in csv.reader(f, delimiter=';', dialect=csv.excel):
+                        if len(rec) < 4:
+                            # недописанная при аварии строка
+                            continue
+
+                        ix = int(rec[0])
+
+                        if rec[1] == self.KW_BEGIN:
+                            self.pending[ix] = rec[3]
+                        elif rec[1] == self.KW_CANCEL:
+                            self.pending.pop(ix, None)
+                        elif rec[1] == self.KW_DONE:
+                            self.done.add(ix)
+                            self.pending.pop(ix, None)
+
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            raise self.Error('не удалось загрузить контрольную точку из "%s" - %s' % (self.queuePath, ex))
+
+        self.__open_done('a')
+
+        return (params, queue)
+
+    def begin(self, ix, src, dest):
+        """Запись о начале копирования (перемещения) элемента ix очереди
+        из файла src в файл dest."""
+
+        self.__write_synced((ix, self.KW_BEGIN, src, dest))
+
+    def cancel(self, ix):
+        """Отмена записи о начале копирования (перемещения) элемента
+        ix очереди (см. KW_CANCEL)."""
+
+        self.__write_synced((ix, self.KW_CANCEL, '', ''))
+
+    def __write_synced(self, rec):
+        with self.lock:
+            # накопленные KW_DONE в буфере файла не лежат,
+            # и flush их на диск не отправит
+            self.donewriter.writerow(rec)
+            self.donef.flush()
+
+            if self.syncBegin:
+                os.fsync(self.donef.fileno())
+
+    def finish(self, ix):
+        """Запись о завершении обработки элемента ix очереди
+        (в файл она попадёт при вызове sync)."""
+
+        with self.lock:
+            self.unsyncedRows.append((ix, self.KW_DONE, '', ''))
+            self.done.add(ix)
+            self.pending.pop(ix, None)
+
+            self.nUnsynced += 1
+
+    def sync(self, force=False):
+        """Сброс накопленных записей на диск, если с последнего сброса
+        обработано не менее syncInterval элементов очереди (или force=True)."""
+
+        with self.lock:
+            if self.donef is not None and (force or self.nUnsynced >= self.syncInterval):
+                self.donewriter.writerows(self.unsyncedRows)
+                self.unsyncedRows.clear()
+
+                self.donef.flush()
+                os.fsync(self.donef.fileno())
+                self.nUnsynced = 0
+
+    def close(self, completed):
+        """Завершение работы с контрольной точкой.
+        completed   - True, если очередь обработана полностью;
+                      в этом случае файлы контрольной точки удаляются."""
+
+        if self.donef is not None:
+            self.sync(True)
+            self.donef.close()
+            self.donef = None
+            self.donewriter = None
+
+        if completed:
+            for path in (self.queuePath, self.donePath):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -19,7 +19,7 @@
 
 
 TITLE = 'PhotoMV'
-VERSION = '1.5.2'
+VERSION = '1.6.0'
 TITLE_VERSION = '%s v%s' % (TITLE, VERSION)
 
 
@@ -86,7 +86,9 @@ def same_dir(dir1, dir2):
     if dir1 == dir2: #os.path.samefile(dir1, dir2):
         return True
 
-    r = os.path.normpath(os.path.commonprefix((dir1, dir2)))
+    # commonprefix сравнивает посимвольно ("/a/b" и "/a/bc"), а не по
+    # компонентам пути
+    r = os.path.commonpath((dir1, dir2))
     return r == dir1 or r == dir2
     #return os.path.samefile(r, dir1) or os.path.samefile(r, dir2)
 
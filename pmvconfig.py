@@ -26,10 +26,21 @@ import shutil
 import datetime
 import csv
 import argparse
+import copy
+import pickle
+import hashlib
+import io
+from fnmatch import fnmatch
 
 from pmvcommon import *
 from pmvtemplates import *
 from pmvmetadata import FileMetadata, FileTypes
+from pmvtransfer import FileTransfer, DestinationDirCache
+from pmvthrottle import IOThrottle
+from pmvcheckpoint import PMVCheckpoint
+from pmvscanner import ScanIndex
+from pmvreport import JournalReport
+from pmvworkers import MetadataWorkerPool
 
 
 workmodemsgs = namedtuple('workmodemsgs', 'errmsg statmsg')
@@ -62,7 +73,18 @@ class PMVLogger():
     1: дата/время в формате YYYY-MM-DD HH:MM:SS,
     2: ключевое слово операции (см. KW_xxx),
     3: True или False - результат выполнения операции,
-    4 и 5: параметры, зависящие от операции."""
+    4 и 5: параметры, зависящие от операции.
+    У сообщений KW_CP и KW_MV об основных (не сопроводительных)
+    файлах есть ещё четыре поля:
+    6: размер файла в байтах,
+    7: время копирования (перемещения) в секундах,
+    8: модель камеры (пустая строка, если неизвестна),
+    9: дата файла в формате YYYY-MM-DD - та, что подставляется
+       в шаблоны (пустая строка, если шаблону дата не нужна).
+    При нескольких каталогах назначения на каждый файл пишется
+    по сообщению KW_CP (KW_MV) на каталог, с одинаковыми датой/временем
+    и исходным файлом; поля 6-9 есть только в первом из них.
+    Сводку по журналу строит pmvreport.JournalReport."""
 
     # метка запуска (сообщение с ней вставляется автоматически при вызове метода open)
     # 3й параметр - всегда True, 4й и 5й параметры - пустые строки
@@ -85,6 +107,11 @@ class PMVLogger():
     # сообщение о попытке создания каталога
     # 3й параметр - результат операции, 4й параметр - путь к новому каталогу, 5й - пустая строка
     KW_MKDIR = 'mkdir'
+    # контрольная сумма скопированных данных (пишется после KW_CP/KW_MV,
+    # если включена проверка копий - см. параметр verify)
+    # 3й параметр - всегда True, 4й параметр - имя назначения,
+    # 5й - "алгоритм:контрольная сумма" (шестнадцатеричная)
+    KW_DIGEST = 'digest'
 
     LOG_FNAME = 'operations.log'
     LOG_FNAME_OLD = LOG_FNAME + '.old'
@@ -133,6 +160,11 @@ class PMVLogger():
 
     def open(self):
         if self.logf is None:
+            if not os.path.exists(self.logDir):
+                emsg = make_dirs(self.logDir)
+                if emsg:
+                    raise EnvironmentError(emsg)
+
             self.__rotate_logs()
 
             self.logf = open(self.logPath, 'a')
@@ -154,13 +186,14 @@ class PMVLogger():
 
             self.__rotate_logs()
 
-    def write(self, timestamp, operation, result, param1, param2):
+    def write(self, timestamp, operation, result, param1, param2, *extra):
         """Запись операции в журнал.
         timestamp   - экземпляр datetime.datetime или None,
                       в последнем случае используется текущее время
         operation   - строка, KW_xxx
         result      - булевское значение, результат операции
-        param1 и param2 зависят от операции."""
+        param1 и param2 зависят от операции;
+        extra       - дополнительные поля (см. описание класса)."""
 
         if self.logf is None:
             raise EnvironmentError(self.E_LOG_NOT_OPEN % self.logPath)
@@ -169,7 +202,7 @@ class PMVLogger():
             timestamp = datetime.datetime.now()
 
         self.logwriter.writerow((timestamp.strftime(self.LOG_TIMESTAMP_FORMAT),
-            operation, str(result), param1, param2))
+            operation, str(result), param1, param2) + extra)
 
     def write_msg(self, timestamp, message):
         self.write(timestamp, self.KW_MSG, True, message, '')
@@ -243,11 +276,36 @@ class Environment():
     OPT_IF_EXISTS = 'if-exists'
     OPT_SHOW_SRC_DIR = 'show-src-dir'
     OPT_MAX_LOG_SIZE = 'max-log-size'
+    OPT_READ_AHEAD = 'read-ahead'
+    OPT_TRANSFER_CACHE = 'transfer-cache'
+    OPT_DURABILITY = 'durability'
+    OPT_SYNC_BATCH_SIZE = 'sync-batch-size'
+    OPT_VERIFY = 'verify'
+    OPT_CHECKPOINT_INTERVAL = 'checkpoint-interval'
+    OPT_EXCLUDE_DIRS = 'exclude-dirs'
+    OPT_MAX_DEPTH = 'max-depth'
+    OPT_ONE_FILESYSTEM = 'one-filesystem'
+    OPT_SCAN_INDEX = 'scan-index'
+    OPT_METADATA_WORKERS = 'metadata-workers'
+    OPT_METADATA_TIMEOUT = 'metadata-timeout'
+    OPT_METADATA_WORKER_RECYCLE = 'metadata-worker-recycle'
+    OPT_BURST_CACHE = 'burst-cache'
+    OPT_SHARD_SIZE = 'shard-size'
+    OPT_MAX_TRANSFER_RATE = 'max-transfer-rate'
+    OPT_MAX_FILE_RATE = 'max-file-rate'
+    OPT_IO_BACKOFF = 'io-backoff'
+    OPT_IO_PRIORITY = 'io-priority'
+
+    IOPRIO_NORMAL = 'normal'
+    IOPRIO_IDLE = 'idle'
+    IOPRIO_OPTIONS = (IOPRIO_NORMAL, IOPRIO_IDLE)
 
     #FileMetadata.FILE_TYPE_IMAGE, FILE_TYPE_RAW_IMAGE, FILE_TYPE_VIDEO
     OPT_KNOWN_FILE_TYPES = ('known-image-types',
         'known-raw-image-types',
         'known-video-types')
+    OPT_KNOWN_SIDECAR_TYPES = 'known-sidecar-types'
+    OPT_SIDECARS = 'sidecars'
 
     SEC_TEMPLATES = 'templates'
     DEFAULT_TEMPLATE_NAME = '*'
@@ -263,20 +321,119 @@ class Environment():
     E_CMDLINE = 'параметр %d командной строки: %s'
 
     DEFAULT_MAX_LOG_SIZE = 10 # максимальный размер файла журнала в мегабайтах
+    DEFAULT_READ_AHEAD = 8 # кол-во файлов, заголовки которых читаются заранее
 
     def setup_work_mode(self):
         """Вызывать после изменения workModeMove"""
 
         if self.modeMoveFiles:
             self.modeMessages = workmodemsgs('переместить', 'перемещено')
-            self.modeFileOp = shutil.move
+            self.modeFileOp = self.transfer.move
+            self.modeFileOpMulti = self.transfer.move_multi
         else:
             self.modeMessages = workmodemsgs('скопировать', 'скопировано')
-            self.modeFileOp = shutil.copy
+            self.modeFileOp = self.transfer.copy
+            self.modeFileOpMulti = self.transfer.copy_multi
+
+    # разобранные шаблоны, псевдонимы и типы файлов - общие для всех
+    # экземпляров Environment (см. from_config)
+    # ключи - строки (кортежи строк) из файла настроек
+    __templateCache = {}
+    __aliasesCache = {}
+    __fileTypesCache = {}
+
+    # готовые экземпляры Environment (см. from_config)
+    # ключи - кортежи (настройки, moveFiles, cacheDir)
+    __envCache = {}
+    ENV_CACHE_SIZE = 64
+
+    CFG_IN_MEMORY = '<в памяти>'
+
+    # кэш разобранного файла настроек (см. __read_config_file)
+    CONFIG_CACHE_FNAME = 'settings.cache'
+    __CONFIG_CACHE_VERSION = 1
+
+    @classmethod
+    def from_config(cls, config, moveFiles=False, cacheDir=None):
+        """Создание экземпляра Environment без поиска файла настроек
+        и разбора командной строки - например, при использовании
+        photomv как библиотеки, когда на каждое задание создаётся свой
+        экземпляр.
+
+        config      - словарь вида {'секция':{'параметр':'значение', ...}, ...}
+                      (как в файле настроек) или экземпляр
+                      configparser.RawConfigParser;
+        moveFiles   - True - режим перемещения, False - копирования;
+        cacheDir    - каталог для журнала, контрольной точки и индекса
+                      (None - каталог по умолчанию); чтобы одновременно
+                      выполняющиеся задания не мешали друг другу,
+                      у каждого должен быть свой каталог.
+
+        Разобранные шаблоны, псевдонимы и списки типов файлов кэшируются,
+        а экземпляр с теми же настройками повторно не создаётся - вместо
+        этого возвращается его копия (см. copy), так что повторное
+        создание обходится дёшево. Каталоги при создании экземпляра
+        не создаются (каталог журнала создаётся при открытии журнала).
+
+        В случае ошибок генерирует исключения."""
+
+        if isinstance(config, RawConfigParser):
+            sections = ((secname, config.items(secname, raw=True)) for secname in config.sections())
+        else:
+            sections = config.items()
+
+        key = (tuple(sorted((secname, tuple(sorted((str(k), str(v)) for k, v in dict(opts).items()))) for secname, opts in sections)),
+            bool(moveFiles), cacheDir)
+
+        env = cls.__envCache.get(key)
+
+        if env is None:
+            env = cls(config, moveFiles, cacheDir)
+
+            if len(cls.__envCache) >= cls.ENV_CACHE_SIZE:
+                cls.__envCache.clear()
+
+            cls.__envCache[key] = env
+
+        return env.copy()
+
+    def copy(self):
+        """Возвращает копию экземпляра Environment с теми же настройками,
+        но со своими (ещё не использованными) журналом, контрольной
+        точкой, кэшем каталогов назначения и т.п.
+        Разобранные шаблоны и типы файлов не копируются, а используются
+        совместно (они после создания не изменяются)."""
 
-    def __init__(self):
-        """Поиск и загрузка файла конфигурации, после - разбор командной
-        строки.
+        env = copy.copy(self)
+
+        env.sourceDirs = [self.SourceDir(sd.path, sd.ignore) for sd in self.sourceDirs]
+        env.destinationDirs = list(self.destinationDirs)
+        env.aliases = dict(self.aliases)
+        env.templates = dict(self.templates)
+        env.excludeDirs = list(self.excludeDirs)
+
+        throttle = self.transfer.throttle
+        if throttle is not None:
+            # у каждого экземпляра - своё "ведро"
+            throttle = IOThrottle(throttle.maxBytesRate, throttle.maxFilesRate, throttle.backoff)
+
+        env.transfer = FileTransfer(self.transfer.cachePolicy, self.transfer.durability, self.transfer.syncBatchSize,
+            self.transfer.verify, throttle)
+        env.destDirs = DestinationDirCache(self.destDirs.shardSize)
+
+        env.logger = PMVLogger(self.logger.logDir, self.maxLogSizeMB)
+        env.checkpoint = PMVCheckpoint(self.logger.logDir, self.checkpointInterval,
+            self.transfer.durability == FileTransfer.SYNC_FILE)
+        env.scanIndex = ScanIndex(self.logger.logDir, self.knownFileTypes) if self.useScanIndex else None
+
+        env.setup_work_mode()
+
+        return env
+
+    def __init__(self, config=None, moveFiles=None, cacheDir=None):
+        """Если config=None - поиск и загрузка файла конфигурации, после -
+        разбор командной строки;
+        иначе - см. from_config.
 
         В случае ошибок генерирует исключения."""
 
@@ -287,6 +444,8 @@ class Environment():
 
         self.modeMessages = None
         self.modeFileOp = None
+        # то же для нескольких каталогов назначения
+        self.modeFileOpMulti = None
 
         # каталоги, из которых копируются (или перемещаются) изображения
         # список экземпляров Environment.SourceDir
@@ -295,8 +454,14 @@ class Environment():
         # каталог, в который копируются (или перемещаются) изображения
         self.destinationDir = None
 
-        # поддерживаемые типы файлов (по расширениям)
-        self.knownFileTypes = FileTypes()
+        # все каталоги назначения (первый - destinationDir, остальные -
+        # дополнительные, напр. резервные копии); файлы пишутся во все
+        # сразу, с одинаковыми относительными путями
+        self.destinationDirs = []
+
+        # поддерживаемые типы файлов (по расширениям) - экземпляр FileTypes
+        # (присваивается при разборе секции options)
+        self.knownFileTypes = None
 
         # что делать с файлами, которые уже есть в каталоге-приемнике
         self.ifFileExists = self.FEXIST_RENAME
@@ -320,16 +485,83 @@ class Environment():
         # максимальный размер файла журнала в мегабайтах
         self.maxLogSizeMB = self.DEFAULT_MAX_LOG_SIZE
 
+        # кол-во файлов из очереди обработки, заголовки которых
+        # читаются заранее (см. pmvfileio.HeaderPrefetcher)
+        self.readAheadFiles = self.DEFAULT_READ_AHEAD
+
+        # копирование/перемещение файлов
+        self.transfer = FileTransfer()
+
+        # содержимое каталогов назначения и зарезервированные имена файлов
+        self.destDirs = DestinationDirCache()
+
+        # кол-во файлов между сбросами контрольной точки на диск
+        self.checkpointInterval = PMVCheckpoint.DEFAULT_SYNC_INTERVAL
+
+        # True - продолжение прерванного запуска (ключ --resume)
+        self.resumeRun = False
+
+        # None или формат сводки по журналу (ключ --report,
+        # см. pmvreport.JournalReport.FORMAT_xxx)
+        self.reportFormat = None
+
+        # шаблоны имён каталогов, пропускаемых при поиске файлов
+        self.excludeDirs = []
+
+        # максимальная глубина обхода каталогов-источников (0 - без ограничений)
+        self.maxScanDepth = 0
+
+        # не заходить при поиске файлов в каталоги на других ФС
+        self.oneFileSystem = False
+
+        # True - использовать индекс содержимого каталогов-источников
+        self.useScanIndex = False
+
+        # индекс содержимого каталогов-источников (ScanIndex) или None
+        self.scanIndex = None
+
+        # кол-во процессов для извлечения метаданных
+        # (0 - метаданные извлекаются в основном процессе)
+        self.metadataWorkers = 0
+
+        # максимальное время извлечения метаданных одного файла (в секундах)
+        self.metadataTimeout = MetadataWorkerPool.DEFAULT_TIMEOUT
+
+        # кол-во файлов, после которых процесс извлечения метаданных перезапускается
+        self.metadataWorkerRecycle = MetadataWorkerPool.DEFAULT_RECYCLE
+
+        # True - для серий снимков EXIF разбирается полностью только
+        # у первого файла серии (см. pmvmetadata.BurstCache)
+        self.useBurstCache = False
+
+        # True - понизить приоритет ввода-вывода до "idle"
+        # (см. pmvthrottle.set_idle_io_priority)
+        self.idleIOPriority = False
 
-        #
-        # ищем файл конфигурации
-        #
-        self.configPath = self.__get_config_path(sys.argv[0])
         self.cfg = PMVRawConfigParser()
 
-        with open(self.configPath, 'r', encoding=ENCODING) as f:
+        # каталог журнала, контрольной точки, индекса и кэша настроек
+        # (сам каталог создаётся при открытии журнала)
+        logdir = self.__get_log_directory() if cacheDir is None else validate_path(cacheDir)
+
+        # ключ для сохранения кэша настроек или None
+        cfgCacheKey = None
+
+        if config is None:
+            #
+            # ищем файл конфигурации
+            #
+            self.configPath = self.__get_config_path(sys.argv[0])
+
+            cfgCacheKey = self.__read_config_file(logdir)
+        else:
+            self.configPath = self.CFG_IN_MEMORY
+
             try:
-                self.cfg.read_file(f)
+                if isinstance(config, RawConfigParser):
+                    self.cfg.read_dict({secname:dict(config.items(secname, raw=True)) for secname in config.sections()})
+                else:
+                    self.cfg.read_dict(config)
             except ConfigParserError as ex:
                 raise self.Error(self.E_CONFIG % str(ex))
 
@@ -364,19 +596,38 @@ class Environment():
         if self.cfg.has_section(self.SEC_TEMPLATES):
             self.__read_config_templates()
 
+        if cfgCacheKey is not None:
+            self.__write_config_cache(logdir, cfgCacheKey)
+
         #
         # журналирование операций
         #
 
-        self.logger = PMVLogger(self.__get_log_directory(), self.maxLogSizeMB)
+        self.logger = PMVLogger(logdir, self.maxLogSizeMB)
+
+        # контрольная точка для продолжения прерванного запуска
+        self.checkpoint = PMVCheckpoint(logdir, self.checkpointInterval,
+            self.transfer.durability == FileTransfer.SYNC_FILE)
+
+        # индекс содержимого каталогов-источников
+        # (открывается и закрывается снаружи, как и logger)
+        if self.useScanIndex:
+            self.scanIndex = ScanIndex(logdir, self.knownFileTypes)
 
         #
         # ...а вот теперь - разгребаем командную строку, т.к. ее параметры
         # перекрывают файл настроек
         #
 
-        self.__detect_work_mode()
-        self.__parse_cmdline_options()
+        if config is None:
+            self.__detect_work_mode()
+            self.__parse_cmdline_options()
+        else:
+            self.modeMoveFiles = bool(moveFiles)
+
+        if self.reportFormat is not None:
+            # для сводки по журналу нужен только журнал
+            return
 
         if self.modeMoveFiles is None:
             raise self.Error('Меня зовут %s, и я не знаю, что делать.' % bname)
@@ -392,10 +643,23 @@ class Environment():
 
         # минимальное причёсывание
         if self.destinationDir:
-            self.destinationDir = validate_path(self.destinationDir)
+            # каталог назначения мог быть заменён из командной строки
+            if not self.destinationDirs or self.destinationDir != self.destinationDirs[0]:
+                self.destinationDirs = [self.destinationDir]
 
-            if os.path.exists(self.destinationDir) and not os.path.isdir(self.destinationDir):
-                raise self.Error('путь "%s" указывает не на каталог' % self.destinationDir)
+            self.destinationDirs = list(map(validate_path, self.destinationDirs))
+            self.destinationDir = self.destinationDirs[0]
+
+            for destdir in self.destinationDirs:
+                if os.path.exists(destdir) and not os.path.isdir(destdir):
+                    raise self.Error('путь "%s" указывает не на каталог' % destdir)
+
+            for ixdd, destdir in enumerate(self.destinationDirs):
+                for otherdir in self.destinationDirs[:ixdd]:
+                    if same_dir(destdir, otherdir):
+                        raise self.Error('каталог назначения "%s" указан более одного раза' % destdir)
+        else:
+            self.destinationDirs = []
 
         #
         self.setup_work_mode()
@@ -445,8 +709,29 @@ class Environment():
             choices=self.FEXIST_OPTIONS.keys(),
             default=self.FEXISTS_OPTIONS_STR[self.ifFileExists])
 
+        aparser.add_argument('-r', '--resume', help='продолжить прерванный запуск (без повторного поиска файлов)',
+            action='store_true', dest='resume', default=False)
+
+        aparser.add_argument('--verify', help='проверка копий - подсчёт контрольных сумм при копировании (hash) и перечитывание записанных файлов (reread)',
+            action='store', nargs='?', dest='verify',
+            choices=FileTransfer.VERIFY_OPTIONS.keys(),
+            const=FileTransfer.VERIFY_OPTIONS_STR[FileTransfer.VERIFY_HASH],
+            default=None)
+
+        aparser.add_argument('--report', help='вывести сводку по журналу операций (в виде текста или JSON) и завершить работу; байты по дням группируются по датам файлов',
+            action='store', nargs='?', dest='report',
+            choices=JournalReport.FORMATS,
+            const=JournalReport.FORMAT_TEXT,
+            default=None)
+
         args = aparser.parse_args()
 
+        self.resumeRun = args.resume
+        self.reportFormat = args.report
+
+        if args.verify is not None:
+            self.transfer.verify = FileTransfer.VERIFY_OPTIONS[args.verify]
+
         # т.к. ArgumentParser хранит обычные параметры как список списков, извращаемся:
 
         def __expand_list(l):
@@ -523,7 +808,9 @@ class Environment():
         # каталог назначения
         #
 
-        self.destinationDir = self.cfg.getstr(self.SEC_PATHS, self.OPT_DEST_DIR)
+        # каталогов может быть несколько (через ":") - см. destinationDirs
+        self.destinationDirs = list(filter(None, map(lambda s: s.strip(), self.cfg.getstr(self.SEC_PATHS, self.OPT_DEST_DIR).split(':'))))
+        self.destinationDir = self.destinationDirs[0] if self.destinationDirs else ''
 
         # правильность указания каталога назначения проверяется в конце __init__
 
@@ -531,8 +818,15 @@ class Environment():
         """Проверка, не является ли каталог назначения одним из каталогов-
         источников.
 
+        Проверяются все каталоги назначения (см. destinationDirs).
+
         Возвращает True, если случилась такая досада..."""
-        return self.same_src_dir(self.destinationDir)
+
+        for destdir in self.destinationDirs:
+            if self.same_src_dir(destdir):
+                return True
+
+        return False
 
     def same_src_dir(self, dirname):
         """Возвращает True, если каталог dirname совпадает с одним из
@@ -565,20 +859,38 @@ class Environment():
         self.showSrcDir = self.cfg.getboolean(self.SEC_OPTIONS, self.OPT_SHOW_SRC_DIR, fallback=False)
 
         #
-        # known-*-types
+        # known-*-types, known-sidecar-types, sidecars
         #
-        for ixopt, optname in enumerate(self.OPT_KNOWN_FILE_TYPES):
-            kts = filter(None, self.cfg.getstr(self.SEC_OPTIONS, optname).lower().split(None))
+        ftkey = self.__get_file_types_key()
+        ktopts, sctopt, sidecars = ftkey
+
+        ftypes = self.__fileTypesCache.get(ftkey)
+
+        if ftypes is None:
+            ftypes = FileTypes()
 
-            exts = set()
+            def exts_from_str(ktopt):
+                exts = set()
 
-            for ktype in kts:
-                if not ktype.startswith('.'):
-                    ktype = '.%s' % ktype
+                for ktype in filter(None, ktopt.split(None)):
+                    if not ktype.startswith('.'):
+                        ktype = '.%s' % ktype
 
-                exts.add(ktype)
+                    exts.add(ktype)
 
-            self.knownFileTypes.add_extensions(ixopt, exts)
+                return exts
+
+            for ixopt, ktopt in enumerate(ktopts):
+                ftypes.add_extensions(ixopt, exts_from_str(ktopt))
+
+            if sidecars:
+                ftypes.add_sidecar_extensions(exts_from_str(sctopt))
+            else:
+                ftypes.sidecarExtensions.clear()
+
+            self.__fileTypesCache[ftkey] = ftypes
+
+        self.knownFileTypes = ftypes
 
         #
         # max-log-size
@@ -589,19 +901,199 @@ class Environment():
 
         self.maxLogSizeMB = mls
 
+        #
+        # read-ahead
+        #
+        ra = self.cfg.getint(self.SEC_OPTIONS, self.OPT_READ_AHEAD, fallback=self.DEFAULT_READ_AHEAD)
+        if ra < 0:
+            ra = self.DEFAULT_READ_AHEAD
+
+        self.readAheadFiles = ra
+
+        #
+        # transfer-cache
+        #
+        tcopt = self.cfg.getstr(self.SEC_OPTIONS, self.OPT_TRANSFER_CACHE).lower()
+        if not tcopt:
+            cachePolicy = FileTransfer.CACHE_NORMAL
+        elif tcopt in FileTransfer.CACHE_OPTIONS:
+            cachePolicy = FileTransfer.CACHE_OPTIONS[tcopt]
+        else:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_TRANSFER_CACHE, self.SEC_OPTIONS, self.configPath))
+
+        #
+        # durability
+        #
+        duropt = self.cfg.getstr(self.SEC_OPTIONS, self.OPT_DURABILITY).lower()
+        if not duropt:
+            durability = FileTransfer.SYNC_NONE
+        elif duropt in FileTransfer.SYNC_OPTIONS:
+            durability = FileTransfer.SYNC_OPTIONS[duropt]
+        else:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_DURABILITY, self.SEC_OPTIONS, self.configPath))
+
+        #
+        # sync-batch-size
+        #
+        sbs = self.cfg.getint(self.SEC_OPTIONS, self.OPT_SYNC_BATCH_SIZE, fallback=FileTransfer.DEFAULT_SYNC_BATCH_SIZE)
+        if sbs < 1:
+            sbs = FileTransfer.DEFAULT_SYNC_BATCH_SIZE
+
+        #
+        # verify
+        #
+        vopt = self.cfg.getstr(self.SEC_OPTIONS, self.OPT_VERIFY).lower()
+        if not vopt:
+            verify = FileTransfer.VERIFY_NONE
+        elif vopt in FileTransfer.VERIFY_OPTIONS:
+            verify = FileTransfer.VERIFY_OPTIONS[vopt]
+        else:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_VERIFY, self.SEC_OPTIONS, self.configPath))
+
+        #
+        # max-transfer-rate, max-file-rate, io-backoff
+        #
+        try:
+            mtr = self.cfg.getfloat(self.SEC_OPTIONS, self.OPT_MAX_TRANSFER_RATE, fallback=0.0)
+        except ValueError:
+            mtr = -1
+        if mtr < 0:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_MAX_TRANSFER_RATE, self.SEC_OPTIONS, self.configPath))
+
+        try:
+            mfr = self.cfg.getfloat(self.SEC_OPTIONS, self.OPT_MAX_FILE_RATE, fallback=0.0)
+        except ValueError:
+            mfr = -1
+        if mfr < 0:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_MAX_FILE_RATE, self.SEC_OPTIONS, self.configPath))
+
+        throttle = IOThrottle(int(mtr * 1024 * 1024), mfr,
+            self.cfg.getboolean(self.SEC_OPTIONS, self.OPT_IO_BACKOFF, fallback=False))
+
+        self.transfer = FileTransfer(cachePolicy, durability, sbs, verify,
+            throttle if throttle.enabled else None)
+
+        #
+        # io-priority
+        #
+        iopopt = self.cfg.getstr(self.SEC_OPTIONS, self.OPT_IO_PRIORITY).lower()
+        if iopopt and iopopt not in self.IOPRIO_OPTIONS:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_IO_PRIORITY, self.SEC_OPTIONS, self.configPath))
+
+        self.idleIOPriority = iopopt == self.IOPRIO_IDLE
+
+        #
+        # shard-size
+        #
+        ss = self.cfg.getint(self.SEC_OPTIONS, self.OPT_SHARD_SIZE, fallback=0)
+        if ss < 0:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_SHARD_SIZE, self.SEC_OPTIONS, self.configPath))
+
+        self.destDirs = DestinationDirCache(ss)
+
+        #
+        # checkpoint-interval
+        #
+        cpi = self.cfg.getint(self.SEC_OPTIONS, self.OPT_CHECKPOINT_INTERVAL, fallback=PMVCheckpoint.DEFAULT_SYNC_INTERVAL)
+        if cpi < 1:
+            cpi = PMVCheckpoint.DEFAULT_SYNC_INTERVAL
+
+        self.checkpointInterval = cpi
+
+        #
+        # exclude-dirs
+        #
+        self.excludeDirs = list(filter(None, map(lambda s: s.strip(), self.cfg.getstr(self.SEC_OPTIONS, self.OPT_EXCLUDE_DIRS).split(':'))))
+
+        #
+        # max-depth
+        #
+        md = self.cfg.getint(self.SEC_OPTIONS, self.OPT_MAX_DEPTH, fallback=0)
+        if md < 0:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_MAX_DEPTH, self.SEC_OPTIONS, self.configPath))
+
+        self.maxScanDepth = md
+
+        #
+        # one-filesystem
+        #
+        self.oneFileSystem = self.cfg.getboolean(self.SEC_OPTIONS, self.OPT_ONE_FILESYSTEM, fallback=False)
+
+        #
+        # scan-index
+        #
+        self.useScanIndex = self.cfg.getboolean(self.SEC_OPTIONS, self.OPT_SCAN_INDEX, fallback=False)
+
+        #
+        # burst-cache
+        #
+        self.useBurstCache = self.cfg.getboolean(self.SEC_OPTIONS, self.OPT_BURST_CACHE, fallback=False)
+
+        #
+        # metadata-workers
+        #
+        mw = self.cfg.getint(self.SEC_OPTIONS, self.OPT_METADATA_WORKERS, fallback=0)
+        if mw < 0:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_METADATA_WORKERS, self.SEC_OPTIONS, self.configPath))
+
+        self.metadataWorkers = mw
+
+        #
+        # metadata-timeout
+        #
+        mt = self.cfg.getint(self.SEC_OPTIONS, self.OPT_METADATA_TIMEOUT, fallback=MetadataWorkerPool.DEFAULT_TIMEOUT)
+        if mt < 1:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_METADATA_TIMEOUT, self.SEC_OPTIONS, self.configPath))
+
+        self.metadataTimeout = mt
+
+        #
+        # metadata-worker-recycle
+        #
+        mr = self.cfg.getint(self.SEC_OPTIONS, self.OPT_METADATA_WORKER_RECYCLE, fallback=MetadataWorkerPool.DEFAULT_RECYCLE)
+        if mr < 1:
+            raise self.Error(self.E_BADVAL2 % (self.OPT_METADATA_WORKER_RECYCLE, self.SEC_OPTIONS, self.configPath))
+
+        self.metadataWorkerRecycle = mr
+
+    def __get_file_types_key(self):
+        """Возвращает ключ для __fileTypesCache - кортеж из значений
+        параметров known-*-types, known-sidecar-types и sidecars."""
+
+        ktopts = tuple(map(lambda optname: self.cfg.getstr(self.SEC_OPTIONS, optname).lower(), self.OPT_KNOWN_FILE_TYPES))
+
+        sctopt = self.cfg.getstr(self.SEC_OPTIONS, self.OPT_KNOWN_SIDECAR_TYPES).lower()
+        sidecars = self.cfg.getboolean(self.SEC_OPTIONS, self.OPT_SIDECARS, fallback=False)
+
+        return (ktopts, sctopt, sidecars)
+
+    def __get_aliases_key(self):
+        """Возвращает ключ для __aliasesCache - кортеж пар
+        ('имя', 'псевдоним') из секции aliases."""
+
+        return tuple(map(lambda aname: (aname, self.cfg.getstr(self.SEC_ALIASES, aname)), self.cfg.options(self.SEC_ALIASES)))
+
     def __read_config_aliases(self):
         """Разбор секции aliases файла настроек"""
 
-        anames = self.cfg.options(self.SEC_ALIASES)
+        akey = self.__get_aliases_key()
 
-        for aname in anames:
-            astr = self.cfg.getstr(self.SEC_ALIASES, aname)
+        aliases = self.__aliasesCache.get(akey)
 
-            if not astr:
-                raise self.Error(self.E_NOVAL % (aname, self.SEC_ALIASES, self.configPath))
+        if aliases is None:
+            aliases = {}
 
-            # проверку на повтор не делаем - RawConfigParser ругнётся раньше на одинаковые опции
-            self.aliases[aname.lower()] = normalize_filename(astr)
+            for aname, astr in akey:
+                if not astr:
+                    raise self.Error(self.E_NOVAL % (aname, self.SEC_ALIASES, self.configPath))
+
+                # проверку на повтор не делаем - RawConfigParser ругнётся раньше на одинаковые опции
+                aliases[aname.lower()] = normalize_filename(astr)
+
+            self.__aliasesCache[akey] = aliases
+
+        # копия - на случай изменения псевдонимов снаружи
+        self.aliases = dict(aliases)
 
     def __read_config_templates(self):
         """Разбор секции templates файла настроек"""
@@ -617,10 +1109,19 @@ class Environment():
             tplname = tname.lower()
 
             # проверку на повтор не делаем - RawConfigParser ругнётся раньше на одинаковые опции
-            try:
-                self.templates[tplname] = FileNameTemplate(tstr)
-            except Exception as ex:
-                raise self.Error(self.E_BADVAL % (tname, self.SEC_TEMPLATES, self.configPath, repr(ex)))
+            # экземпляры FileNameTemplate после создания не изменяются,
+            # так что их можно использовать повторно
+            template = self.__templateCache.get(tstr)
+
+            if template is None:
+                try:
+                    template = FileNameTemplate(tstr)
+                except Exception as ex:
+                    raise self.Error(self.E_BADVAL % (tname, self.SEC_TEMPLATES, self.configPath, repr(ex)))
+
+                self.__templateCache[tstr] = template
+
+            self.templates[tplname] = template
 
         # если в файле настроек не был указан общий шаблон с именем "*",
         # то добавляем в templates встроенный шаблон pmvtemplates.defaultFileNameTemplate
@@ -629,15 +1130,108 @@ class Environment():
         if self.DEFAULT_TEMPLATE_NAME not in self.templates:
             self.templates[self.DEFAULT_TEMPLATE_NAME] = defaultFileNameTemplate
 
+    def __read_config_file(self, cacheDir):
+        """Загрузка файла настроек self.configPath в self.cfg.
+
+        Если в каталоге cacheDir есть кэш, сохранённый для файла
+        настроек с тем же содержимым (совпадают время изменения, размер
+        и SHA1), то файл не разбирается: содержимое секций, шаблоны,
+        псевдонимы и типы файлов в уже разобранном и проверенном виде
+        загружаются из кэша одним pickle.load, так что частые запуски
+        (из cron и т.п.) с большим кол-вом шаблонов обходятся дёшево.
+
+        Возвращает None, если настройки взяты из кэша, иначе - ключ,
+        который следует передать __write_config_cache после проверки
+        всех настроек."""
+
+        try:
+            with open(self.configPath, 'rb') as f:
+                data = f.read()
+                st = os.fstat(f.fileno())
+        except OSError as ex:
+            raise self.Error('Не удалось прочитать файл настроек "%s" - %s' % (self.configPath, ex))
+
+        # разобранные шаблоны и типы файлов - экземпляры классов
+        # из модулей программы, потому кэш годится только для той же
+        # версии этих модулей
+        try:
+            codeVersion = tuple(os.stat(sys.modules[cls.__module__].__file__).st_mtime_ns for cls in (FileNameTemplate, FileTypes))
+        except (OSError, AttributeError, TypeError):
+            codeVersion = None
+
+        key = (self.__CONFIG_CACHE_VERSION, VERSION, codeVersion, self.configPath,
+            st.st_mtime_ns, st.st_size, hashlib.sha1(data).hexdigest())
+
+        cached = None
+
+        try:
+            with open(os.path.join(cacheDir, self.CONFIG_CACHE_FNAME), 'rb') as f:
+                cached = pickle.load(f)
+        except Exception:
+            # нет кэша, или он испорчен, или от другой версии программы -
+            # просто разбираем файл настроек
+            pass
+
+        if isinstance(cached, tuple) and len(cached) == 5 and cached[0] == key:
+            sections, templates, aliases, fileTypes = cached[1:]
+
+            self.cfg.read_dict(sections)
+
+            self.__templateCache.update(templates)
+            self.__aliasesCache.update(aliases)
+            self.__fileTypesCache.update(fileTypes)
+
+            return None
+
+        try:
+            self.cfg.read_file(io.StringIO(data.decode(ENCODING), newline=None), self.configPath)
+        except (ConfigParserError, UnicodeDecodeError) as ex:
+            raise self.Error(self.E_CONFIG % str(ex))
+
+        return key
+
+    def __write_config_cache(self, cacheDir, key):
+        """Сохранение кэша разобранного файла настроек (см.
+        __read_config_file) в каталоге cacheDir.
+        Ошибки игнорируются - без кэша программа тоже работает."""
+
+        sections = {secname:dict(self.cfg.items(secname, raw=True)) for secname in self.cfg.sections()}
+
+        templates = {}
+        if self.cfg.has_section(self.SEC_TEMPLATES):
+            for tname in self.cfg.options(self.SEC_TEMPLATES):
+                tstr = self.cfg.getstr(self.SEC_TEMPLATES, tname)
+                templates[tstr] = self.__templateCache[tstr]
+
+        aliases = {}
+        if self.cfg.has_section(self.SEC_ALIASES):
+            akey = self.__get_aliases_key()
+            aliases[akey] = self.__aliasesCache[akey]
+
+        ftkey = self.__get_file_types_key()
+
+        cachePath = os.path.join(cacheDir, self.CONFIG_CACHE_FNAME)
+        tmpPath = '%s.tmp' % cachePath
+
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+
+            with open(tmpPath, 'wb') as f:
+                pickle.dump((key, sections, templates, aliases, {ftkey:self.__fileTypesCache[ftkey]}),
+                    f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmpPath, cachePath)
+        except (OSError, pickle.PicklingError):
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+
     def __get_log_directory(self):
         """Возвращает полный путь к каталогу файлов журналов операций.
-        При отсутствии каталога - создаёт его."""
-
-        logdir = os.path.expanduser('~/.cache/photomv')
-        if not os.path.exists(logdir):
-            make_dirs(logdir, self.Error)
+        Сам каталог создаётся при открытии журнала (см. PMVLogger.open)."""
 
-        return logdir
+        return os.path.expanduser('~/.cache/photomv')
 
     def __get_config_path(self, me):
         """Поиск файла конфигурации.
@@ -670,9 +1264,12 @@ class Environment():
         """Сохранение настроек.
         В случае ошибки генерирует исключение."""
 
+        if self.configPath == self.CFG_IN_MEMORY:
+            raise self.Error('настройки не были загружены из файла - сохранять некуда')
+
         # секция paths
         self.cfg.set(self.SEC_PATHS, self.OPT_SRC_DIRS, ':'.join(map(lambda sd: '%s%s' % ('-' if sd.ignore else '', sd.path), self.sourceDirs)))
-        self.cfg.set(self.SEC_PATHS, self.OPT_DEST_DIR, self.destinationDir)
+        self.cfg.set(self.SEC_PATHS, self.OPT_DEST_DIR, ':'.join([self.destinationDir] + self.destinationDirs[1:]))
 
         # секция options
         self.cfg.set(self.SEC_OPTIONS, self.OPT_IF_EXISTS, self.FEXISTS_OPTIONS_STR[self.ifFileExists])
@@ -689,7 +1286,7 @@ class Environment():
         определённой камеры.
 
         cameraModel - название модели из метаданных файла
-                      (pmvmetadata.FileMetadata.fields[pmvmetadata.MODEL]),
+                      (pmvmetadata.FileMetadata.model),
                       пустая строка, или None;
                       в последних двух случаях возвращает общий шаблон
                       из файла настроек, если он указан, иначе возвращает
@@ -717,16 +1314,33 @@ class Environment():
         # а когда совсем ничего нету - встроенный шаблон
         return defaultFileNameTemplate
 
+    def metadata_needs_exif(self):
+        """Возвращает True, если для выбора шаблонов и создания новых
+        имён файлов нужны метаданные из EXIF."""
+
+        for tplCameraModel, template in self.templates.items():
+            if tplCameraModel != self.DEFAULT_TEMPLATE_NAME or template.needs_exif():
+                return True
+
+        return False
+
     def get_template_from_metadata(self, metadata):
         """Получение экземпляра pmvtemplates.FileNameTemplate для
         определённой камеры, модель которой определяется по
-        соответствующему полю metadata - экземпляра FileMetadata."""
+        соответствующему полю metadata - экземпляра FileMetadata.
+
+        Если индивидуальных шаблонов для камер нет - модель
+        (а значит, и EXIF) из файла не извлекается."""
+
+        for tplCameraModel in self.templates:
+            if tplCameraModel != self.DEFAULT_TEMPLATE_NAME:
+                return self.get_template(metadata.model)
 
-        return self.get_template(metadata.fields[metadata.MODEL])
+        return self.get_template(None)
 
     def __repr__(self):
         """Для отладки"""
-        return '%s(cfg = "%s", modeMoveFiles = %s, modeMessages = %s, modeFileOp = %s, sourceDirs = %s, destinationDir = "%s", ifFileExists = %s, knownFileTypes: %s, showSrcDir = %s, aliases = %s, templates = %s, maxLogSizeMB = %d, logger = "%s")' % (
+        return '%s(cfg = "%s", modeMoveFiles = %s, modeMessages = %s, modeFileOp = %s, sourceDirs = %s, destinationDir = "%s", ifFileExists = %s, knownFileTypes: %s, showSrcDir = %s, aliases = %s, templates = %s, maxLogSizeMB = %d, readAheadFiles = %d, transfer = %s, logger = "%s")' % (
             self.__class__.__name__,
             self.cfg,
             self.modeMoveFiles,
@@ -740,6 +1354,8 @@ class Environment():
             self.aliases,
             ', '.join(map(str, self.templates.values())),
             self.maxLogSizeMB,
+            self.readAheadFiles,
+            self.transfer,
             self.logger)
 
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path
+import stat
+import mmap
+import threading
+from queue import Queue
+
+
+class HeaderPrefetcher():
+    """Упреждающее чтение заголовков файлов из очереди обработки.
+
+    Пока обрабатывается текущий файл, для следующих depth файлов
+    очереди в отдельном потоке запрашивается чтение начальных
+    headerSize байт (где живут EXIF и прочие метаданные).
+    Если ОС умеет posix_fadvise - используется POSIX_FADV_WILLNEED,
+    иначе заголовок просто читается, чтобы попасть в кэш ОС.
+
+    Открытие файлов тоже делается в потоке, т.к. на NFS и прочих
+    медленных ФС оно само по себе стоит заметного времени."""
+
+    DEFAULT_HEADER_SIZE = 256 * 1024
+
+    def __init__(self, depth, headerSize=DEFAULT_HEADER_SIZE):
+        """depth        - кол-во файлов, читаемых заранее;
+                          0 - упреждающее чтение отключено;
+        headerSize      - размер читаемого заголовка в байтах."""
+
+        self.depth = depth
+        self.headerSize = headerSize
+
+        # индекс последнего элемента очереди, отправленного в поток
+        self.lastIx = -1
+
+        self.requests = None
+        self.thread = None
+
+        if self.depth > 0:
+            self.requests = Queue()
+            self.thread = threading.Thread(target=self.__prefetch_thread, daemon=True)
+            self.thread.start()
+
+    def __prefetch_thread(self):
+        while True:
+            path = self.requests.get()
+            if path is None:
+                break
+
+            self.prefetch_file(path)
+
+    def prefetch_file(self, path):
+        """Запрос на чтение заголовка файла path в кэш ОС.
+        Ошибки игнорируются - файл потом всё равно будет открыт
+        для обработки, и уже там о них станет известно."""
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, 0, self.headerSize, os.POSIX_FADV_WILLNEED)
+                else:
+                    os.read(fd, self.headerSize)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def advance(self, queue, ix):
+        """Вызывается перед обработкой элемента ix очереди queue.
+
+        queue   - последовательность кортежей вида ('каталог', 'имя файла', ...);
+        ix      - индекс текущего элемента."""
+
+        if self.thread is None:
+            return
+
+        lastIx = min(ix + self.depth, len(queue) - 1)
+
+        for pix in range(max(self.lastIx + 1, ix + 1), lastIx + 1):
+            self.requests.put(os.path.join(queue[pix][0], queue[pix][1]))
+
+        self.lastIx = max(self.lastIx, lastIx)
+
+    def close(self):
+        """Останов потока упреждающего чтения."""
+
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(depth=%d, headerSize=%d)' % (self.__class__.__name__,
+            self.depth, self.headerSize)
+
+
+class SourceFile():
+    """Исходный файл, открытый для извлечения метаданных.
+
+    Файл открывается один раз; сведения о нём (os.stat_result) берутся
+    у открытого дескриптора (os.fstat), а содержимое доступно только
+    для чтения через отображение в память (mmap) - без копирования
+    в буферы Python. Отображается файл целиком, но с диска читаются
+    (и занимают память) только затронутые страницы, т.е. на практике -
+    заголовок с метаданными.
+
+    Отображение используется там, где содержимое файла разбирается
+    средствами Python (pmvmetadata.BurstCache); GExiv2 его не получает
+    (см. FileMetadata.__open_exif).
+
+    Пригоден для использования в операторе with."""
+
+    # O_NONBLOCK - чтобы открытие FIFO не повисло (на обычные файлы
+    # не влияет)
+    OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0) | getattr(os, 'O_CLOEXEC', 0) | getattr(os, 'O_BINARY', 0)
+
+    def __init__(self, path):
+        """path - полный путь к файлу.
+        В случае ошибки генерирует исключение OSError.
+
+        Поля:
+        path    - полный путь к файлу;
+        fd      - дескриптор открытого файла;
+        stat    - экземпляр os.stat_result."""
+
+        self.path = path
+        self.fd = os.open(path, self.OPEN_FLAGS)
+
+        try:
+            self.stat = os.fstat(self.fd)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+        self.map = None
+
+    def is_file(self):
+        """Возвращает True, если это обычный файл."""
+
+        return stat.S_ISREG(self.stat.st_mode)
+
+    def get_map(self):
+        """Возвращает отображение файла в память (экземпляр mmap.mmap,
+        только для чтения), или None, если файл пустой или не может
+        быть отображён (не обычный файл и т.п.)."""
+
+        if self.map is None and self.fd is not None and self.stat.st_size > 0 and self.is_file():
+            try:
+                self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(path="%s", fd=%s, mapped=%s)' % (self.__class__.__name__,
+            self.path, self.fd, self.map is not None)
@@ -0,0 +1,1161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path
+import errno
+import datetime
+import threading
+import time
+from collections import namedtuple
+
+from pmvcommon import *
+from pmvmetadata import FileMetadata, BurstCache
+from pmvfileio import HeaderPrefetcher, SourceFile
+from pmvscanner import SourceScanner
+from pmvworkers import MetadataWorkerPool
+from pmvthrottle import set_idle_io_priority
+from pmvtransfer import rename_noreplace
+
+
+# результат обработки одного элемента очереди:
+# src       - полный путь к исходному файлу;
+# dest      - полный путь к файлу назначения или None;
+# action    - PMVJob.ACTION_xxx;
+# size      - размер файла в байтах (0, если неизвестен);
+# timings   - экземпляр FileTimings или None;
+# error     - сообщение об ошибке (или о причине пропуска файла) или None;
+# digest    - контрольная сумма скопированных данных ("алгоритм:сумма")
+#             или None (см. параметр verify);
+# sidecars  - кортеж полных путей к скопированным (перемещённым)
+#             вместе с файлом сопроводительным файлам (в основном
+#             каталоге назначения)
+FileResult = namedtuple('FileResult', 'src dest action size timings error digest sidecars', defaults=(None, ()))
+
+# время (в секундах), потраченное на стадии обработки файла:
+# извлечение метаданных и создание нового имени, создание каталога
+# и резервирование имени, копирование (перемещение)
+FileTimings = namedtuple('FileTimings', 'metadata place transfer')
+
+# итоги обработки:
+# total     - всего файлов в очереди;
+# processed - скопировано (перемещено) файлов;
+# skipped   - пропущено файлов (в т.ч. из-за ошибок);
+# bytes     - скопировано (перемещено) байт;
+# elapsed   - общее время обработки в секундах
+JobStats = namedtuple('JobStats', 'total processed skipped bytes elapsed')
+
+
+class JobUI():
+    """Вывод сообщений о ходе обработки файлов.
+    Этот класс сообщения просто выбрасывает; для вывода куда-либо
+    следует перекрыть нужные методы в классе-потомке."""
+
+    def show_dir(self, dirname):
+        """Начало обработки файлов из каталога dirname."""
+
+        pass
+
+    def progress(self, progress, msg=''):
+        """Ход обработки; progress - доля обработанных файлов
+        (0.0-1.0) или отрицательное число, если она неизвестна."""
+
+        pass
+
+    def error(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+
+class PMVJob():
+    """Задание на обработку файлов из каталогов-источников.
+
+    Содержит общую для синхронного (photomv.process_files)
+    и асинхронного (pmvasync.process_files_async) движков логику;
+    движки только вызывают методы в нужном порядке.
+
+    Порядок работы:
+    1. prepare - поиск файлов (или загрузка очереди из контрольной
+       точки) и проверка каталога назначения;
+    2. open;
+    3. для каждого индекса из pending_indexes:
+       - plan_file - извлечение метаданных и создание нового имени;
+       - place_file - создание каталога и резервирование имени файла;
+       - begin_file, transfer_file, end_file - копирование (перемещение);
+       - sync_transfers и report_sync - сброс на диск пачки файлов;
+       - finish_file - отметка в контрольной точке;
+    4. close.
+
+    Методы plan_file, place_file, transfer_file и sync_transfers
+    не пишут в журнал и могут вызываться из разных потоков
+    одновременно; остальные методы вызываются из одного потока.
+
+    Об ошибках, из-за которых файл пропускается, plan_file, place_file
+    и transfer_file сообщают исключением PMVJob.Skipped (его следует передать
+    методу skip_file), о неустранимых ошибках - исключением
+    PMVJob.Fatal (его следует передать методу report_fatal).
+
+    Методы end_file, skip_file и resumed_file возвращают результат
+    обработки файла - экземпляр FileResult.
+
+    Для синхронной обработки проще всего использовать метод run."""
+
+    ACTION_COPY = 'cp'
+    ACTION_MOVE = 'mv'
+    # файл пропущен (см. FileResult.error)
+    ACTION_SKIP = 'skip'
+    # ошибка копирования (перемещения)
+    ACTION_ERROR = 'error'
+    # файл был обработан в прерванном запуске
+    ACTION_RESUMED = 'resumed'
+
+    class Skipped(Exception):
+        """Файл пропущен.
+        kw      - None или ключевое слово для журнала (PMVLogger.KW_xxx;
+                  None - сообщение об ошибке);
+        warning - True, если это не ошибка, а предупреждение."""
+
+        def __init__(self, msg, kw=None, warning=False):
+            super().__init__(msg)
+
+            self.kw = kw
+            self.warning = warning
+
+    class Fatal(Exception):
+        pass
+
+    class FilePlan():
+        """Всё, что известно об обрабатываемом файле."""
+
+        __slots__ = 'ix', 'srcDir', 'fileName', 'srcPathName', 'timestamp', \
+            'resumeDestPathName', 'newSubDir', 'destPath', 'newFileName', 'newFileExt', \
+            'destPathName', 'extraDestPathNames', 'destReserved', 'fileSize', 'model', 'fileDate', 'digest', \
+            'sidecars', 'sidecarDests', 'sidecarsDone', \
+            'tMetadata', 'tPlace', 'tTransfer'
+
+        def __init__(self, ix, srcDir, fileName, sidecars=()):
+            self.ix = ix
+            self.srcDir = srcDir
+            self.fileName = fileName
+            self.srcPathName = os.path.join(srcDir, fileName)
+
+            # имена сопроводительных файлов (в каталоге srcDir)
+            self.sidecars = sidecars
+
+            # метка времени для нескольких сообщений при файловых
+            # операциях должна быть одинаковой
+            self.timestamp = datetime.datetime.now()
+
+            # файл назначения, обработка которого была начата
+            # в прерванном запуске, или None
+            self.resumeDestPathName = None
+
+            # подкаталог относительно каталога назначения
+            self.newSubDir = None
+            self.destPath = None
+            self.newFileName = None
+            self.newFileExt = None
+            self.destPathName = None
+            # полные пути к копиям файла в дополнительных каталогах
+            # назначения (см. Environment.destinationDirs)
+            self.extraDestPathNames = []
+            self.destReserved = False
+
+            self.fileSize = 0
+
+            # модель камеры и дата файла ('ГГГГ-ММ-ДД') - для журнала,
+            # если уже были загружены (вычислены)
+            self.model = None
+            self.fileDate = None
+
+            # контрольная сумма ("алгоритм:сумма") или None
+            self.digest = None
+
+            # для сопроводительных файлов - список кортежей вида
+            # ('исходный файл', [файлы назначения]), и список таких же
+            # кортежей, дополненных контрольной суммой, для уже
+            # скопированных (перемещённых) файлов
+            self.sidecarDests = []
+            self.sidecarsDone = []
+
+            self.tMetadata = 0.0
+            self.tPlace = 0.0
+            self.tTransfer = 0.0
+
+        def get_timings(self):
+            return FileTimings(self.tMetadata, self.tPlace, self.tTransfer)
+
+    def __init__(self, env, ui=None):
+        """env  - экземпляр pmvconfig.Environment;
+        ui      - экземпляр JobUI (или None)."""
+
+        self.env = env
+        self.ui = ui if ui is not None else JobUI()
+
+        # с этим списком (очередью) работает 2й проход;
+        # содержит он кортежи вида ('каталог', 'имя файла') или
+        # ('каталог', 'имя файла', (сопроводительные файлы));
+        # да, оно память жрёть, а шо таки делать?
+        # а кто натравит photomv на гигантскую файлопомойку -
+        # сам себе злой буратино
+        self.workqueue = []
+
+        self.statTotalFiles = 0
+        self.statProcessedFiles = 0
+        self.statSkippedFiles = 0
+        self.statBytes = 0
+
+        # время начала обработки (time.monotonic())
+        self.startTime = None
+
+        # сообщения для пользователя по завершении обработки (см. run);
+        # пустой список - если обработка прервана из-за ошибки
+        self.messages = None
+
+        # параметры запуска, которые должны совпадать при продолжении
+        # прерванного запуска
+        self.checkpointParams = {'move':env.modeMoveFiles, 'dest':env.destinationDirs}
+
+        self.prefetcher = None
+        self.mdworkers = None
+        # MetadataWorkerPool потокобезопасностью не отличается
+        self.mdworkersLock = threading.Lock()
+
+        self.burstCache = None
+
+        # True, если env.scanIndex открыт в prepare
+        self.scanIndexOpened = False
+
+        # результаты завершения перемещений, прерванных после записи
+        # файлов назначения (см. plan_file и resumed_file)
+        # ключи - индексы элементов очереди
+        self.resumedMoves = {}
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(statTotalFiles=%d, statProcessedFiles=%d, statSkippedFiles=%d)' % (
+            self.__class__.__name__,
+            self.statTotalFiles, self.statProcessedFiles, self.statSkippedFiles)
+
+    def error(self, timestamp, emsg):
+        """Сообщение об ошибке - и в журнал, и пользователю."""
+
+        self.env.logger.write_error(timestamp, emsg)
+        self.ui.error(emsg)
+
+    def prepare(self):
+        """1й проход - поиск файлов (или загрузка очереди из контрольной
+        точки) и проверка каталога назначения.
+
+        Индекс содержимого каталогов-источников (env.scanIndex), если
+        он не открыт вызывающим, открывается здесь, а закрывается
+        методом close - или здесь же, если к обработке файлов
+        приступать нельзя.
+
+        Возвращает None, если можно приступать к обработке файлов,
+        иначе - список строк с сообщениями для пользователя
+        (возможно, пустой - если об ошибке уже сообщено)."""
+
+        env = self.env
+
+        if env.scanIndex is not None and env.scanIndex.db is None:
+            env.scanIndex.open()
+            self.scanIndexOpened = True
+
+        try:
+            msgs = self.__prepare()
+        except BaseException:
+            self.__close_scan_index()
+            raise
+
+        if msgs is not None:
+            self.__close_scan_index()
+
+        return msgs
+
+    def __close_scan_index(self):
+        if self.scanIndexOpened:
+            self.env.scanIndex.close()
+            self.scanIndexOpened = False
+
+    def __prepare(self):
+        env = self.env
+
+        self.startTime = time.monotonic()
+
+        env.logger.write_msg(None, 'подготовка')
+
+        if env.resumeRun:
+            # продолжение прерванного запуска - очередь берём из контрольной
+            # точки, каталоги заново не сканируем
+            try:
+                cpParams, self.workqueue = env.checkpoint.load()
+            except env.checkpoint.Error as ex:
+                self.error(None, str(ex))
+                return []
+
+            if cpParams != self.checkpointParams:
+                self.error(None, 'прерванный запуск был в другом режиме или с другим каталогом назначения')
+                return []
+        else:
+            self.ui.progress(0.0, 'Поиск файлов...')
+
+            # каталоги, не изменившиеся с прошлого раза, сканер берёт из индекса
+            scanner = SourceScanner(env.knownFileTypes, env.excludeDirs, env.maxScanDepth, env.oneFileSystem,
+                env.scanIndex)
+
+            for srcdir in env.sourceDirs:
+                if srcdir.ignore:
+                    continue
+
+                srcdir = srcdir.path
+
+                if not os.path.exists(srcdir) or not os.path.isdir(srcdir):
+                    self.error(None, 'путь "%s" не существует или указывает не на каталог' % srcdir)
+                else:
+                    # "скрытые" и исключённые каталоги, а также файлы
+                    # неизвестных типов сканер отсеивает сам
+                    for srcroot, files in scanner.scan(srcdir):
+                        # сопроводительные файлы (если есть) сканер уже
+                        # привязал к основным
+                        for fentry in files:
+                            self.workqueue.append((srcroot, fentry[0]) + fentry[2:])
+
+        self.statTotalFiles = len(self.workqueue)
+
+        if self.statTotalFiles == 0:
+            return ['не с чем работать - нет файлов']
+
+        #
+        # проход 1.5 - проверка каталога назначения
+        # можно было проверить до прохода 1, но с другой стороны -
+        # какая нам разница, есть ли каталог назначения, если кидать туда
+        # нечего?
+        # а вот ща уже есть разница...
+        #
+
+        if not env.destinationDirs:
+            self.error(None, 'Каталог назначения не указан')
+            return []
+
+        if env.check_dest_is_same_with_src_dir():
+            self.error(None, 'Каталог назначения совпадает с одним из исходных каталогов')
+            return []
+
+        # если каталога назначения нет - пытаемся создать.
+        # если не удаётся - тогда уже лаемся
+
+        for destdir in env.destinationDirs:
+            if not os.path.exists(destdir):
+                emsg = make_dirs(destdir, None)
+                if emsg:
+                    env.logger.write(None, env.logger.KW_MKDIR, False, emsg, '')
+                    self.ui.error(emsg)
+                    return []
+
+        if not env.resumeRun:
+            if env.checkpoint.exists():
+                self.ui.warning('данные прерванного запуска будут потеряны (для продолжения используйте ключ --resume)')
+
+            env.checkpoint.create(self.checkpointParams, self.workqueue)
+
+        return None
+
+    def open(self):
+        """Подготовка ко 2му проходу."""
+
+        env = self.env
+
+        # до запуска потоков и процессов - они наследуют приоритет
+        if env.idleIOPriority and not set_idle_io_priority():
+            self.ui.warning('не удалось понизить приоритет ввода-вывода (параметр io-priority)')
+
+        # пока обрабатывается текущий файл, заголовки следующих
+        # уже читаются в кэш ОС
+        self.prefetcher = HeaderPrefetcher(env.readAheadFiles)
+
+        # EXIF (если он вообще нужен) читается в отдельных процессах,
+        # чтобы повреждённые файлы не роняли и не вешали всю программу
+        if env.metadataWorkers and env.metadata_needs_exif():
+            self.mdworkers = MetadataWorkerPool(env.knownFileTypes,
+                env.metadataWorkers, env.metadataTimeout, env.metadataWorkerRecycle)
+
+        # в рабочих процессах EXIF разбирается заранее, там от кэша
+        # серий толку нет
+        if env.useBurstCache and self.mdworkers is None and env.metadata_needs_exif():
+            self.burstCache = BurstCache()
+
+    def close(self, completed):
+        """Завершение 2го прохода.
+        completed   - True, если очередь обработана полностью."""
+
+        env = self.env
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+        if self.mdworkers is not None:
+            self.mdworkers.close()
+            self.mdworkers = None
+
+        self.burstCache = None
+
+        # остатки последней пачки
+        self.report_sync(None, env.transfer.sync(True))
+
+        env.checkpoint.close(completed)
+
+        self.__close_scan_index()
+
+    def get_stats(self):
+        """Возвращает итоги обработки - экземпляр JobStats."""
+
+        return JobStats(self.statTotalFiles,
+            self.statProcessedFiles,
+            self.statSkippedFiles,
+            self.statBytes,
+            time.monotonic() - self.startTime if self.startTime is not None else 0.0)
+
+    def stats_text(self):
+        """Возвращает кортеж строк с итогами обработки."""
+
+        return ('Всего файлов: %d\n%s: %d\nпропущено: %d' % (self.statTotalFiles,
+            self.env.modeMessages.statmsg, self.statProcessedFiles,
+            self.statSkippedFiles),)
+
+    def pending_indexes(self):
+        """Генератор; выдаёт индексы ещё не обработанных элементов
+        очереди (в т.ч. обработанные в прерванном запуске пропускаются),
+        попутно сообщая о смене каталога и запрашивая упреждающее
+        чтение."""
+
+        lastSrcDir = None
+
+        for ix, qitem in enumerate(self.workqueue):
+            srcdir = qitem[0]
+
+            if ix in self.env.checkpoint.done:
+                # обработан в прерванном запуске
+                continue
+
+            if srcdir != lastSrcDir:
+                if self.env.showSrcDir:
+                    self.ui.show_dir(srcdir)
+
+                lastSrcDir = srcdir
+
+            self.prefetcher.advance(self.workqueue, ix)
+
+            yield ix
+
+    def __mdworkers_skip(self, ix):
+        # элементы, уже обработанные в прерванном запуске,
+        # и файлы, метаданные которых есть в индексе
+        return ix in self.env.checkpoint.done \
+            or (self.env.scanIndex is not None and self.env.scanIndex.get_metadata(*self.workqueue[ix][:2]))
+
+    def plan_file(self, ix):
+        """Извлечение метаданных и создание нового имени для элемента ix
+        очереди.
+
+        Возвращает экземпляр FilePlan, или None, если файл был обработан
+        в прерванном запуске (но отметка об этом в контрольную точку
+        не попала).
+        Если файл обрабатывать не надо - генерирует исключение Skipped."""
+
+        env = self.env
+
+        t0 = time.monotonic()
+
+        plan = self.FilePlan(ix, *self.workqueue[ix])
+
+        # файл, обработка которого была начата в прерванном запуске
+        plan.resumeDestPathName = env.checkpoint.pending.get(ix)
+
+        if plan.resumeDestPathName and os.path.exists(plan.resumeDestPathName) \
+            and (env.ifFileExists != env.FEXIST_OVERWRITE or not os.path.exists(plan.srcPathName)):
+            # ...и успела завершиться, но не записаться в контрольную точку
+            # (файлы пишутся через временные, так что недописанный
+            # файл под окончательным именем появиться не может)
+            if env.modeMoveFiles:
+                self.resumedMoves[ix] = self.__finish_resumed_move(plan)
+
+            return None
+
+        # файл открывается один раз - и для stat, и для заголовка
+        # серии снимков (см. pmvfileio.SourceFile)
+        try:
+            source = SourceFile(plan.srcPathName)
+        except OSError as ex:
+            # ENXIO - сокеты и устройства без драйвера, их открыть нельзя
+            if ex.errno != errno.ENXIO:
+                raise self.Skipped('не удалось открыть файл "%s" - %s' % (plan.srcPathName,
+                    ex.strerror if ex.strerror else str(ex)))
+
+            source = None
+
+        if source is None or not source.is_file():
+            if source is not None:
+                source.close()
+
+            # всякие там символические ссылки пока нафиг
+            raise self.Skipped('"%s" - не файл' % plan.srcPathName, env.logger.KW_MSG, True)
+
+        metadata = FileMetadata(plan.srcPathName, env.knownFileTypes, source)
+
+        # метаданные извлекаются лениво - только те, что нужны
+        # шаблону, потому ошибки их извлечения могут вылететь
+        # и при выборе шаблона, и при создании нового имени
+        try:
+            mdrec = env.scanIndex.get_metadata(plan.srcDir, plan.fileName) if env.scanIndex is not None else None
+
+            if not mdrec and self.mdworkers is not None:
+                with self.mdworkersLock:
+                    self.mdworkers.advance(self.workqueue, ix, self.__mdworkers_skip)
+                    mdrec = self.mdworkers.get(ix)
+
+            if mdrec:
+                metadata.set_record(mdrec)
+
+            #
+            # выясняем, каким шаблоном создавать новое имя файла
+            #
+
+            fntemplate = None
+            burstLearn = False
+
+            if not mdrec and self.burstCache is not None:
+                # очередной файл серии - EXIF не разбираем
+                fntemplate = self.burstCache.lookup(plan.srcDir, metadata)
+                burstLearn = fntemplate is None
+
+            if fntemplate is None:
+                fntemplate = env.get_template_from_metadata(metadata)
+
+            plan.newSubDir, plan.newFileName, plan.newFileExt = fntemplate.get_new_file_name(env, metadata)
+
+            if burstLearn:
+                # EXIF к этому моменту разобран - файл становится
+                # образцом для следующих файлов серии
+                self.burstCache.learn(plan.srcDir, metadata, fntemplate)
+
+            plan.fileSize = metadata.fileSize
+
+            # EXIF ради журнала не загружаем
+            exif = metadata.get_exif()
+            if exif is not None:
+                plan.model = exif[0]
+
+            ts = metadata.get_timestamp()
+            if ts is not None:
+                plan.fileDate = time.strftime('%Y-%m-%d', time.gmtime(ts))
+
+            if env.scanIndex is not None:
+                env.scanIndex.set_metadata(plan.srcDir, plan.fileName, metadata.get_record())
+        except Exception as ex:
+            # с кривыми файлами ничего не делаем
+            raise self.Skipped('не удалось получить метаданные файла "%s" - %s' % (plan.fileName, str(ex)))
+        finally:
+            metadata.source = None
+            source.close()
+
+        plan.destPath = os.path.join(env.destinationDir, plan.newSubDir)
+
+        plan.tMetadata = time.monotonic() - t0
+
+        return plan
+
+    def __finish_resumed_move(self, plan):
+        """Удаление исходных файлов элемента очереди, перемещение
+        которого прервалось после записи файлов назначения (см.
+        plan_file). Исходный файл удаляется, только если все его копии
+        на месте, совпадают с ним по размеру и сброшены на диск.
+
+        Возвращает список кортежей ('исходный файл', [файлы назначения],
+        сообщение об ошибке или None) для оставшихся исходных файлов."""
+
+        env = self.env
+
+        newSubPathName = os.path.relpath(plan.resumeDestPathName, env.destinationDir)
+        newSubDir = os.path.dirname(newSubPathName)
+        newFileName, plan.newFileExt = os.path.splitext(os.path.basename(newSubPathName))
+
+        def dest_names(fname):
+            return [os.path.join(root, newSubDir, fname) for root in env.destinationDirs]
+
+        files = [(os.path.join(plan.srcDir, sidecar), dest_names(newFileName + self.__sidecar_suffix(plan, sidecar)))
+            for sidecar in plan.sidecars]
+        files.append((plan.srcPathName, dest_names(newFileName + plan.newFileExt)))
+
+        r = []
+
+        for src, dsts in files:
+            if not os.path.exists(src):
+                continue
+
+            try:
+                srcSize = os.stat(src).st_size
+
+                for dst in dsts:
+                    if os.stat(dst).st_size != srcSize:
+                        raise OSError('размер файла "%s" не совпадает с исходным' % dst)
+
+                    fd = os.open(dst, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+
+                os.remove(src)
+                emsg = None
+            except OSError as ex:
+                emsg = 'не удалось завершить перемещение файла "%s" - %s' % (src,
+                    ex.strerror if ex.strerror else str(ex))
+
+            r.append((src, dsts, emsg))
+
+        return r
+
+    def place_file(self, plan):
+        """Создание каталога назначения и резервирование имени файла
+        назначения для plan (экземпляра FilePlan).
+        Проверка существования файла и резервирование имени делаются
+        через кэш каталогов назначения, без обращений к ФС.
+
+        Если файл обрабатывать не надо - генерирует исключение Skipped,
+        если каталог не удалось создать - Fatal (его следует передать
+        методу report_fatal).
+
+        При нескольких каталогах назначения имя файла во всех
+        них одинаково: занятое хотя бы в одном из каталогов имя
+        считается занятым. То же - для сопроводительных файлов:
+        они получают новое имя основного файла (с их собственными
+        расширениями), и имя подбирается так, чтобы было свободно
+        для всех."""
+
+        env = self.env
+
+        t0 = time.monotonic()
+
+        destPaths = [plan.destPath] + [os.path.join(root, plan.newSubDir) for root in env.destinationDirs[1:]]
+
+        self.__make_dirs(destPaths)
+
+        # новое имя (без расширения) и расширение основного файла
+        newFileName = plan.newFileName
+        newFileExt = plan.newFileExt
+
+        def dest_names(fname):
+            return self.__dest_names(plan, fname, newFileExt)
+
+        # корзина (см. DestinationDirCache), в которую попадут файлы
+        shard = ''
+
+        if plan.resumeDestPathName:
+            # файл, не дописанный в прерванном запуске,
+            # пишем под тем же именем (и в ту же корзину),
+            # иначе будут дубликаты
+            newSubPathName = os.path.relpath(plan.resumeDestPathName, env.destinationDir)
+            destPaths = [os.path.dirname(os.path.join(root, newSubPathName)) for root in env.destinationDirs]
+            newFileName, newFileExt = os.path.splitext(os.path.basename(newSubPathName))
+
+            shard = env.destDirs.split_shard(destPaths[0])[1]
+            if shard:
+                destPaths = [os.path.dirname(destPath) for destPath in destPaths]
+
+            plan.destReserved = self.__reserve_names(destPaths, dest_names(newFileName), shard) is not None
+        else:
+            shard = self.__reserve_names(destPaths, dest_names(newFileName))
+            plan.destReserved = shard is not None
+
+        if not plan.destReserved and not plan.resumeDestPathName:
+            if env.ifFileExists == env.FEXIST_SKIP:
+                # существующий файл может лежать в корзине
+                plan.destPathName = self.__find_existing(destPaths, dest_names(newFileName))
+
+                raise self.Skipped('файл "%s" уже существует, пропускаю' % plan.destPathName,
+                    env.logger.KW_MSG, True)
+            elif env.ifFileExists == env.FEXIST_RENAME:
+                newFileName, shard = self.__reserve_renamed(plan, destPaths)
+                plan.destReserved = True
+            else:
+                # env.FEXIST_OVERWRITE - перезаписываем там, где лежит
+                # существующий файл
+                foundPath = env.destDirs.find(destPaths[0], newFileName + newFileExt)
+                shard = os.path.basename(foundPath) if foundPath and foundPath != destPaths[0] else ''
+
+        self.__set_dest_names(plan, destPaths, shard, newFileName, newFileExt)
+
+        plan.tPlace = time.monotonic() - t0
+
+    def __find_existing(self, destPaths, fnames):
+        """Возвращает полный путь к первому из файлов с именами fnames,
+        занятыми в каталогах destPaths (или в их корзинах)."""
+
+        destDirs = self.env.destDirs
+
+        for destPath in destPaths:
+            for fname in fnames:
+                foundPath = destDirs.find(destPath, fname)
+                if foundPath is not None:
+                    return os.path.join(foundPath, fname)
+
+        # имя успели освободить - путь без корзины
+        return os.path.join(destPaths[0], fnames[0])
+
+    def __dest_names(self, plan, fname, newFileExt):
+        """Возвращает список новых имён основного (первое)
+        и сопроводительных файлов plan; fname - новое имя без
+        расширения."""
+
+        return [fname + newFileExt] + [fname + self.__sidecar_suffix(plan, sidecar) for sidecar in plan.sidecars]
+
+    def __reserve_renamed(self, plan, destPaths):
+        """Подбор и резервирование незанятого имени вида "имя-N" для
+        файлов plan во всех каталогах destPaths (if-exists=rename).
+        Возвращает кортеж из двух элементов - новое имя без расширения
+        и имя корзины (см. __reserve_names).
+        Если имя подобрать не удалось - генерирует исключение Skipped."""
+
+        # нефиг больше 10 повторов... и 10-то много
+        for unum in range(1, 11):
+            unumFileName = '%s-%d' % (plan.newFileName, unum)
+
+            shard = self.__reserve_names(destPaths, self.__dest_names(plan, unumFileName, plan.newFileExt))
+
+            if shard is not None:
+                return (unumFileName, shard)
+
+        raise self.Skipped('в каталоге "%s" слишком много файлов с именем %s*%s' % (plan.destPath, plan.newFileName, plan.newFileExt),
+            self.env.logger.KW_MSG)
+
+    def __set_dest_names(self, plan, destPaths, shard, newFileName, newFileExt):
+        """Заполнение полных путей к файлам назначения plan."""
+
+        if shard:
+            destPaths = [os.path.join(destPath, shard) for destPath in destPaths]
+            self.__make_dirs(destPaths)
+
+        newFileNameExt = newFileName + newFileExt
+
+        plan.destPathName = os.path.join(destPaths[0], newFileNameExt)
+        plan.extraDestPathNames = [os.path.join(destPath, newFileNameExt) for destPath in destPaths[1:]]
+
+        plan.sidecarDests = [(os.path.join(plan.srcDir, sidecar),
+                [os.path.join(destPath, newFileName + self.__sidecar_suffix(plan, sidecar)) for destPath in destPaths])
+            for sidecar in plan.sidecars]
+
+    @staticmethod
+    def __sidecar_suffix(plan, sidecar):
+        """Возвращает окончание нового имени сопроводительного файла
+        sidecar (добавляется к новому имени основного файла без
+        расширения)."""
+
+        ext = os.path.splitext(sidecar)[1].lower()
+
+        # "имя.ext основного.xmp" или "имя.xmp"
+        return plan.newFileExt + ext if sidecar[:-len(ext)] == plan.fileName else ext
+
+    def __make_dirs(self, destPaths):
+        for destPath in destPaths:
+            emsg = self.env.destDirs.make_dirs(destPath)
+            if emsg:
+                raise self.Fatal(emsg)
+
+    def __reserve_names(self, destPaths, fnames, shard=None):
+        """Резервирование имён fnames во всех каталогах destPaths.
+        Все имена попадают в одну и ту же корзину (см.
+        DestinationDirCache) всех каталогов: shard - её имя, или None,
+        если её следует выбрать при резервировании первого имени.
+
+        Возвращает имя корзины ('' - без корзины).
+        Если хотя бы одно из имён хотя бы в одном из каталогов занято -
+        снимает уже сделанные резервирования и возвращает None."""
+
+        destDirs = self.env.destDirs
+
+        reserved = []
+
+        for destPath in destPaths:
+            for fname in fnames:
+                rpath = destDirs.reserve(destPath, fname, shard)
+
+                if rpath is None:
+                    for rpath, rname in reserved:
+                        destDirs.release(rpath, rname)
+
+                    return None
+
+                if shard is None:
+                    shard = os.path.basename(rpath) if rpath != destPath else ''
+
+                reserved.append((rpath, fname))
+
+        return shard
+
+    def __release_names(self, plan):
+        destPathNames = [plan.destPathName] + plan.extraDestPathNames
+
+        for sidecarSrc, sidecarDsts in plan.sidecarDests:
+            destPathNames += sidecarDsts
+
+        for destPathName in destPathNames:
+            self.env.destDirs.release(*os.path.split(destPathName))
+
+    def report_fatal(self, timestamp, ex):
+        """Запись в журнал неустранимой ошибки; ex - исключение Fatal."""
+
+        emsg = str(ex)
+
+        self.env.logger.write(timestamp, self.env.logger.KW_MKDIR, False, emsg, '')
+        self.ui.error(emsg)
+
+    def begin_file(self, plan):
+        """Отметка в контрольной точке о начале копирования (перемещения)."""
+
+        self.ui.progress(float(plan.ix + 1) / self.statTotalFiles,
+            '%s -> %s' % (plan.fileName, os.path.split(plan.destPathName)[1]))
+
+        self.env.checkpoint.begin(plan.ix, plan.srcPathName, plan.destPathName)
+
+    def transfer_file(self, plan):
+        """Копирование (перемещение) файла.
+        Возвращает None в случае успеха, иначе - сообщение об ошибке.
+
+        Если имя файла назначения между его резервированием и записью
+        занял другой процесс - поступает в соответствии с параметром
+        if-exists (см. __name_taken): записывает файлы под другим
+        именем или генерирует исключение Skipped."""
+
+        env = self.env
+
+        t0 = time.monotonic()
+
+        overwrite = env.ifFileExists == env.FEXIST_OVERWRITE
+
+        try:
+            while True:
+                try:
+                    # сопроводительные файлы - перед основным: если основной
+                    # файл уже есть в каталоге назначения, то есть и они
+                    # (см. plan_file); все они попадают в одну пачку
+                    # (см. sync_transfers)
+                    sidecarsDone = set(sidecarSrc for sidecarSrc, sidecarDsts, digest in plan.sidecarsDone)
+
+                    for sidecarSrc, sidecarDsts in plan.sidecarDests:
+                        if sidecarSrc in sidecarsDone:
+                            # записан до того, как пришлось сменить имя
+                            continue
+
+                        if plan.resumeDestPathName and os.path.exists(sidecarDsts[0]) \
+                            and (not overwrite or not os.path.exists(sidecarSrc)):
+                            # записан в прерванном запуске
+                            continue
+
+                        plan.sidecarsDone.append((sidecarSrc, sidecarDsts,
+                            self.__transfer(sidecarSrc, sidecarDsts, overwrite)))
+
+                    plan.digest = self.__transfer(plan.srcPathName, [plan.destPathName] + plan.extraDestPathNames, overwrite)
+                    break
+                except FileExistsError:
+                    if overwrite:
+                        raise
+
+                    self.__name_taken(plan)
+        except (IOError, os.error) as emsg:
+            if plan.destReserved:
+                self.__release_names(plan)
+
+            return 'не удалось %s файл - %s' % (env.modeMessages.errmsg, repr(emsg))
+        finally:
+            plan.tTransfer = time.monotonic() - t0
+
+        return None
+
+    def __name_taken(self, plan):
+        """Обработка гонки с другим процессом: одно из имён файлов
+        назначения plan оказалось занято при записи (файлы, запись
+        которых не удалась, FileTransfer уже удалил).
+
+        При if-exists=rename подбирает для plan новое имя, переименовывает
+        уже записанные сопроводительные файлы и отмечает новое имя
+        в контрольной точке; при if-exists=skip удаляет записанные
+        сопроводительные файлы (при перемещении - возвращает их на место)
+        и генерирует исключение Skipped."""
+
+        env = self.env
+
+        # занятые на диске имена - в кэш каталогов назначения;
+        # зарезервированные plan имена не освобождаются - часть из них
+        # занята уже записанными файлами, а остальные освободятся
+        # при следующем запуске
+        written = set()
+        for sidecarSrc, sidecarDsts, digest in plan.sidecarsDone:
+            written.update(sidecarDsts)
+
+        destPathNames = [plan.destPathName] + plan.extraDestPathNames
+        for sidecarSrc, sidecarDsts in plan.sidecarDests:
+            destPathNames += sidecarDsts
+
+        for destPathName in destPathNames:
+            if destPathName not in written and os.path.lexists(destPathName):
+                env.destDirs.mark_existing(*os.path.split(destPathName))
+
+        if env.ifFileExists == env.FEXIST_RENAME:
+            destPaths = [os.path.join(root, plan.newSubDir) for root in env.destinationDirs]
+
+            newFileName, shard = self.__reserve_renamed(plan, destPaths)
+
+            self.__set_dest_names(plan, destPaths, shard, newFileName, plan.newFileExt)
+
+            newSidecarDests = dict(plan.sidecarDests)
+            sidecarsDone = []
+
+            for sidecarSrc, sidecarDsts, digest in plan.sidecarsDone:
+                newDsts = newSidecarDests[sidecarSrc]
+
+                for dst, newDst in zip(sidecarDsts, newDsts):
+                    try:
+                        rename_noreplace(dst, newDst)
+                    except OSError as ex:
+                        # без errno - чтобы не оказаться снова FileExistsError
+                        raise OSError('не удалось переименовать "%s" в "%s" - %s' % (dst, newDst, ex))
+
+                sidecarsDone.append((sidecarSrc, newDsts, digest))
+
+            plan.sidecarsDone = sidecarsDone
+
+            env.checkpoint.begin(plan.ix, plan.srcPathName, plan.destPathName)
+            return
+
+        # env.FEXIST_SKIP
+        for sidecarSrc, sidecarDsts, digest in plan.sidecarsDone:
+            if env.modeMoveFiles:
+                env.transfer.undo_move(sidecarSrc, sidecarDsts[0])
+                sidecarDsts = sidecarDsts[1:]
+
+            for dst in sidecarDsts:
+                os.remove(dst)
+
+        plan.sidecarsDone = []
+
+        env.checkpoint.cancel(plan.ix)
+
+        raise self.Skipped('файл "%s" уже существует, пропускаю' % os.path.basename(plan.destPathName),
+            env.logger.KW_MSG, True)
+
+    def __transfer(self, src, dsts, overwrite):
+        """Копирование (перемещение) файла src в файлы dsts.
+        Возвращает контрольную сумму ("алгоритм:сумма") или None."""
+
+        env = self.env
+
+        if len(dsts) > 1:
+            # исходный файл читается один раз на все каталоги назначения
+            digest = env.modeFileOpMulti(src, dsts, overwrite)
+        else:
+            digest = env.modeFileOp(src, dsts[0], overwrite)
+
+        return '%s:%s' % (env.transfer.HASH_ALGORITHM, digest) if digest is not None else None
+
+    def __log_transfer(self, timestamp, result, src, dsts, digest, plan=None):
+        """Запись в журнал сообщений о копировании (перемещении) src
+        в dsts; для основного файла указывается plan (размер, время
+        копирования, модель камеры и дата файла попадают в журнал -
+        только в строку для первого каталога назначения, иначе сводка
+        по журналу посчитает копии отдельными файлами)."""
+
+        logger = self.env.logger
+
+        extra = () if plan is None else (plan.fileSize, '%.3f' % plan.tTransfer,
+            plan.model if plan.model else '', plan.fileDate if plan.fileDate else '')
+
+        for dst in dsts:
+            logger.write(timestamp,
+                logger.KW_MV if self.env.modeMoveFiles else logger.KW_CP,
+                result, src, dst, *extra)
+
+            extra = ()
+
+            if digest and result:
+                logger.write(timestamp, logger.KW_DIGEST, True, dst, digest)
+
+    def end_file(self, plan, emsg):
+        """Запись в журнал результата копирования (перемещения);
+        emsg - значение, полученное от transfer_file."""
+
+        env = self.env
+
+        if emsg:
+            self.statSkippedFiles += 1
+            self.error(plan.timestamp, emsg)
+            action = self.ACTION_ERROR
+        else:
+            self.statProcessedFiles += 1
+            self.statBytes += plan.fileSize
+            action = self.ACTION_MOVE if env.modeMoveFiles else self.ACTION_COPY
+
+        # сопроводительные файлы, скопированные (перемещённые) до основного
+        for sidecarSrc, sidecarDsts, digest in plan.sidecarsDone:
+            self.__log_transfer(plan.timestamp, True, sidecarSrc, sidecarDsts, digest)
+
+        self.__log_transfer(plan.timestamp, not emsg, plan.srcPathName,
+            [plan.destPathName] + plan.extraDestPathNames, plan.digest, plan)
+
+        return FileResult(plan.srcPathName, plan.destPathName, action,
+            plan.fileSize, plan.get_timings(), emsg, plan.digest,
+            tuple(sidecarDsts[0] for sidecarSrc, sidecarDsts, digest in plan.sidecarsDone))
+
+    def resumed_file(self, ix):
+        """Учёт файла (элемента ix очереди), обработанного в прерванном
+        запуске (см. plan_file)."""
+
+        self.statProcessedFiles += 1
+
+        # в режиме перемещения - удалённые в plan_file исходные файлы
+        for src, dsts, emsg in self.resumedMoves.pop(ix, ()):
+            if emsg:
+                self.error(None, emsg)
+            else:
+                self.__log_transfer(None, True, src, dsts, None)
+
+        return FileResult(os.path.join(*self.workqueue[ix][:2]),
+            self.env.checkpoint.pending.get(ix), self.ACTION_RESUMED,
+            0, None, None)
+
+    def skip_file(self, ix, ex, plan=None):
+        """Запись в журнал сообщения о пропуске файла (элемента ix
+        очереди); ex - исключение Skipped; plan - экземпляр FilePlan
+        (если исключение сгенерировал place_file)."""
+
+        self.statSkippedFiles += 1
+
+        emsg = str(ex)
+
+        timestamp = plan.timestamp if plan is not None else datetime.datetime.now()
+
+        if ex.kw is None:
+            self.env.logger.write_error(timestamp, emsg)
+        else:
+            self.env.logger.write(timestamp, ex.kw, True, emsg, '')
+
+        if ex.warning:
+            self.ui.warning(emsg)
+        else:
+            self.ui.error(emsg)
+
+        if plan is None:
+            return FileResult(os.path.join(*self.workqueue[ix][:2]), None, self.ACTION_SKIP, 0, None, emsg)
+
+        return FileResult(plan.srcPathName, plan.destPathName, self.ACTION_SKIP,
+            plan.fileSize, plan.get_timings(), emsg)
+
+    def sync_transfers(self):
+        """Для durability=batch - сброс на диск очередной пачки
+        файлов и удаление соответствующих исходных файлов.
+        Возвращает список сообщений об ошибках для report_sync."""
+
+        return self.env.transfer.sync()
+
+    def report_sync(self, timestamp, errors):
+        """Запись в журнал ошибок, полученных от sync_transfers;
+        сброс на диск записей контрольной точки."""
+
+        for emsg in errors:
+            self.error(timestamp, emsg)
+
+        # записи контрольной точки сбрасываются на диск
+        # только после того, как на диске оказались сами файлы
+        if self.env.transfer.nUnsynced == 0:
+            self.env.checkpoint.sync()
+
+    def finish_file(self, ix):
+        """Отметка в контрольной точке о завершении обработки элемента
+        ix очереди (с любым результатом)."""
+
+        self.env.checkpoint.finish(ix)
+
+    def run(self):
+        """Синхронная обработка файлов.
+
+        Генератор; для каждого обработанного элемента очереди выдаёт
+        экземпляр FileResult. По завершении в поле messages - сообщения
+        для пользователя (пустой список, если обработка прервана из-за
+        ошибки), итоги возвращает метод get_stats.
+        Возвращает (как значение StopIteration) итоги - экземпляр JobStats."""
+
+        #
+        # 1й проход - подсчет общего количества файлов для индикации прогресса
+        # во втором проходе
+        #
+        msgs = self.prepare()
+        if msgs is not None:
+            self.messages = msgs
+            return self.get_stats()
+
+        # True, если очередь обработана полностью
+        completed = False
+
+        try:
+            #
+            # 2й проход - собственно обработка файлов
+            #
+            self.open()
+
+            for ix in self.pending_indexes():
+                plan = None
+
+                try:
+                    plan = self.plan_file(ix)
+
+                    if plan is None:
+                        result = self.resumed_file(ix)
+                    else:
+                        self.place_file(plan)
+
+                        #
+                        # а вот теперь копируем или перемещаем файл
+                        #
+                        self.begin_file(plan)
+                        result = self.end_file(plan, self.transfer_file(plan))
+
+                        self.report_sync(plan.timestamp, self.sync_transfers())
+                except self.Skipped as ex:
+                    result = self.skip_file(ix, ex, plan)
+                except self.Fatal as ex:
+                    self.report_fatal(plan.timestamp, ex)
+                    self.messages = []
+                    return self.get_stats()
+
+                # обработан (с любым результатом)
+                self.finish_file(ix)
+
+                yield result
+
+            completed = True
+        finally:
+            self.close(completed)
+
+        self.messages = list(self.stats_text())
+
+        return self.get_stats()
@@ -23,9 +23,13 @@ gi_require_version('GExiv2', '0.10')
 from gi.repository import GExiv2, GLib
 
 import os, os.path
+import sys
 import datetime
+import time
+import calendar
 from collections import namedtuple
 import re
+import threading
 
 from pmvcommon import *
 
@@ -53,6 +57,16 @@ class FileTypes():
             '.mp4', '.m4v', '.mkv', '.mts'}
         }
 
+    # "сопроводительные" файлы (sidecars): XMP от редакторов, эскизы
+    # THM и голосовые заметки WAV от камер; сами по себе не обрабатываются,
+    # а перемещаются (копируются) вместе с основными файлами
+    DEFAULT_SIDECAR_EXTENSIONS = {'.xmp', '.thm', '.wav'}
+
+    # если у нескольких основных файлов одинаковые имена (без расширения),
+    # сопроводительный файл вида "имя.xmp" достаётся первому из них
+    # в этом порядке
+    SIDECAR_OWNER_ORDER = {RAW_IMAGE:0, VIDEO:1, IMAGE:2}
+
     def __init__(self):
         self.knownExtensions = dict()
 
@@ -60,6 +74,24 @@ class FileTypes():
         for ftype in self.DEFAULT_FILE_EXTENSIONS:
             self.knownExtensions[ftype] = self.DEFAULT_FILE_EXTENSIONS[ftype].copy()
 
+        self.sidecarExtensions = self.DEFAULT_SIDECAR_EXTENSIONS.copy()
+
+        # плоский словарь для быстрого определения типа файла:
+        # ключи - расширения, значения - FileTypes.xxx
+        self.extMap = dict()
+        self.__update_ext_map()
+
+    def __update_ext_map(self):
+        """Перестроение словаря extMap после изменения knownExtensions."""
+
+        self.extMap.clear()
+
+        # если одно расширение указано для нескольких типов - побеждает
+        # тип, который раньше в knownExtensions (как было и при переборе)
+        for ftype in reversed(tuple(self.knownExtensions)):
+            for ext in self.knownExtensions[ftype]:
+                self.extMap[ext] = ftype
+
     @staticmethod
     def extensions_from_str(s):
         """Преобразование строки вида '.ext .ext' в set, с проверкой
@@ -103,6 +135,13 @@ class FileTypes():
         extensions  - множество строк вида '.расширение'."""
 
         self.knownExtensions[ftype].update(extensions)
+        self.__update_ext_map()
+
+    def add_sidecar_extensions(self, extensions):
+        """Добавление расширений сопроводительных файлов
+        (extensions - множество строк вида '.расширение')."""
+
+        self.sidecarExtensions.update(extensions)
 
     def get_file_type(self, fileext):
         """Определяет по расширению fileext, известен ли программе
@@ -110,17 +149,102 @@ class FileTypes():
         Возвращает значение FileType.IMAGE|RAW|VIDEO, если тип известен,
         иначе возвращает None."""
 
-        for ft in self.knownExtensions:
-            if fileext in self.knownExtensions[ft]:
-                return ft
-
-        # просто так нагляднее
-        return None
+        return self.extMap.get(fileext)
 
     def get_file_type_by_name(self, filename):
-        """Определяет тип файла по имени filename."""
+        """Определяет тип файла по имени filename (без каталога)."""
+
+        extix = filename.rfind('.')
+
+        # точка в начале имени - не расширение (как у os.path.splitext)
+        if extix <= 0:
+            return None
+
+        return self.extMap.get(filename[extix:].lower())
+
+    def filter_known_files(self, entries):
+        """Отбор файлов известных типов из списка файлов каталога
+        (пакетный вариант get_file_type_by_name для сканирования).
+
+        entries - итерируемый объект, содержащий имена файлов (строки)
+                  или экземпляры os.DirEntry (например, результат
+                  os.scandir).
+
+        "Скрытые" (в *nix-образных ОС) файлы отбрасываются.
+
+        Возвращает список кортежей вида (элемент entries, FileTypes.xxx)."""
+
+        extmap = self.extMap
+        r = []
+
+        for entry in entries:
+            name = entry if isinstance(entry, str) else entry.name
+
+            extix = name.rfind('.')
+            # заодно отсеиваются и скрытые файлы (с точкой в начале имени)
+            if extix <= 0 or name[0] == '.':
+                continue
+
+            ftype = extmap.get(name[extix:].lower())
+            if ftype is not None:
+                r.append((entry, ftype))
+
+        return r
+
+    def group_sidecars(self, files, names):
+        """Привязка сопроводительных файлов к основным.
+
+        files   - результат filter_known_files для списка имён файлов
+                  каталога;
+        names   - имена всех файлов того же каталога.
+
+        Сопроводительный файл привязывается к основному, если его имя
+        имеет вид "имя.ext основного.ext" (напр. IMG_0001.CR2.xmp) или
+        "имя.ext" (напр. IMG_0001.xmp) - см. также SIDECAR_OWNER_ORDER.
+
+        Возвращает список того же вида, что и files, но для основных
+        файлов, у которых есть сопроводительные, вместо кортежей
+        ('имя файла', FileTypes.xxx) - кортежи вида ('имя файла',
+        FileTypes.xxx, ('имя сопроводительного файла', ...))."""
+
+        if not self.sidecarExtensions or not files:
+            return files
+
+        # индексы основных файлов в files по полному имени и по имени
+        # без расширения
+        byName = {}
+        byStem = {}
+
+        for ix, (name, ftype) in enumerate(files):
+            byName[name] = ix
+
+            stem = name[:name.rfind('.')]
 
-        return self.get_file_type(os.path.splitext(filename)[1].lower())
+            ownerix = byStem.get(stem)
+            if ownerix is None or self.SIDECAR_OWNER_ORDER[ftype] < self.SIDECAR_OWNER_ORDER[files[ownerix][1]]:
+                byStem[stem] = ix
+
+        # ключи - индексы основных файлов, значения - списки имён
+        sidecars = {}
+
+        for name in names:
+            extix = name.rfind('.')
+            if extix <= 0 or name[0] == '.' or name[extix:].lower() not in self.sidecarExtensions:
+                continue
+
+            base = name[:extix]
+
+            ix = byName.get(base)
+            if ix is None:
+                ix = byStem.get(base)
+
+            if ix is not None:
+                sidecars.setdefault(ix, []).append(name)
+
+        if not sidecars:
+            return files
+
+        return [(name, ftype, tuple(sorted(sidecars[ix]))) if ix in sidecars else (name, ftype) for ix, (name, ftype) in enumerate(files)]
 
     def __repr__(self):
         """Костыль для отладки"""
@@ -132,45 +256,122 @@ class FileTypes():
             )
 
 
+# значение ещё не загруженного поля FileMetadata
+_NOTLOADED = object()
+
+
 class FileMetadata():
     """Метаданные изображения или видеофайла.
 
-    Содержит только поля, поддерживаемые FileNameTemplate."""
+    Содержит только поля, поддерживаемые FileNameTemplate.
 
-    __EXIF_DT_TAGS = ['Exif.Image.OriginalDateTime', 'Exif.Image.DateTime']
+    Т.к. экземпляров класса может быть очень много (сотни тысяч при
+    планировании и сортировке), хранятся они компактно: без __dict__,
+    дата/время - одним целым числом, строки с названиями моделей
+    интернированы, а строки полей даты создаются только по запросу
+    (см. метод get_field).
+
+    Метаданные извлекаются лениво - при первом обращении к
+    соответствующим полям: если шаблону нужны только имя и тип файла,
+    то ни EXIF, ни даже os.stat не понадобятся."""
+
+    __slots__ = 'filePath', 'fileName', 'fileExt', 'fileType', 'source', \
+        '_fileSize', '_mtime', '_model', '_dts', '_prefix', '_number', '_ts', \
+        '_msec', '_utcoffset', '_serial', '_counter'
+
+    # поля, сохраняемые методом get_record (то, что берётся из ФС и EXIF;
+    # префикс/номер из имени файла и разбор даты дёшевы и не сохраняются)
+    __RECORD_SLOTS = ('_fileSize', '_mtime', '_model', '_dts', '_serial', '_counter')
+
+    # тэги с датой - в порядке убывания приоритета; к каждому - тэги
+    # с долями секунды и смещением относительно UTC (вида "+03:00")
+    __EXIF_DT_TAGS = (
+        ('Exif.Photo.DateTimeOriginal', 'Exif.Photo.SubSecTimeOriginal', 'Exif.Photo.OffsetTimeOriginal'),
+        ('Exif.Image.OriginalDateTime', 'Exif.Photo.SubSecTimeOriginal', 'Exif.Photo.OffsetTimeOriginal'),
+        ('Exif.Image.DateTime', 'Exif.Photo.SubSecTime', 'Exif.Photo.OffsetTime'))
     __EXIF_MODEL = 'Exif.Image.Model'
 
-    __N_FIELDS = 10
+    # серийный номер камеры и счётчик снимков - стандартные тэги
+    # и тэги из MakerNote; берётся первый найденный
+    __EXIF_SERIAL_TAGS = ('Exif.Photo.BodySerialNumber',
+        'Exif.Image.CameraSerialNumber',
+        'Exif.Nikon3.SerialNumber',
+        'Exif.Canon.SerialNumber',
+        'Exif.Fujifilm.SerialNumber',
+        'Exif.Olympus.SerialNumber',
+        'Exif.Pentax.SerialNumber')
+
+    __EXIF_COUNTER_TAGS = ('Exif.Nikon3.ShutterCount',
+        'Exif.Pentax.ShutterCount',
+        'Exif.Canon.FileNumber',
+        'Exif.Image.ImageNumber')
+
+    __N_FIELDS = 15
 
     FILETYPE, MODEL, PREFIX, NUMBER, \
-    YEAR, MONTH, DAY, HOUR, MINUTE, SECOND = range(__N_FIELDS)
+    YEAR, MONTH, DAY, HOUR, MINUTE, SECOND, \
+    MSECOND, TZ, UTC, SERIAL, COUNTER = range(__N_FIELDS)
+
+    # поля даты/времени: индекс в кортеже time.struct_time и формат
+    __DATE_FIELDS = {YEAR:(0, '%.4d'),
+        MONTH:(1, '%.2d'),
+        DAY:(2, '%.2d'),
+        HOUR:(3, '%.2d'),
+        MINUTE:(4, '%.2d'),
+        SECOND:(5, '%.2d')}
 
     # выражение для выделения префикса и номера из имени файла
     # может не работать на файлах от некоторых камер - производители
     # с именами изгаляются как могут
     __rxFNameParts = re.compile(r'^(.*?)[-_]?(\d+)?$', re.UNICODE)
 
-    def __init__(self, filename, ftypes):
-        """Извлечение метаданных из файла filename.
+    # смещение относительно UTC: "+03:00"
+    __rxUTCOffset = re.compile(r'^([+-])(\d\d):(\d\d)$')
+
+    def __init__(self, filename, ftypes, source=None):
+        """Подготовка к извлечению метаданных из файла filename.
 
         Параметры:
         filename    - полный путь и имя файла с расширением
         ftype       - экземпляр класса FileTypes
+        source      - None или открытый экземпляр pmvfileio.SourceFile
+                      для этого файла; если указан - stat (и заголовок
+                      для BurstCache) берутся у него, а не открытием файла
+                      заново (после закрытия source полю следует
+                      присвоить None)
 
         Поля:
-        fields      - поля с метаданными (см. константы xxx)
-                      содержат значения в виде строк или None
+        filePath    - полный путь и имя файла
         fileName    - имя файла без расширения
         fileExt     - и расширение
+        fileType    - тип файла (FileTypes.xxx) или None
+        source      - см. параметр source
+
+        Свойства (значения загружаются при первом обращении):
         fileSize    - размер файла в байтах
-        timestamp   - экземпляр datetime.datetime со значениями из EXIF
-                      (если таковые нашлись) или mtime файла
+        mtime       - время последнего изменения файла
+        model       - модель камеры или None
+        serial      - серийный номер камеры или None
+        counter     - счётчик снимков камеры (строка с числом) или None
+        prefix      - префикс из имени файла или None
+        number      - номер из имени файла или None
+        ts          - дата/время из EXIF (если таковые нашлись) или mtime
+                      файла, в виде целого числа секунд от начала эпохи
+                      (без учёта часового пояса, т.е. "как есть")
+        msec        - миллисекунды к ts (из EXIF или mtime) или None
+        utcoffset   - смещение ts относительно UTC в минутах или None
+                      (в EXIF его может не быть; для mtime - смещение
+                      местного часового пояса)
+
+        Значения полей в виде строк (как было раньше в списке fields)
+        возвращает метод get_field.
 
         В случае неизвестного типа файлов всем полям присваивается
         значение None.
-        В случае прочих ошибок генерируются исключения."""
+        В случае прочих ошибок при обращении к свойствам генерируются
+        исключения."""
 
-        self.fields = [None] * self.__N_FIELDS
+        self.filePath = filename
 
         self.fileName, self.fileExt = os.path.splitext(os.path.split(filename)[1])
 
@@ -178,11 +379,75 @@ class FileMetadata():
         # в любом случае будет в нижнем регистре, ибо ваистену
         self.fileExt = self.fileExt.lower()
 
-        self.fields[self.FILETYPE] = ftypes.get_file_type(self.fileExt)
+        self.fileType = ftypes.get_file_type(self.fileExt)
+
+        self.source = source
+
+        self._fileSize = _NOTLOADED
+        self._mtime = _NOTLOADED
+        self._model = _NOTLOADED
+        self._dts = _NOTLOADED
+        self._prefix = _NOTLOADED
+        self._number = _NOTLOADED
+        self._ts = _NOTLOADED
+        self._msec = _NOTLOADED
+        self._utcoffset = _NOTLOADED
+        self._serial = _NOTLOADED
+        self._counter = _NOTLOADED
+
+    def get_record(self):
+        """Возвращает уже загруженные из файла метаданные в виде
+        компактного кортежа пар (номер поля, значение) - для сохранения
+        в индексе (см. pmvscanner.ScanIndex) и последующей загрузки
+        методом set_record."""
+
+        return tuple((ix, v) for ix, v in enumerate(map(self.__getattribute__, self.__RECORD_SLOTS)) if v is not _NOTLOADED)
+
+    def set_record(self, rec):
+        """Загрузка метаданных, ранее полученных методом get_record.
+        После этого соответствующие свойства файл уже не читают."""
+
+        for ix, v in rec:
+            slot = self.__RECORD_SLOTS[ix]
+
+            if slot == '_model' and v is not None:
+                v = sys.intern(v)
+
+            setattr(self, slot, v)
+
+    def get_exif(self):
+        """Возвращает уже загруженные из EXIF метаданные в виде кортежа
+        из двух элементов - модель камеры (или None) и кортеж кортежей
+        строк ('дата', 'доли секунды', 'смещение относительно UTC')
+        (отсутствующие значения - пустые строки), или None, если EXIF
+        ещё не загружался."""
+
+        if self._model is _NOTLOADED or self._dts is _NOTLOADED:
+            return None
+
+        return (self._model, self._dts)
+
+    def get_timestamp(self):
+        """Возвращает уже вычисленные дату/время (значение свойства ts)
+        или None, если они ещё не вычислялись."""
+
+        return self._ts if self._ts is not _NOTLOADED else None
+
+    def set_exif(self, model, dts):
+        """Загрузка метаданных, полученных не из EXIF этого файла
+        (см. BurstCache); параметры - как у результата get_exif.
+        Серийный номер и счётчик снимков при этом не загружаются -
+        при обращении к ним EXIF будет разобран полностью."""
+
+        self._model = model
+        self._dts = dts
+
+    def __load_name_parts(self):
+        """Поля PREFIX, NUMBER"""
+
+        self._prefix = None
+        self._number = None
 
-        #
-        # поля PREFIX, NUMBER
-        #
         rm = self.__rxFNameParts.match(self.fileName)
         if rm:
             rmg = rm.groups()
@@ -190,19 +455,28 @@ class FileMetadata():
             if rmg[0]:
                 s = rmg[0].strip()
                 if s:
-                    self.fields[self.PREFIX] = s;
+                    self._prefix = s;
 
-            self.fields[self.NUMBER] = rmg[1] # м.б. None
+            self._number = rmg[1] # м.б. None
 
-        #
-        # Получение метаданных из EXIF
-        # сделано для pyexiv2/gexiv v0.1.x
-        # (т.к. оно на момент написания было в пузиториях убунты),
-        # м.б. несовместимо с более поздними версиями?
-        #
+    def __load_exif(self):
+        """Получение метаданных из EXIF
+        сделано для pyexiv2/gexiv v0.1.x
+        (т.к. оно на момент написания было в пузиториях убунты),
+        м.б. несовместимо с более поздними версиями?
+
+        Модель камеры сохраняется сразу, строки с датой - как есть,
+        разбираются они только при обращении к свойству ts."""
 
-        md = None
-        if self.fields[self.FILETYPE] != FileTypes.VIDEO:
+        def tag_str(tag):
+            return md.get_tag_string(tag).strip() if md.has_tag(tag) else ''
+
+        self._model = None
+        self._dts = ()
+        self._serial = None
+        self._counter = None
+
+        if self.fileType == FileTypes.VIDEO:
             # пытаемся выковыривать exif только из изображений,
             # если видеофайлы и могут его содержать, один фиг exiv2
             # на обычных видеофайлах спотыкается, а универсальной,
@@ -210,72 +484,234 @@ class FileMetadata():
             # Debian/Ubuntu/... библиотеки что-то пока не нашлось;
             # тащить зависимости ручками из PIP, GitHub и т.п.
             # не считаю допустимым
+            return
+
+        md = GExiv2.Metadata.new()
+        self.__open_exif(md)
+
+        # except GLib.Error as ex:
+        # исключения тут обрабатывать не будем - пусть вылетают
+        # потому как на правильных файлах известных типов оне вылетать не должны,
+        # даже если в файле нет EXIF
+        #    print('GLib.Error: %s - %s' % (GLib.strerror(ex.code), ex.message))
+
+        # ковыряемся в тэгах:
+
+        #
+        # MODEL
+        #
+        if md.has_tag(self.__EXIF_MODEL):
+            model = md.get_tag_string(self.__EXIF_MODEL).strip()
+            if model:
+                # одинаковых строк с моделями - тысячи, хранить будем одну
+                self._model = sys.intern(model)
+
+        #
+        # дата - строки из всех тэгов, которые есть (вместе с долями
+        # секунды и смещением)
+        #
+        self._dts = tuple((md.get_tag_string(dttag), tag_str(sstag), tag_str(tztag)) for dttag, sstag, tztag in self.__EXIF_DT_TAGS if md.has_tag(dttag))
 
-            md = GExiv2.Metadata.new()
-            md.open_path(filename)
-
-            # except GLib.Error as ex:
-            # исключения тут обрабатывать не будем - пусть вылетают
-            # потому как на правильных файлах известных типов оне вылетать не должны,
-            # даже если в файле нет EXIF
-            #    print('GLib.Error: %s - %s' % (GLib.strerror(ex.code), ex.message))
-
-        self.timestamp = None
-
-        if md:
-            # ковыряемся в тэгах:
-
-            #
-            # сначала дату
-            #
-            for tagname in self.__EXIF_DT_TAGS:
-                if md.has_tag(tagname):
-                    # 2016:07:11 20:28:50
-                    dts = md.get_tag_string(tagname)
-                    try:
-                        self.timestamp = datetime.datetime.strptime(dts, u'%Y:%m:%d %H:%M:%S')
-                    except Exception as ex:
-                        print('* Warning!', str(ex))
-                        self.timestamp = None
-                        continue
-                    break
-
-            #
-            # MODEL
-            #
-            if md.has_tag(self.__EXIF_MODEL):
-                model = md.get_tag_string(self.__EXIF_MODEL).strip()
-                if model:
-                    self.fields[self.MODEL] = model
+        #
+        # SERIAL - нули вместо номера пишут камеры, которым его не задали
+        #
+        for tag in self.__EXIF_SERIAL_TAGS:
+            serial = tag_str(tag)
+            if serial.strip('0'):
+                self._serial = normalize_filename(serial)
+                break
 
         #
-        fstatr = os.stat(filename)
+        # COUNTER
+        #
+        for tag in self.__EXIF_COUNTER_TAGS:
+            counter = tag_str(tag)
+            if counter.isdigit():
+                self._counter = counter
+                break
+
+    def __open_exif(self, md):
+        """Загрузка метаданных файла в md (экземпляр GExiv2.Metadata).
+
+        Файл открывается по имени, даже если уже открыт (см. поле
+        source): отображение в память PyGObject передаёт в open_buf
+        не как bytes, а как последовательность - поэлементно, читая
+        и копируя файл целиком, а обрезанный до заголовка буфер
+        не годится для RAW, у которых IFD бывают где угодно."""
+
+        md.open_path(self.filePath)
+
+    def __load_stat(self):
+        fstatr = self.source.stat if self.source is not None else os.stat(self.filePath)
 
         # размер файла в байтах
-        self.fileSize = fstatr.st_size
+        self._fileSize = fstatr.st_size
+        self._mtime = fstatr.st_mtime
+
+    def __load_timestamp(self):
+        timestamp = None
+
+        for dts, subsec, utcoffset in self._dts:
+            # 2016:07:11 20:28:50
+            try:
+                timestamp = datetime.datetime.strptime(dts, u'%Y:%m:%d %H:%M:%S')
+            except Exception as ex:
+                print('* Warning!', str(ex))
+                timestamp = None
+                continue
+            break
 
         #
         # доковыриваем дату
         #
-        if self.timestamp:
+        if timestamp:
             # вахЪ! дата нашлась в EXIF!
-            if self.timestamp.year < 1800 or self.timestamp.month <1 or self.timestamp.month > 12 or self.timestamp.day <1 or self.timestamp.day > 31:
+            if timestamp.year < 1800 or timestamp.month <1 or timestamp.month > 12 or timestamp.day <1 or timestamp.day > 31:
                 # но содержит какую-то херню
-                self.timestamp = None
+                timestamp = None
+
+        if timestamp is not None:
+            self._ts = calendar.timegm(timestamp.timetuple())
+
+            # доли секунды: "5" - это 500 мс, "123456" - 123 мс
+            self._msec = int((subsec + '00')[:3]) if subsec.isdigit() else None
 
-        # фигвам. берём в качестве даты создания mtime файла
-        if self.timestamp is None:
-            self.timestamp = datetime.datetime.fromtimestamp(fstatr.st_mtime)
+            rm = self.__rxUTCOffset.match(utcoffset)
+            if rm:
+                sign, hh, mm = rm.groups()
+                self._utcoffset = (int(hh) * 60 + int(mm)) * (-1 if sign == '-' else 1)
+            else:
+                self._utcoffset = None
+        else:
+            # фигвам. берём в качестве даты создания mtime файла
+            lt = time.localtime(self.mtime)
 
-        self.fields[self.YEAR]      = '%.4d' % self.timestamp.year
-        self.fields[self.MONTH]     = '%.2d' % self.timestamp.month
-        self.fields[self.DAY]       = '%.2d' % self.timestamp.day
-        self.fields[self.HOUR]      = '%.2d' % self.timestamp.hour
-        self.fields[self.MINUTE]    = '%.2d' % self.timestamp.minute
-        self.fields[self.SECOND]    = '%.2d' % self.timestamp.second
+            self._ts = calendar.timegm(lt)
+            self._msec = int(self.mtime * 1000) % 1000
+            self._utcoffset = lt.tm_gmtoff // 60
+
+    @property
+    def fileSize(self):
+        if self._fileSize is _NOTLOADED:
+            self.__load_stat()
+
+        return self._fileSize
+
+    @property
+    def mtime(self):
+        if self._mtime is _NOTLOADED:
+            self.__load_stat()
+
+        return self._mtime
+
+    @property
+    def model(self):
+        if self._model is _NOTLOADED:
+            self.__load_exif()
+
+        return self._model
+
+    @property
+    def serial(self):
+        if self._serial is _NOTLOADED:
+            self.__load_exif()
+
+        return self._serial
+
+    @property
+    def counter(self):
+        if self._counter is _NOTLOADED:
+            self.__load_exif()
+
+        return self._counter
+
+    @property
+    def prefix(self):
+        if self._prefix is _NOTLOADED:
+            self.__load_name_parts()
+
+        return self._prefix
+
+    @property
+    def number(self):
+        if self._number is _NOTLOADED:
+            self.__load_name_parts()
+
+        return self._number
+
+    @property
+    def ts(self):
+        if self._ts is _NOTLOADED:
+            if self._dts is _NOTLOADED:
+                self.__load_exif()
+
+            self.__load_timestamp()
+
+        return self._ts
+
+    @property
+    def msec(self):
+        if self._msec is _NOTLOADED:
+            self.ts
+
+        return self._msec
+
+    @property
+    def utcoffset(self):
+        if self._utcoffset is _NOTLOADED:
+            self.ts
+
+        return self._utcoffset
+
+    @property
+    def timestamp(self):
+        """Дата/время в виде экземпляра datetime.datetime."""
+
+        return datetime.datetime(*time.gmtime(self.ts)[:6])
+
+    def get_field(self, fldix):
+        """Возвращает значение поля fldix (см. константы xxx) в виде
+        строки, или None, если значения нет."""
+
+        if fldix in self.__DATE_FIELDS:
+            tix, fmt = self.__DATE_FIELDS[fldix]
+            return fmt % time.gmtime(self.ts)[tix]
+        elif fldix == self.FILETYPE:
+            return self.fileType
+        elif fldix == self.MODEL:
+            return self.model
+        elif fldix == self.PREFIX:
+            return self.prefix
+        elif fldix == self.NUMBER:
+            return self.number
+        elif fldix == self.SERIAL:
+            return self.serial
+        elif fldix == self.COUNTER:
+            return self.counter
+        elif fldix == self.MSECOND:
+            return '%.3d' % self.msec if self.msec is not None else None
+        elif fldix in (self.TZ, self.UTC):
+            utcoffset = self.utcoffset
+            if utcoffset is None:
+                return None
+
+            if fldix == self.TZ:
+                # "+0300" - двоеточие в именах файлов недопустимо
+                return '%s%.2d%.2d' % ('-' if utcoffset < 0 else '+', abs(utcoffset) // 60, abs(utcoffset) % 60)
+
+            return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(self.ts - utcoffset * 60))
+
+        return None
+
+    @property
+    def fields(self):
+        """Все поля в виде списка (для совместимости и отладки)."""
+
+        return list(map(self.get_field, range(self.__N_FIELDS)))
 
     __FLD_NAMES = ('FILETYPE', 'MODEL', 'PREFIX', 'NUMBER',
-        'YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE', 'SECOND')
+        'YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE', 'SECOND',
+        'MSECOND', 'TZ', 'UTC', 'SERIAL', 'COUNTER')
 
     def __repr__(self):
         """Для отладки"""
@@ -288,6 +724,288 @@ class FileMetadata():
         return '%s(%s)' % (self.__class__.__name__, '\n'.join(r))
 
 
+class BurstCache():
+    """Кэш для серий снимков.
+
+    При серийной съёмке в каталоге оказываются тысячи файлов подряд
+    с одной камеры, у которых различаются только дата/время и номер.
+    Раскладка заголовков у таких файлов одинакова, поэтому после
+    полного разбора EXIF одного файла серии для следующих файлов
+    (в том же каталоге, с тем же префиксом имени и того же порядка
+    размера) достаточно прочитать строки с датой, долями секунды
+    и смещением относительно UTC по тем же смещениям, что и у первого
+    файла, не разбирая EXIF целиком; модель камеры и шаблон берутся
+    от первого файла.
+
+    Библиотека exiv2 читать отдельные тэги не умеет (разбирает все
+    метаданные сразу), потому строки с датой читаются из файла
+    напрямую. Если строки по запомненным смещениям не похожи на дату,
+    или по смещению модели камеры не та модель - файл разбирается
+    полностью (и становится новым образцом). Серийный номер и счётчик
+    снимков (двоичные значения в MakerNote) так не читаются - если они
+    нужны шаблону, EXIF всё равно разбирается полностью.
+
+    Короткие строки (доли секунды, смещение) могут случайно найтись
+    и в других местах заголовка, поэтому запоминаются все их вхождения,
+    и у следующих файлов серии значения по всем смещениям должны
+    совпасть.
+
+    Строки с датой привязываются к тэгам по значению; если у образца
+    в разных тэгах одна и та же дата (обычно DateTime и DateTimeOriginal),
+    то какое из смещений какому тэгу принадлежит - неизвестно. Пока
+    у следующих файлов по этим смещениям тоже одинаковые строки, это
+    ничего не меняет; если строки разные - файл разбирается полностью
+    (и становится новым образцом, уже без неоднозначности)."""
+
+    # сколько начальных байт файла просматривать при поиске смещений
+    HEADER_SIZE = 64 * 1024
+
+    # макс. кол-во серий в кэше (при переполнении кэш очищается)
+    MAX_ENTRIES = 256
+
+    # макс. кол-во вхождений короткой строки в заголовок
+    # (если больше - файл образцом не становится)
+    MAX_OCCURRENCES = 8
+
+    # дата/время в EXIF: "2016:07:11 20:28:50"
+    __DTS_LENGTH = 19
+    __rxDTS = re.compile(rb'\d{4}:\d\d:\d\d \d\d:\d\d:\d\d$')
+
+    # доли секунды ("45") или смещение ("+03:00") - с концом строки
+    __rxShortStr = re.compile(rb'(\d+|[+-]\d\d:\d\d)\0$')
+
+    class Entry():
+        __slots__ = 'model', 'modelBytes', 'modelOffset', 'dtsOffsets', \
+            'dtsGroups', 'strOffsets', 'dtsRefs', 'template'
+
+        def __init__(self, model, modelBytes, modelOffset, dtsOffsets, dtsGroups, strOffsets, dtsRefs, template):
+            """dtsOffsets   - смещения строк с датой;
+            dtsGroups       - кортеж кортежей индексов в dtsOffsets для
+                              строк с датой, одинаковых у образца;
+            strOffsets      - кортеж кортежей (длина, (смещения)) для
+                              каждого значения коротких строк;
+            dtsRefs         - для каждой строки с датой - кортеж из двух
+                              индексов в strOffsets (доли секунды
+                              и смещение), вместо отсутствующих - None."""
+
+            self.model = model
+            self.modelBytes = modelBytes
+            self.modelOffset = modelOffset
+            self.dtsOffsets = dtsOffsets
+            self.dtsGroups = dtsGroups
+            self.strOffsets = strOffsets
+            self.dtsRefs = dtsRefs
+            self.template = template
+
+    def __init__(self):
+        # ключи - кортежи ('каталог', префикс имени файла, порядок размера),
+        # значения - экземпляры Entry
+        self.entries = {}
+
+        # метаданные могут запрашиваться из разных потоков (см. pmvasync)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(entries=%d)' % (self.__class__.__name__, len(self.entries))
+
+    @staticmethod
+    def __get_key(dirPath, metadata):
+        prefix = metadata.prefix
+        if prefix is None:
+            return None
+
+        return (dirPath, prefix, metadata.fileSize.bit_length())
+
+    @staticmethod
+    def __read_header(metadata, size):
+        """Возвращает содержимое файла - отображение в память, если файл
+        уже открыт (см. FileMetadata.source), иначе - прочитанные
+        из файла начальные size байт.
+        Длина результата может превышать size."""
+
+        if metadata.source is not None:
+            buf = metadata.source.get_map()
+            if buf is not None:
+                return buf
+
+        fd = os.open(metadata.filePath, os.O_RDONLY)
+        try:
+            return os.pread(fd, size, 0)
+        finally:
+            os.close(fd)
+
+    def lookup(self, dirPath, metadata):
+        """Поиск серии, к которой относится файл (metadata - экземпляр
+        FileMetadata, dirPath - каталог файла).
+        Если серия нашлась - загружает в metadata модель камеры и дату
+        и возвращает шаблон, сохранённый методом learn, иначе
+        возвращает None."""
+
+        key = self.__get_key(dirPath, metadata)
+        if key is None:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        hdrSize = max(max(entry.dtsOffsets) + self.__DTS_LENGTH,
+            entry.modelOffset + len(entry.modelBytes or b''),
+            max((max(offsets) + length for length, offsets in entry.strOffsets), default=0))
+
+        try:
+            header = self.__read_header(metadata, hdrSize)
+        except OSError:
+            return None
+
+        if entry.modelBytes is not None \
+            and header[entry.modelOffset:entry.modelOffset + len(entry.modelBytes)] != entry.modelBytes:
+            return None
+
+        strs = []
+
+        for length, offsets in entry.strOffsets:
+            sb = header[offsets[0]:offsets[0] + length]
+
+            if not self.__rxShortStr.match(sb):
+                return None
+
+            for offset in offsets[1:]:
+                if header[offset:offset + length] != sb:
+                    return None
+
+            strs.append(sb[:-1].decode('ascii'))
+
+        dts = []
+
+        for offset, refs in zip(entry.dtsOffsets, entry.dtsRefs):
+            dtsb = header[offset:offset + self.__DTS_LENGTH]
+
+            if not self.__rxDTS.match(dtsb):
+                return None
+
+            dts.append((dtsb.decode('ascii'), *('' if ref is None else strs[ref] for ref in refs)))
+
+        # у образца эти строки совпадали, и смещения могли достаться
+        # не тем тэгам
+        for group in entry.dtsGroups:
+            if any(dts[ix][0] != dts[group[0]][0] for ix in group[1:]):
+                return None
+
+        metadata.set_exif(entry.model, tuple(dts))
+
+        return entry.template
+
+    def learn(self, dirPath, metadata, template):
+        """Запоминание файла (metadata - экземпляр FileMetadata
+        с уже загруженным EXIF) как образца серии; template - шаблон,
+        выбранный для этого файла."""
+
+        exif = metadata.get_exif()
+        if exif is None:
+            return
+
+        model, dts = exif
+        if not dts:
+            return
+
+        key = self.__get_key(dirPath, metadata)
+        if key is None:
+            return
+
+        try:
+            header = self.__read_header(metadata, self.HEADER_SIZE)
+        except OSError:
+            return
+
+        hdrEnd = min(len(header), self.HEADER_SIZE)
+
+        dtsOffsets = []
+
+        # ключи - значения коротких строк, значения - индексы в strOffsets
+        strIndexes = {}
+        strOffsets = []
+        dtsRefs = []
+
+        for s, subsec, utcoffset in dts:
+            # строка в EXIF может быть какой угодно, в т.ч. не ASCII
+            sb = s.encode('utf-8')
+            if len(sb) != self.__DTS_LENGTH or not self.__rxDTS.match(sb):
+                return
+
+            # одинаковые строки из разных тэгов лежат в разных местах
+            start = max((o + 1 for o, ps in zip(dtsOffsets, dts) if ps[0] == s), default=0)
+
+            offset = header.find(sb, start, hdrEnd)
+            if offset < 0:
+                return
+
+            dtsOffsets.append(offset)
+
+            refs = []
+
+            for ss in (subsec, utcoffset):
+                if not ss:
+                    refs.append(None)
+                    continue
+
+                if ss not in strIndexes:
+                    ssb = ss.encode('utf-8') + b'\0'
+                    if not self.__rxShortStr.match(ssb):
+                        return
+
+                    offsets = []
+                    offset = header.find(ssb, 0, hdrEnd)
+
+                    while offset >= 0:
+                        # "45" внутри "2345" не годится
+                        if offset == 0 or not header[offset - 1:offset].isdigit():
+                            offsets.append(offset)
+
+                        offset = header.find(ssb, offset + 1, hdrEnd)
+
+                    if not offsets or len(offsets) > self.MAX_OCCURRENCES:
+                        return
+
+                    strIndexes[ss] = len(strOffsets)
+                    strOffsets.append((len(ssb), tuple(offsets)))
+
+                refs.append(strIndexes[ss])
+
+            dtsRefs.append(tuple(refs))
+
+        modelBytes = None
+        modelOffset = 0
+
+        if model is not None:
+            modelBytes = model.encode('utf-8')
+            modelOffset = header.find(modelBytes, 0, hdrEnd)
+
+            if modelOffset < 0:
+                return
+
+            # вместе со следующим байтом (концом строки), иначе "NIKON D70"
+            # совпадёт и с "NIKON D70s"
+            modelBytes = header[modelOffset:modelOffset + len(modelBytes) + 1]
+
+        dtsGroups = {}
+        for ix, (s, subsec, utcoffset) in enumerate(dts):
+            dtsGroups.setdefault(s, []).append(ix)
+
+        dtsGroups = tuple(tuple(group) for group in dtsGroups.values() if len(group) > 1)
+
+        with self.lock:
+            if len(self.entries) >= self.MAX_ENTRIES:
+                self.entries.clear()
+
+            self.entries[key] = self.Entry(model, modelBytes, modelOffset,
+                tuple(dtsOffsets), dtsGroups, tuple(strOffsets), tuple(dtsRefs), template)
+
+
 if __name__ == '__main__':
     print('[debugging %s]' % __file__)
 
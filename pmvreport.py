@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+
+
+import os.path
+import csv
+import heapq
+import json
+
+
+class JournalReport():
+    """Сводка по журналу операций (см. pmvconfig.PMVLogger).
+
+    Журнал (вместе с предыдущим, ротированным файлом) читается за один
+    проход, построчно; в памяти хранятся только итоги: кол-во файлов
+    и байт по минутам, кол-во байт по датам файлов (тем, по которым
+    файлы раскладываются в каталоги назначения), кол-во файлов
+    по моделям камер и top самых медленных файлов (в куче
+    фиксированного размера).
+
+    Размер, время копирования, модель камеры и дата файла есть только
+    в строках cp/mv, записанных версиями программы, которые их пишут;
+    более старые строки учитываются только в кол-ве файлов.
+
+    При нескольких каталогах назначения строки cp/mv о копиях
+    в дополнительных каталогах (те же дата/время и исходный файл, что
+    и у предыдущей строки cp/mv, и без размера) считаются отдельно,
+    как копии, а не как файлы."""
+
+    FORMAT_TEXT = 'text'
+    FORMAT_JSON = 'json'
+    FORMATS = (FORMAT_TEXT, FORMAT_JSON)
+
+    DEFAULT_TOP = 10
+
+    # поля строки журнала
+    __FLD_TIMESTAMP, __FLD_KW, __FLD_RESULT, __FLD_PARAM1, __FLD_PARAM2, \
+    __FLD_SIZE, __FLD_DURATION, __FLD_MODEL, __FLD_DATE = range(9)
+
+    # ключевые слова журнала (см. PMVLogger.KW_xxx) - здесь, чтобы
+    # не тащить pmvconfig со всеми его зависимостями
+    __KW_START = 'start'
+    __KW_ERROR = 'error'
+    __KW_TRANSFER = frozenset(('cp', 'mv'))
+
+    UNKNOWN_MODEL = ''
+    # дата файла не вычислялась (шаблону не нужна) или строка
+    # от старой версии
+    UNKNOWN_DATE = ''
+
+    def __init__(self, top=DEFAULT_TOP):
+        """top  - кол-во самых медленных файлов в отчёте."""
+
+        self.top = top
+
+        # прочитанные файлы журнала
+        self.logPaths = []
+
+        self.runs = 0
+        self.errors = 0
+        self.filesOk = 0
+        self.filesFailed = 0
+        # копии в дополнительных каталогах назначения
+        self.replicas = 0
+        self.bytes = 0
+
+        # (дата/время, исходный файл) предыдущей строки cp/mv
+        self.lastTransfer = None
+
+        # ключи - 'ГГГГ-ММ-ДД ЧЧ:ММ', значения - списки [файлов, байт]
+        self.perMinute = {}
+        # ключи - даты файлов 'ГГГГ-ММ-ДД', значения - байт
+        self.bytesPerDay = {}
+        # ключи - модели камер, значения - кол-во файлов
+        self.perCamera = {}
+
+        # куча кортежей (время копирования, дата/время, размер, источник, назначение)
+        self.slowest = []
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(logPaths=%s, filesOk=%d, filesFailed=%d, replicas=%d, bytes=%d)' % (self.__class__.__name__,
+            self.logPaths, self.filesOk, self.filesFailed, self.replicas, self.bytes)
+
+    def read_log(self, logPath, logOldPath=None):
+        """Чтение журнала logPath (и, если указан и существует,
+        предыдущего файла журнала logOldPath - он читается первым).
+        Отсутствующие файлы пропускаются."""
+
+        for path in (logOldPath, logPath):
+            if path is None or not os.path.exists(path):
+                continue
+
+            self.logPaths.append(path)
+
+            with open(path, 'r', newline='') as f:
+                for row in csv.reader(f, delimiter=';', dialect=csv.excel):
+                    self.add_row(row)
+
+    @staticmethod
+    def __get_number(row, fldix, conv):
+        if len(row) <= fldix or not row[fldix]:
+            return None
+
+        try:
+            return conv(row[fldix])
+        except ValueError:
+            return None
+
+    def add_row(self, row):
+        """Учёт строки журнала (списка строк, как у csv.reader)."""
+
+        if len(row) < 3:
+            # мусор
+            return
+
+        kw = row[self.__FLD_KW]
+
+        if kw == self.__KW_START:
+            self.runs += 1
+        elif kw == self.__KW_ERROR:
+            self.errors += 1
+        elif kw in self.__KW_TRANSFER:
+            timestamp = row[self.__FLD_TIMESTAMP]
+            transfer = (timestamp, row[self.__FLD_PARAM1])
+
+            size = self.__get_number(row, self.__FLD_SIZE, int)
+
+            if size is None and transfer == self.lastTransfer:
+                # тот же файл в дополнительном каталоге назначения
+                if row[self.__FLD_RESULT] == 'True':
+                    self.replicas += 1
+                return
+
+            self.lastTransfer = transfer
+
+            if row[self.__FLD_RESULT] != 'True':
+                self.filesFailed += 1
+                return
+
+            self.filesOk += 1
+            if size is None:
+                # сопроводительный файл или строка от старой версии
+                size = 0
+            else:
+                model = row[self.__FLD_MODEL] if len(row) > self.__FLD_MODEL else self.UNKNOWN_MODEL
+                self.perCamera[model] = self.perCamera.get(model, 0) + 1
+
+                day = row[self.__FLD_DATE] if len(row) > self.__FLD_DATE else self.UNKNOWN_DATE
+                self.bytesPerDay[day] = self.bytesPerDay.get(day, 0) + size
+
+            self.bytes += size
+
+            minute = self.perMinute.get(timestamp[:16])
+            if minute is None:
+                minute = [0, 0]
+                self.perMinute[timestamp[:16]] = minute
+
+            minute[0] += 1
+            minute[1] += size
+
+            duration = self.__get_number(row, self.__FLD_DURATION, float)
+            if duration is not None and self.top > 0:
+                item = (duration, timestamp, size, row[self.__FLD_PARAM1], row[self.__FLD_PARAM2])
+
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, item)
+                elif item > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    def get_dict(self):
+        """Возвращает отчёт в виде словаря (для JSON)."""
+
+        return {'logs':self.logPaths,
+            'runs':self.runs,
+            'errors':self.errors,
+            'files':{'ok':self.filesOk, 'failed':self.filesFailed, 'replicas':self.replicas},
+            'bytes':self.bytes,
+            'throughput':[{'minute':minute, 'files':files, 'bytes':nbytes}
+                for minute, (files, nbytes) in sorted(self.perMinute.items())],
+            'bytesPerDay':dict(sorted(self.bytesPerDay.items())),
+            'cameras':dict(sorted(self.perCamera.items(), key=lambda c: (-c[1], c[0]))),
+            'slowest':[{'duration':duration, 'time':timestamp, 'size':size, 'src':src, 'dest':dest}
+                for duration, timestamp, size, src, dest in sorted(self.slowest, reverse=True)]}
+
+    def get_json(self):
+        return json.dumps(self.get_dict(), ensure_ascii=False, indent=1)
+
+    def get_text(self):
+        """Возвращает отчёт в виде текста."""
+
+        r = ['Журнал: %s' % (', '.join(self.logPaths) if self.logPaths else 'нет'),
+            'Запусков: %d' % self.runs,
+            'Скопировано (перемещено) файлов: %d, байт: %d' % (self.filesOk, self.bytes),
+            'Копий в дополнительных каталогах назначения: %d' % self.replicas,
+            'Неудачных попыток копирования (перемещения): %d' % self.filesFailed,
+            'Ошибок: %d' % self.errors]
+
+        if self.perCamera:
+            r.append('\nФайлов по камерам:')
+            for model, count in sorted(self.perCamera.items(), key=lambda c: (-c[1], c[0])):
+                r.append('  %s: %d' % (model if model else '(модель неизвестна)', count))
+
+        if self.bytesPerDay:
+            r.append('\nБайт по датам файлов:')
+            for day, nbytes in sorted(self.bytesPerDay.items()):
+                r.append('  %s: %d' % (day if day else '(дата неизвестна)', nbytes))
+
+        if self.perMinute:
+            r.append('\nПо минутам:')
+            for minute, (files, nbytes) in sorted(self.perMinute.items()):
+                r.append('  %s  файлов: %d, байт: %d (%.2f МБ/с)' % (minute, files, nbytes, nbytes / (60.0 * 1048576)))
+
+        if self.slowest:
+            r.append('\nСамые медленные файлы:')
+            for duration, timestamp, size, src, dest in sorted(self.slowest, reverse=True):
+                r.append('  %.3f с, %d байт: %s -> %s (%s)' % (duration, size, src, dest, timestamp))
+
+        return '\n'.join(r)
+
+    def get_report(self, fmt):
+        """Возвращает отчёт в формате fmt (FORMAT_xxx)."""
+
+        return self.get_json() if fmt == self.FORMAT_JSON else self.get_text()
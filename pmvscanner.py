@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path
+import re
+import shelve
+import threading
+from fnmatch import translate as fnmatch_translate
+
+
+class SourceScanner():
+    """Поиск файлов известных типов в каталогах-источниках.
+
+    В отличие от os.walk, ненужные каталоги отбрасываются до того,
+    как в них заглядывать:
+    - "скрытые" (в *nix-образных ОС) каталоги;
+    - каталоги, имена которых соответствуют шаблонам excludeDirs;
+    - каталоги глубже maxDepth уровней от корня обхода;
+    - каталоги на других ФС (если oneFileSystem=True).
+
+    Если указан индекс (ScanIndex) - содержимое не изменившихся с прошлого
+    раза каталогов берётся из него."""
+
+    def __init__(self, ftypes, excludeDirs=(), maxDepth=0, oneFileSystem=False, index=None):
+        """ftypes       - экземпляр pmvmetadata.FileTypes;
+        excludeDirs     - последовательность строк с шаблонами имён
+                          каталогов (в формате fnmatch), в которые
+                          заглядывать не следует;
+        maxDepth        - максимальная глубина обхода (1 - только
+                          файлы из самого каталога-источника и его
+                          подкаталогов первого уровня, и т.д.);
+                          0 - без ограничений;
+        oneFileSystem   - если True - не заходить в каталоги,
+                          расположенные на других ФС (точки
+                          монтирования);
+        index           - открытый экземпляр ScanIndex или None."""
+
+        self.ftypes = ftypes
+        self.index = index
+
+        # все шаблоны - в одно регулярное выражение
+        self.excludeMatch = re.compile('|'.join(map(fnmatch_translate, excludeDirs))).match if excludeDirs else None
+
+        self.maxDepth = maxDepth
+        self.oneFileSystem = oneFileSystem
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(excludeDirs=%s, maxDepth=%d, oneFileSystem=%s)' % (
+            self.__class__.__name__,
+            self.excludeMatch.__self__.pattern if self.excludeMatch else None,
+            self.maxDepth,
+            self.oneFileSystem)
+
+    def __read_dir(self, dirpath):
+        """Чтение содержимого каталога dirpath (или его копии из индекса).
+
+        Возвращает кортеж из двух элементов:
+        1. список подкаталогов (кроме "скрытых") - кортежей вида
+           ('имя', st_dev или None);
+        2. список файлов известных типов - кортежей вида
+           ('имя файла', FileTypes.xxx) или ('имя файла', FileTypes.xxx,
+           (сопроводительные файлы)) - см. FileTypes.group_sidecars.
+        В случае ошибки возвращает None."""
+
+        try:
+            if self.index is not None:
+                mtime = os.stat(dirpath).st_mtime_ns
+
+                rec = self.index.get_dir(dirpath, mtime)
+                if rec is not None:
+                    return (rec.subdirs, rec.files)
+
+            with os.scandir(dirpath) as scit:
+                entries = list(scit)
+        except OSError:
+            return None
+
+        files = []
+        subdirs = []
+
+        for entry in entries:
+            try:
+                isdir = entry.is_dir(follow_symlinks=False)
+
+                if not isdir:
+                    files.append(entry.name)
+                # "скрытые" (в *nix-образных ОС) каталоги игнорируем нахрен
+                elif not entry.name.startswith('.'):
+                    subdirs.append((entry.name,
+                        entry.stat(follow_symlinks=False).st_dev if self.oneFileSystem else None))
+            except OSError:
+                continue
+
+        files = self.ftypes.group_sidecars(self.ftypes.filter_known_files(files), files)
+
+        if self.index is not None:
+            self.index.put_dir(dirpath, mtime, subdirs, files)
+
+        return (subdirs, files)
+
+    def scan(self, rootdir):
+        """Обход каталога rootdir (в том же порядке, что и у os.walk).
+
+        Генератор; для каждого каталога, содержащего файлы известных
+        типов, выдаёт кортеж из двух элементов:
+        1. полный путь к каталогу;
+        2. список кортежей вида ('имя файла', FileTypes.xxx[,
+           (сопроводительные файлы)]).
+
+        Ошибки чтения каталогов игнорируются (как у os.walk)."""
+
+        rootdev = os.stat(rootdir).st_dev if self.oneFileSystem else None
+
+        # стек вместо рекурсии; элементы - кортежи ('каталог', глубина)
+        stack = [(rootdir, 0)]
+
+        while stack:
+            dirpath, depth = stack.pop()
+
+            dirdata = self.__read_dir(dirpath)
+            if dirdata is None:
+                continue
+
+            subdirs, files = dirdata
+
+            if files:
+                yield (dirpath, files)
+
+            if self.maxDepth and depth >= self.maxDepth:
+                continue
+
+            nextdirs = []
+
+            for name, dev in subdirs:
+                if self.excludeMatch is not None and self.excludeMatch(name):
+                    continue
+
+                subdirpath = os.path.join(dirpath, name)
+
+                if rootdev is not None:
+                    try:
+                        if dev is None:
+                            # каталог из индекса, созданного без one-filesystem
+                            dev = os.lstat(subdirpath).st_dev
+
+                        if dev != rootdev:
+                            continue
+                    except OSError:
+                        continue
+
+                nextdirs.append((subdirpath, depth + 1))
+
+            stack.extend(reversed(nextdirs))
+
+
+class ScanIndex():
+    """Индекс (снимок) содержимого каталогов-источников.
+
+    Для каждого каталога хранит время его последнего изменения,
+    список подкаталогов, список файлов известных типов и уже
+    извлечённые из этих файлов метаданные.
+    Если время изменения каталога с прошлого раза не изменилось -
+    его содержимое берётся из индекса, а не читается заново.
+
+    Предназначен для больших архивов, которые не меняются (только
+    читаются): изменение содержимого файлов без изменения каталога
+    (добавления, удаления или переименования файлов) индекс
+    не замечает.
+
+    Хранится с помощью модуля shelve; ключи - полные пути к каталогам."""
+
+    INDEX_FNAME = 'scanindex'
+
+    # ключ для параметров, при изменении которых индекс недействителен
+    __CONFIG_KEY = '\0config'
+    __VERSION = 3
+
+    class DirRecord():
+        __slots__ = 'mtime', 'subdirs', 'files', 'metadata'
+
+        def __init__(self, mtime, subdirs, files):
+            self.mtime = mtime
+            self.subdirs = subdirs
+            self.files = files
+
+            # ключи - имена файлов, значения - см. FileMetadata.get_record
+            self.metadata = {}
+
+        def __getstate__(self):
+            return (self.mtime, self.subdirs, self.files, self.metadata)
+
+        def __setstate__(self, state):
+            self.mtime, self.subdirs, self.files, self.metadata = state
+
+    def __init__(self, cacheDir, ftypes):
+        """cacheDir     - полный путь к каталогу, где хранится индекс;
+        ftypes          - экземпляр pmvmetadata.FileTypes (при изменении
+                          списков известных расширений, в т.ч. расширений
+                          сопроводительных файлов, индекс сбрасывается)."""
+
+        self.indexPath = os.path.join(cacheDir, self.INDEX_FNAME)
+        self.config = (self.__VERSION, tuple(sorted(ftypes.extMap.items())), tuple(sorted(ftypes.sidecarExtensions)))
+
+        self.db = None
+
+        # прочитанные и изменённые записи
+        # ключи - полные пути к каталогам, значения - DirRecord
+        self.dirs = {}
+        # пути к каталогам, записи которых надо сохранить
+        self.modified = set()
+
+        # метаданные файлов могут запрашиваться из разных потоков
+        # (см. pmvasync)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(indexPath="%s")' % (self.__class__.__name__, self.indexPath)
+
+    def open(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.indexPath), exist_ok=True)
+
+            self.db = shelve.open(self.indexPath)
+
+            if self.db.get(self.__CONFIG_KEY) != self.config:
+                self.db.clear()
+                self.db[self.__CONFIG_KEY] = self.config
+
+    def close(self):
+        if self.db is not None:
+            for dirpath in self.modified:
+                self.db[dirpath] = self.dirs[dirpath]
+
+            self.modified.clear()
+            self.dirs.clear()
+
+            self.db.close()
+            self.db = None
+
+    def __get_record(self, dirpath):
+        rec = self.dirs.get(dirpath)
+
+        if rec is None:
+            rec = self.db.get(dirpath)
+            if rec is not None:
+                self.dirs[dirpath] = rec
+
+        return rec
+
+    def get_dir(self, dirpath, mtime):
+        """Возвращает экземпляр DirRecord для каталога dirpath, если
+        он есть в индексе и время изменения каталога совпадает с mtime,
+        иначе возвращает None."""
+
+        rec = self.__get_record(dirpath)
+
+        return rec if rec is not None and rec.mtime == mtime else None
+
+    def put_dir(self, dirpath, mtime, subdirs, files):
+        """Добавление (замена) записи о каталоге dirpath.
+        Ранее сохранённые метаданные файлов каталога сбрасываются."""
+
+        self.dirs[dirpath] = self.DirRecord(mtime, subdirs, files)
+        self.modified.add(dirpath)
+
+    def get_metadata(self, dirpath, fname):
+        """Возвращает сохранённые метаданные файла fname из каталога
+        dirpath (см. FileMetadata.get_record) или None."""
+
+        with self.lock:
+            rec = self.__get_record(dirpath)
+
+            return rec.metadata.get(fname) if rec is not None else None
+
+    def set_metadata(self, dirpath, fname, mdrec):
+        """Сохранение метаданных файла fname из каталога dirpath
+        (mdrec - см. FileMetadata.get_record)."""
+
+        with self.lock:
+            rec = self.__get_record(dirpath)
+
+            if rec is not None and rec.metadata.get(fname) != mdrec:
+                rec.metadata[fname] = mdrec
+                self.modified.add(dirpath)
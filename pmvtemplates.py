@@ -31,7 +31,7 @@ class FileNameTemplate():
     # поля шаблона
     YEAR, MONTH, DAY, HOUR, MINUTE, SECOND, \
     MODEL, ALIAS, PREFIX, NUMBER, FILETYPE, LONGFILETYPE, \
-    FILENAME = range(13)
+    FILENAME, MSECOND, TZ, UTC, SERIAL, COUNTER = range(18)
 
     fldparm = namedtuple('fldparm', 'shortname longname dispname description')
 
@@ -66,6 +66,16 @@ class FileNameTemplate():
         fldparm('l', 'longtype', 'ТИПФАЙЛА', 'тип файла (полностью)'),
         # FILENAME - оригинальное имя файла (без расширения)
         fldparm('f', 'filename', 'ИМЯФАЙЛА', 'исходное имя файла (без расширения)'),
+        # MSECOND - миллисекунды (из долей секунды в EXIF)
+        fldparm('ms', 'msecond', 'МСЕК', 'миллисекунды (три цифры)'),
+        # TZ - смещение относительно UTC (из EXIF)
+        fldparm('z', 'tz', 'ЧПОЯС', 'смещение относительно UTC (+ЧЧММ)'),
+        # UTC - дата/время в UTC (если известно смещение)
+        fldparm('u', 'utc', 'ДАТАUTC', 'дата и время в UTC (ГГГГММДДTЧЧММССZ)'),
+        # SERIAL - серийный номер камеры (из EXIF/MakerNote)
+        fldparm('sn', 'serial', 'СЕРНОМЕР', 'серийный номер камеры'),
+        # COUNTER - счётчик снимков камеры (из EXIF/MakerNote)
+        fldparm('c', 'counter', 'СЧЁТЧИК', 'счётчик снимков камеры'),
         )
 
     # маппинг полей экземпляра FileMetadata в поля FileNameTemplate
@@ -73,7 +83,13 @@ class FileNameTemplate():
     __METADATA_FIELDS = {YEAR:FileMetadata.YEAR, MONTH:FileMetadata.MONTH,
         DAY:FileMetadata.DAY, HOUR:FileMetadata.HOUR, MINUTE:FileMetadata.MINUTE, SECOND:FileMetadata.SECOND,
         MODEL:FileMetadata.MODEL,
-        PREFIX:FileMetadata.PREFIX, NUMBER:FileMetadata.NUMBER}
+        PREFIX:FileMetadata.PREFIX, NUMBER:FileMetadata.NUMBER,
+        MSECOND:FileMetadata.MSECOND, TZ:FileMetadata.TZ, UTC:FileMetadata.UTC,
+        SERIAL:FileMetadata.SERIAL, COUNTER:FileMetadata.COUNTER}
+
+    # поля, для которых нужны метаданные из EXIF
+    # (для полей даты - ещё и os.stat, если в EXIF даты нет)
+    EXIF_FIELDS = frozenset((YEAR, MONTH, DAY, HOUR, MINUTE, SECOND, MSECOND, TZ, UTC, MODEL, ALIAS, SERIAL, COUNTER))
 
     class Error(Exception):
         pass
@@ -177,6 +193,14 @@ class FileNameTemplate():
             else:
                 flush_word(tbracket, tplstr[tplstart:tplix])
 
+        # поля метаданных, используемые шаблоном
+        self.usedFields = frozenset(filter(lambda f: not isinstance(f, str), self.fields))
+
+    def needs_exif(self):
+        """Возвращает True, если для шаблона нужны метаданные из EXIF."""
+
+        return not self.usedFields.isdisjoint(self.EXIF_FIELDS)
+
     def get_field_str(self, env, metadata, fldix):
         """Возвращает поле шаблона в виде строки.
 
@@ -190,20 +214,20 @@ class FileNameTemplate():
         fv = None
 
         if fldix in self.__METADATA_FIELDS:
-            fv = metadata.fields[self.__METADATA_FIELDS[fldix]]
+            fv = metadata.get_field(self.__METADATA_FIELDS[fldix])
         elif fldix == self.ALIAS:
-            if metadata.fields[FileMetadata.MODEL]:
-                model = metadata.fields[FileMetadata.MODEL].lower()
+            if metadata.model:
+                model = metadata.model.lower()
 
                 if model in env.aliases:
                     fv = env.aliases[model]
         elif fldix == self.FILENAME:
             fv = metadata.fileName
         elif fldix == self.FILETYPE:
-            nfx = metadata.fields[FileMetadata.FILETYPE]
+            nfx = metadata.fileType
             fv = FileTypes.STR[nfx] if nfx in FileTypes.STR else None
         elif fldix == self.LONGFILETYPE:
-            nfx = metadata.fields[FileMetadata.FILETYPE]
+            nfx = metadata.fileType
             fv = FileTypes.LONGSTR[nfx] if nfx in FileTypes.LONGSTR else None
 
         return '_' if not fv else fv
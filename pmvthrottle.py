@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+
+
+import os
+import errno
+import time
+import threading
+import platform
+
+try:
+    import ctypes
+
+    __libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    __libc = None
+
+
+class TokenBucket():
+    """Ограничение скорости методом "ведра с жетонами".
+
+    Жетоны добавляются в ведро со скоростью rate в секунду, но не более
+    capacity штук; каждая операция забирает из ведра столько жетонов,
+    сколько "стоит" (байт, файлов), и если их не хватает - ждёт.
+    Пока ведро полное, короткие всплески проходят без задержек,
+    а средняя скорость не превышает rate."""
+
+    def __init__(self, rate, capacity=None):
+        """rate     - скорость (жетонов в секунду), > 0;
+        capacity    - ёмкость ведра (None - жетонов за одну секунду)."""
+
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+
+        self.tokens = self.capacity
+        self.lastTime = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(rate=%g, capacity=%g)' % (self.__class__.__name__, self.rate, self.capacity)
+
+    def consume(self, n):
+        """Забирает из ведра n жетонов; при нехватке - ждёт.
+        Операции "дороже" ёмкости ведра не запрещены: ведро уходит
+        в минус, и следующие операции ждут дольше.
+        Может вызываться из разных потоков."""
+
+        with self.lock:
+            now = time.monotonic()
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.lastTime) * self.rate)
+            self.lastTime = now
+
+            self.tokens -= n
+
+            # жетоны за ожидание уже "потрачены" этой операцией -
+            # прочие потоки будут ждать за ней
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class IOThrottle():
+    """Ограничение нагрузки на ввод-вывод при копировании/перемещении
+    (см. pmvtransfer.FileTransfer.throttle).
+
+    - maxBytesRate - не более заданного кол-ва байт (исходных данных)
+      в секунду;
+    - maxFilesRate - не более заданного кол-ва файлов в секунду;
+    - backoff - подстройка под нагрузку на хранилище: время записи
+      каждого блока сглаживается (экспоненциальное скользящее среднее)
+      и сравнивается с наименьшим наблюдавшимся (базовым); пока
+      запись заметно медленнее базовой (хранилище занято кем-то ещё) -
+      перед каждым блоком делается пауза, удваиваемая с каждым
+      медленным блоком, а когда запись ускоряется - пауза уменьшается
+      вдвое. Так копирование занимает только свободную часть
+      пропускной способности, а не фиксированную долю."""
+
+    # вес нового значения в скользящем среднем
+    EWMA_ALPHA = 0.2
+
+    # во сколько раз время записи должно превысить базовое,
+    # чтобы начались паузы
+    BACKOFF_THRESHOLD = 2.0
+
+    # пределы паузы перед записью блока (в секундах)
+    MIN_DELAY = 0.005
+    MAX_DELAY = 1.0
+
+    # насколько базовое время записи подрастает с каждым блоком
+    # (чтобы медленно следовать за изменениями хранилища)
+    BASELINE_DRIFT = 0.001
+
+    # блоки меньше этого размера (хвосты файлов) не учитываются -
+    # время их записи определяется накладными расходами, а не объёмом
+    MIN_SAMPLE_SIZE = 64 * 1024
+
+    def __init__(self, maxBytesRate=0, maxFilesRate=0, backoff=False):
+        """maxBytesRate - байт в секунду (0 - без ограничения);
+        maxFilesRate    - файлов в секунду (0 - без ограничения);
+        backoff         - True - пауза при росте времени записи."""
+
+        self.maxBytesRate = maxBytesRate
+        self.maxFilesRate = maxFilesRate
+        self.backoff = backoff
+
+        # ёмкость - на одну секунду, но не меньше одного блока
+        # копирования, иначе каждый блок ждал бы "в долг"
+        self.bytesBucket = TokenBucket(maxBytesRate, max(maxBytesRate, 1024 * 1024)) if maxBytesRate > 0 else None
+        self.filesBucket = TokenBucket(maxFilesRate) if maxFilesRate > 0 else None
+
+        # время записи мегабайта: сглаженное и базовое (None - ещё
+        # нет данных)
+        self.latency = None
+        self.baseline = None
+        # текущая пауза перед записью блока
+        self.delay = 0.0
+
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(maxBytesRate=%d, maxFilesRate=%g, backoff=%s)' % (self.__class__.__name__,
+            self.maxBytesRate, self.maxFilesRate, self.backoff)
+
+    @property
+    def enabled(self):
+        return self.bytesBucket is not None or self.filesBucket is not None or self.backoff
+
+    def start_file(self):
+        """Вызывается перед копированием/перемещением очередного файла."""
+
+        if self.filesBucket is not None:
+            self.filesBucket.consume(1)
+
+    def before_write(self, nbytes):
+        """Вызывается перед записью блока из nbytes байт исходных данных."""
+
+        if self.bytesBucket is not None:
+            self.bytesBucket.consume(nbytes)
+
+        if self.backoff:
+            delay = self.delay
+            if delay > 0:
+                time.sleep(delay)
+
+    def after_write(self, nbytes, elapsed):
+        """Вызывается после записи блока из nbytes байт, занявшей
+        elapsed секунд."""
+
+        if not self.backoff or nbytes < self.MIN_SAMPLE_SIZE:
+            return
+
+        # время записи мегабайта
+        sample = elapsed * 1048576.0 / nbytes
+
+        with self.lock:
+            if self.latency is None:
+                self.latency = sample
+                self.baseline = sample
+                return
+
+            self.latency += (sample - self.latency) * self.EWMA_ALPHA
+            self.baseline = min(self.latency, self.baseline * (1.0 + self.BASELINE_DRIFT))
+
+            if self.latency > self.baseline * self.BACKOFF_THRESHOLD:
+                self.delay = min(self.MAX_DELAY, max(self.MIN_DELAY, self.delay * 2))
+            elif self.delay > 0:
+                self.delay /= 2
+                if self.delay < self.MIN_DELAY:
+                    self.delay = 0.0
+
+
+#
+# приоритет ввода-вывода (Linux, ioprio_set)
+#
+
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# номера системного вызова ioprio_set для разных архитектур
+# (в glibc обёртки для него нет)
+_IOPRIO_SET_SYSCALLS = {'x86_64':251,
+    'i386':289, 'i486':289, 'i586':289, 'i686':289,
+    'aarch64':30, 'riscv64':30, 'loongarch64':30,
+    'armv6l':314, 'armv7l':314, 'armv8l':314,
+    'ppc64':273, 'ppc64le':273, 'ppc':273,
+    's390x':282,
+    'mips64':5273}
+
+
+def set_idle_io_priority():
+    """Переключение всех потоков процесса (и создаваемых ими позже
+    потоков и процессов) в класс приоритета ввода-вывода "idle" -
+    диск получают только тогда, когда он никому больше не нужен.
+    Работает только в Linux (и только с планировщиками ввода-вывода,
+    поддерживающими приоритеты - BFQ, CFQ).
+
+    Возвращает True в случае успеха, иначе False."""
+
+    syscallNo = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscallNo is None or __libc is None or not os.path.isdir('/proc/self/task'):
+        return False
+
+    ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+
+    # приоритет в Linux - свойство потока, а не процесса;
+    # новые потоки наследуют его от создающего потока
+    try:
+        tids = [int(tid) for tid in os.listdir('/proc/self/task')]
+    except (OSError, ValueError):
+        return False
+
+    ok = True
+
+    for tid in tids:
+        if __libc.syscall(syscallNo, IOPRIO_WHO_PROCESS, tid, ioprio) != 0:
+            # поток мог успеть завершиться
+            if ctypes.get_errno() != errno.ESRCH:
+                ok = False
+
+    return ok
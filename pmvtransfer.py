@@ -0,0 +1,1063 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path
+import re
+import shutil
+import errno
+import mmap
+import hashlib
+import threading
+import itertools
+import time
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from pmvcommon import make_dirs
+
+try:
+    import ctypes
+
+    __libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    __libc = None
+
+try:
+    _syncfs = __libc.syncfs
+    _syncfs.argtypes = (ctypes.c_int,)
+except AttributeError:
+    # не Linux (или что-то совсем странное) - будет использоваться os.sync()
+    _syncfs = None
+
+try:
+    _renameat2 = __libc.renameat2
+    _renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+except AttributeError:
+    # старая glibc или не Linux - будет использоваться os.link
+    _renameat2 = None
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+# имена временных файлов (см. FileTransfer.__temp_name): "скрытые",
+# с именем компьютера и PID записывающего процесса (каталог назначения
+# может быть на сетевом диске, куда пишут несколько компьютеров)
+TEMP_FNAME_FORMAT = '.%s.pmvtmp-%s-%d-%d'
+_rxTempFName = re.compile(r'^\..+\.pmvtmp-(.+)-(\d+)-\d+$')
+
+# "-" в имени компьютера регулярному выражению не мешает, os.sep - имени файла
+_HOSTNAME = socket.gethostname().replace(os.sep, '_') or 'localhost'
+
+# временные файлы старше этого (в секундах) считаются брошенными
+# там, где нельзя проверить, жив ли записавший их процесс
+STALE_TEMP_AGE = 24 * 60 * 60
+
+
+def _is_stale_temp(path, hostname, pid):
+    """Возвращает True, если временный файл path, записанный процессом
+    pid на компьютере hostname, брошен (процесса уже нет - например,
+    после аварийного завершения).
+    Процесс проверяется, только если он запущен на этом же компьютере;
+    файлы других компьютеров считаются брошенными по возрасту."""
+
+    if hostname == _HOSTNAME and os.name == 'posix':
+        if pid == os.getpid():
+            return False
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            # процесс есть, но чужой
+            pass
+
+        return False
+
+    # PID с другого компьютера здесь ничего не значит, а на прочих ОС
+    # os.kill процесс не проверяет, а убивает
+    try:
+        return time.time() - os.lstat(path).st_mtime > STALE_TEMP_AGE
+    except OSError:
+        return False
+
+
+def rename_noreplace(src, dst):
+    """Атомарное переименование файла src в dst, если dst не существует.
+    Если dst существует - генерирует исключение FileExistsError.
+
+    Использует renameat2(RENAME_NOREPLACE), если его поддерживают ОС и ФС,
+    иначе - os.link с последующим удалением src; если ФС не умеет
+    и жёстких ссылок (FAT и т.п.) - проверку существования dst
+    и os.rename (уже не атомарно)."""
+
+    if _renameat2 is not None:
+        if _renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE) == 0:
+            return
+
+        en = ctypes.get_errno()
+        if en not in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+            raise OSError(en, os.strerror(en), src, None, dst)
+
+    try:
+        os.link(src, dst)
+        os.remove(src)
+        return
+    except OSError as ex:
+        if ex.errno not in (errno.EPERM, errno.ENOTSUP, errno.EMLINK, errno.ENOSYS):
+            raise
+
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+
+    os.rename(src, dst)
+
+
+class DestinationDirCache():
+    """Кэш содержимого каталогов назначения и таблица занятых
+    (в т.ч. зарезервированных, но ещё не записанных) имён файлов.
+
+    Содержимое каталога читается один раз, при первом обращении к нему,
+    после чего проверки существования файлов и подбор свободных имён
+    делаются без системных вызовов.
+    Резервирование имён потокобезопасно, что позволяет копировать файлы
+    в несколько потоков без гонок между проверкой существования файла
+    и его записью.
+
+    Если задан shardSize - каталоги назначения не растут бесконечно:
+    когда в каталоге набирается shardSize элементов, новые файлы
+    кладутся в его подкаталоги-"корзины" (_000, _001, ...), каждая -
+    тоже не больше чем на shardSize элементов. Каталог с корзинами
+    считается одним каталогом: имя, занятое в нём самом или в любой
+    из его корзин, считается занятым.
+
+    При первом обращении к каталогу из него удаляются временные файлы,
+    брошенные прерванными запусками (см. FileTransfer.__temp_name)."""
+
+    # имена подкаталогов-корзин
+    SHARD_FORMAT = '_%03d'
+    __rxShard = re.compile(r'^_\d{3,}$')
+
+    def __init__(self, shardSize=0):
+        """shardSize    - макс. кол-во элементов в каталоге (корзине);
+                          0 - без корзин."""
+
+        self.shardSize = shardSize
+
+        self.lock = threading.Lock()
+
+        # ключи - полные пути к каталогам,
+        # значения - множества имён файлов в этих каталогах
+        self.dirs = {}
+
+        # каталоги, которые точно существуют (прочитаны или созданы)
+        self.madeDirs = set()
+
+        # ключи - полные пути к каталогам, значения - отсортированные
+        # по номеру списки имён корзин этих каталогов
+        self.shards = {}
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(shardSize=%d, dirs=%d)' % (self.__class__.__name__, self.shardSize, len(self.dirs))
+
+    def __get_dir(self, dirpath):
+        names = self.dirs.get(dirpath)
+
+        if names is None:
+            try:
+                names = set(os.listdir(dirpath))
+                self.madeDirs.add(dirpath)
+            except FileNotFoundError:
+                names = set()
+
+            for fname in list(names):
+                rm = _rxTempFName.match(fname)
+                if rm is None:
+                    continue
+
+                tmppath = os.path.join(dirpath, fname)
+
+                if _is_stale_temp(tmppath, rm.group(1), int(rm.group(2))):
+                    try:
+                        os.remove(tmppath)
+                        names.discard(fname)
+                    except OSError:
+                        pass
+
+            self.dirs[dirpath] = names
+
+        return names
+
+    def __get_shards(self, dirpath):
+        shards = self.shards.get(dirpath)
+
+        if shards is None:
+            shards = sorted(filter(self.__rxShard.match, self.__get_dir(dirpath)), key=lambda sn: int(sn[1:]))
+            shards = [sn for sn in shards if os.path.isdir(os.path.join(dirpath, sn))]
+
+            self.shards[dirpath] = shards
+
+        return shards
+
+    def __find(self, dirpath, fname):
+        """Возвращает путь к каталогу (dirpath или одной из его корзин),
+        где занято имя fname, или None."""
+
+        if fname in self.__get_dir(dirpath):
+            return dirpath
+
+        if self.shardSize:
+            for sn in self.__get_shards(dirpath):
+                shardpath = os.path.join(dirpath, sn)
+
+                if fname in self.__get_dir(shardpath):
+                    return shardpath
+
+        return None
+
+    def __get_target(self, dirpath):
+        """Возвращает путь к каталогу, куда следует класть новый файл:
+        dirpath, его последняя корзина или новая корзина."""
+
+        if len(self.__get_dir(dirpath)) < self.shardSize:
+            return dirpath
+
+        shards = self.__get_shards(dirpath)
+
+        if shards:
+            shardpath = os.path.join(dirpath, shards[-1])
+
+            if len(self.__get_dir(shardpath)) < self.shardSize:
+                return shardpath
+
+        sn = self.SHARD_FORMAT % (int(shards[-1][1:]) + 1 if shards else 0)
+
+        # корзина - тоже элемент каталога
+        self.__get_dir(dirpath).add(sn)
+        shards.append(sn)
+
+        return os.path.join(dirpath, sn)
+
+    def split_shard(self, dirpath):
+        """Возвращает кортеж из двух элементов - путь к каталогу
+        и имя корзины ('', если dirpath - не корзина)."""
+
+        if self.shardSize:
+            parent, sn = os.path.split(dirpath)
+
+            if self.__rxShard.match(sn):
+                return (parent, sn)
+
+        return (dirpath, '')
+
+    def make_dirs(self, dirpath):
+        """Создание каталога dirpath, если он ещё не создан
+        (аналог pmvcommon.make_dirs).
+        В случае успеха возвращает None, в случае ошибки - строку
+        с сообщением об ошибке."""
+
+        with self.lock:
+            if dirpath in self.madeDirs:
+                return None
+
+        emsg = make_dirs(dirpath, None)
+        if emsg is None:
+            with self.lock:
+                self.__get_dir(dirpath)
+                self.madeDirs.add(dirpath)
+
+        return emsg
+
+    def find(self, dirpath, fname):
+        """Возвращает путь к каталогу (dirpath или одной из его корзин),
+        где занято (или зарезервировано) имя fname, или None."""
+
+        with self.lock:
+            return self.__find(dirpath, fname)
+
+    def exists(self, dirpath, fname):
+        """Возвращает True, если имя fname в каталоге dirpath
+        (или в одной из его корзин) занято (или зарезервировано)."""
+
+        return self.find(dirpath, fname) is not None
+
+    def reserve(self, dirpath, fname, shard=None):
+        """Резервирование имени fname в каталоге dirpath.
+
+        shard   - None - корзина выбирается автоматически (если они
+                  включены), иначе - имя корзины, в которой следует
+                  резервировать имя, или '' (в самом каталоге).
+
+        Возвращает путь к каталогу (dirpath или одной из его корзин),
+        где имя было свободно (и теперь занято), или None, если имя
+        уже занято."""
+
+        with self.lock:
+            if self.__find(dirpath, fname) is not None:
+                return None
+
+            if shard is None:
+                target = self.__get_target(dirpath) if self.shardSize else dirpath
+            elif shard:
+                target = os.path.join(dirpath, shard)
+
+                shards = self.__get_shards(dirpath)
+                if shard not in shards:
+                    self.__get_dir(dirpath).add(shard)
+                    shards.append(shard)
+                    shards.sort(key=lambda sn: int(sn[1:]))
+            else:
+                target = dirpath
+
+            self.__get_dir(target).add(fname)
+            return target
+
+    def mark_existing(self, dirpath, fname):
+        """Отметка имени fname в каталоге (корзине) dirpath как занятого
+        (например, файлом, созданным другим процессом после того, как
+        каталог был прочитан)."""
+
+        with self.lock:
+            self.__get_dir(dirpath).add(fname)
+
+    def release(self, dirpath, fname):
+        """Освобождение зарезервированного имени (например, если
+        файл записать не удалось); dirpath - каталог (корзина),
+        который вернул метод reserve."""
+
+        with self.lock:
+            self.__get_dir(dirpath).discard(fname)
+
+
+class FileTransfer():
+    """Копирование и перемещение файлов.
+
+    В режиме CACHE_NORMAL работает так же, как shutil.copy и shutil.move.
+
+    В режимах CACHE_DONTNEED и CACHE_DIRECT данные копируются
+    собственным циклом, чтобы многогигабайтные переносы не вытесняли
+    из кэша ОС всё остальное (в т.ч. заголовки файлов, прочитанные
+    заранее для извлечения метаданных):
+    - CACHE_DONTNEED - после чтения и записи каждого блока для уже
+      обработанных участков исходного файла и файла назначения
+      вызывается posix_fadvise(POSIX_FADV_DONTNEED);
+    - CACHE_DIRECT - файлы открываются с флагом O_DIRECT (чтение
+      и запись - выровненными блоками), мимо кэша; если ФС O_DIRECT
+      не поддерживает - используется CACHE_DONTNEED.
+
+    Данные всегда пишутся во временный ("скрытый") файл в каталоге
+    назначения, который после записи атомарно переименовывается
+    в файл назначения, поэтому недописанных файлов в архиве не бывает.
+    Без явного разрешения перезаписи существующий файл назначения
+    не затирается (см. rename_noreplace).
+
+    Проверка копий (verify):
+    - VERIFY_NONE - без проверки;
+    - VERIFY_HASH - контрольная сумма (HASH_ALGORITHM) считается
+      по ходу копирования, без повторного чтения исходного файла;
+    - VERIFY_REREAD - то же, плюс записанный файл (ещё под временным
+      именем) сбрасывается на диск, выбрасывается из кэша ОС
+      и перечитывается; при несовпадении контрольных сумм копирование
+      считается неудачным.
+    При перемещении в пределах одной ФС (переименовании) данные
+    не копируются, и контрольная сумма не считается.
+
+    Копирование в несколько каталогов назначения сразу (методы
+    copy_multi и move_multi) делается за одно чтение исходного файла:
+    каждый прочитанный блок пишется во все файлы назначения параллельно
+    (в отдельных потоках), пока читается следующий блок.
+
+    Нагрузку на хранилище можно ограничить (throttle - экземпляр
+    pmvthrottle.IOThrottle): скорость в байтах и файлах в секунду,
+    паузы при росте времени записи. Данные тогда всегда копируются
+    собственным циклом.
+
+    Сохранность записанных файлов при сбоях питания и т.п. зависит
+    от режима (durability):
+    - SYNC_NONE - как раньше, без fsync (быстро, но при сбое можно
+      потерять и копию, и уже удалённый исходный файл);
+    - SYNC_FILE - после записи каждого файла делается fsync файла
+      и каталога, где он лежит, и только после этого удаляется исходный
+      файл (надёжно, но медленно);
+    - SYNC_BATCH - исходные файлы удаляются не сразу, а пачками:
+      после записи каждых syncBatchSize файлов вызывается syncfs
+      для ФС, на которые писались файлы, и только после этого удаляются
+      соответствующие исходные файлы (см. метод sync)."""
+
+    CACHE_NORMAL, CACHE_DONTNEED, CACHE_DIRECT = range(3)
+
+    CACHE_OPTIONS = {'normal':CACHE_NORMAL,
+        'dontneed':CACHE_DONTNEED,
+        'direct':CACHE_DIRECT}
+
+    CACHE_OPTIONS_STR = dict(map(lambda v: (v[1], v[0]), CACHE_OPTIONS.items()))
+
+    SYNC_NONE, SYNC_FILE, SYNC_BATCH = range(3)
+
+    SYNC_OPTIONS = {'none':SYNC_NONE,
+        'file':SYNC_FILE,
+        'batch':SYNC_BATCH}
+
+    SYNC_OPTIONS_STR = dict(map(lambda v: (v[1], v[0]), SYNC_OPTIONS.items()))
+
+    DEFAULT_SYNC_BATCH_SIZE = 100
+
+    VERIFY_NONE, VERIFY_HASH, VERIFY_REREAD = range(3)
+
+    VERIFY_OPTIONS = {'none':VERIFY_NONE,
+        'hash':VERIFY_HASH,
+        'reread':VERIFY_REREAD}
+
+    VERIFY_OPTIONS_STR = dict(map(lambda v: (v[1], v[0]), VERIFY_OPTIONS.items()))
+
+    # алгоритм контрольных сумм (имя для hashlib.new)
+    HASH_ALGORITHM = 'sha256'
+
+    # размер блока копирования; должен быть кратен DIRECT_ALIGN
+    BUFFER_SIZE = 1024 * 1024
+
+    # выравнивание для O_DIRECT (с запасом - размер страницы,
+    # а не размер сектора)
+    DIRECT_ALIGN = 4096
+
+    # макс. кол-во потоков для записи в несколько файлов назначения
+    FANOUT_WORKERS = 8
+
+    def __init__(self, cachePolicy=CACHE_NORMAL, durability=SYNC_NONE,
+            syncBatchSize=DEFAULT_SYNC_BATCH_SIZE, verify=VERIFY_NONE, throttle=None):
+        """cachePolicy  - CACHE_xxx;
+        durability      - SYNC_xxx;
+        syncBatchSize   - кол-во файлов в пачке для режима SYNC_BATCH;
+        verify          - VERIFY_xxx;
+        throttle        - None или экземпляр pmvthrottle.IOThrottle."""
+
+        self.cachePolicy = cachePolicy
+        self.durability = durability
+        self.syncBatchSize = max(1, syncBatchSize)
+        self.verify = verify
+        self.throttle = throttle
+
+        if not hasattr(os, 'posix_fadvise'):
+            # ОС без posix_fadvise - работаем как раньше
+            self.cachePolicy = self.CACHE_NORMAL
+
+        # буферы для копирования (свои для каждого потока);
+        # mmap - для выравнивания по границе страницы (нужно для O_DIRECT);
+        # создаются при первом использовании
+        self.buffers = threading.local()
+
+        # счётчик для имён временных файлов
+        self.tempCounter = itertools.count()
+
+        # блокировка для состояния режима SYNC_BATCH
+        self.lock = threading.Lock()
+
+        # для режима SYNC_BATCH:
+        # кол-во файлов, записанных после последнего вызова syncfs
+        self.nUnsynced = 0
+        # каталоги, в которые писались эти файлы
+        self.unsyncedDirs = set()
+        # исходные файлы, ожидающие удаления
+        self.pendingRemoval = []
+
+        # потоки для записи в несколько файлов назначения
+        # (создаются при первом использовании)
+        self.fanoutExecutor = None
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(cachePolicy=%s, durability=%s, syncBatchSize=%d, verify=%s, throttle=%s)' % (
+            self.__class__.__name__,
+            self.CACHE_OPTIONS_STR[self.cachePolicy],
+            self.SYNC_OPTIONS_STR[self.durability],
+            self.syncBatchSize,
+            self.VERIFY_OPTIONS_STR[self.verify],
+            self.throttle)
+
+    @staticmethod
+    def __open_direct(path, flags, mode=0o666):
+        """Открытие файла с флагом O_DIRECT, если это возможно.
+        Возвращает кортеж из двух элементов - дескриптор файла
+        и булевское значение (True, если O_DIRECT удалось включить)."""
+
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                return (os.open(path, flags | os.O_DIRECT, mode), True)
+            except OSError as ex:
+                if ex.errno != errno.EINVAL:
+                    raise
+
+        return (os.open(path, flags, mode), False)
+
+    def __drop_cache(self, fd, offset, length):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            # на некоторых ФС (и в некоторых ОС) может не работать -
+            # не страшно, это только подсказка
+            pass
+
+    def __get_buffer(self):
+        """Возвращает буфер для копирования (свой для каждого потока)."""
+
+        buffer = getattr(self.buffers, 'buffer', None)
+        if buffer is None:
+            buffer = mmap.mmap(-1, self.BUFFER_SIZE)
+            self.buffers.buffer = buffer
+
+        return buffer
+
+    def copy_data(self, src, dst, hasher=None):
+        """Копирование содержимого файла src в файл dst
+        (см. описание класса).
+        hasher  - None или объект из hashlib, которому передаются
+                  скопированные данные."""
+
+        buffer = self.__get_buffer()
+        throttle = self.throttle
+
+        direct = self.cachePolicy == self.CACHE_DIRECT
+        dropCache = self.cachePolicy != self.CACHE_NORMAL
+
+        if direct:
+            fdin, directIn = self.__open_direct(src, os.O_RDONLY)
+        else:
+            fdin, directIn = os.open(src, os.O_RDONLY), False
+
+        try:
+            if direct:
+                fdout, directOut = self.__open_direct(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            else:
+                fdout, directOut = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), False
+
+            try:
+                bufview = memoryview(buffer)
+
+                try:
+                    offset = 0
+
+                    while True:
+                        nread = os.readv(fdin, [buffer])
+                        if nread <= 0:
+                            break
+
+                        if hasher is not None:
+                            hasher.update(bufview[:nread])
+
+                        nwrite = nread
+                        if directOut and nread % self.DIRECT_ALIGN:
+                            # хвост файла - дописываем выровненный блок,
+                            # лишнее потом отрезаем
+                            nwrite = (nread // self.DIRECT_ALIGN + 1) * self.DIRECT_ALIGN
+                            bufview[nread:nwrite] = bytes(nwrite - nread)
+
+                        if throttle is not None:
+                            throttle.before_write(nread)
+                            t0 = time.monotonic()
+
+                        nwritten = 0
+                        while nwritten < nwrite:
+                            nwritten += os.write(fdout, bufview[nwritten:nwrite])
+
+                        if throttle is not None:
+                            throttle.after_write(nwrite, time.monotonic() - t0)
+
+                        if dropCache and not directIn:
+                            self.__drop_cache(fdin, offset, nread)
+
+                        if dropCache and not directOut and offset >= self.BUFFER_SIZE:
+                            # "грязные" страницы из кэша не выбрасываются,
+                            # а только ставятся в очередь на запись,
+                            # потому выбрасываем из кэша блок, записанный
+                            # на шаг раньше - он к этому моменту, скорее
+                            # всего, уже записан на диск
+                            self.__drop_cache(fdout, offset - self.BUFFER_SIZE, self.BUFFER_SIZE)
+
+                        offset += nread
+
+                        if nread < self.BUFFER_SIZE and directIn:
+                            # с O_DIRECT короткое чтение бывает только в конце файла
+                            break
+
+                    if directOut:
+                        os.ftruncate(fdout, offset)
+                    elif dropCache:
+                        self.__drop_cache(fdout, 0, 0)
+                finally:
+                    bufview.release()
+            finally:
+                os.close(fdout)
+        finally:
+            os.close(fdin)
+
+    def __get_fanout_buffers(self):
+        """Возвращает пару буферов для fanout_data (свою для каждого потока)."""
+
+        buffers = getattr(self.buffers, 'fanout', None)
+        if buffers is None:
+            buffers = (mmap.mmap(-1, self.BUFFER_SIZE), mmap.mmap(-1, self.BUFFER_SIZE))
+            self.buffers.fanout = buffers
+
+        return buffers
+
+    def __get_fanout_executor(self):
+        with self.lock:
+            if self.fanoutExecutor is None:
+                self.fanoutExecutor = ThreadPoolExecutor(max_workers=self.FANOUT_WORKERS)
+
+            return self.fanoutExecutor
+
+    def __write_block(self, fd, data, offset, dropCache):
+        """Запись блока data в файл fd (для fanout_data)."""
+
+        t0 = time.monotonic()
+
+        nwritten = 0
+        while nwritten < len(data):
+            nwritten += os.write(fd, data[nwritten:])
+
+        if self.throttle is not None:
+            self.throttle.after_write(nwritten, time.monotonic() - t0)
+
+        if dropCache and offset >= self.BUFFER_SIZE:
+            # см. copy_data
+            self.__drop_cache(fd, offset - self.BUFFER_SIZE, self.BUFFER_SIZE)
+
+    def fanout_data(self, src, dsts, hasher=None):
+        """Копирование содержимого файла src в несколько файлов dsts
+        с однократным чтением src.
+        O_DIRECT здесь не используется (при CACHE_DIRECT работает
+        как CACHE_DONTNEED).
+        hasher  - см. copy_data."""
+
+        dropCache = self.cachePolicy != self.CACHE_NORMAL
+
+        buffers = self.__get_fanout_buffers()
+        executor = self.__get_fanout_executor()
+
+        fdin = os.open(src, os.O_RDONLY)
+        fdouts = []
+
+        # запись предыдущего блока (в отдельных потоках)
+        pending = []
+
+        try:
+            for dst in dsts:
+                fdouts.append(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+
+            offset = 0
+            bix = 0
+
+            while True:
+                # пока пишется предыдущий блок - читаем следующий
+                # в другой буфер
+                buf = buffers[bix]
+                nread = os.readv(fdin, [buf])
+
+                for f in pending:
+                    f.result()
+
+                pending = []
+
+                if nread <= 0:
+                    break
+
+                data = memoryview(buf)[:nread]
+
+                if self.throttle is not None:
+                    self.throttle.before_write(nread)
+
+                pending = [executor.submit(self.__write_block, fd, data, offset, dropCache) for fd in fdouts]
+
+                # контрольная сумма считается, пока блок пишется
+                if hasher is not None:
+                    hasher.update(data)
+
+                if dropCache:
+                    self.__drop_cache(fdin, offset, nread)
+
+                offset += nread
+                bix ^= 1
+
+            if dropCache:
+                for fd in fdouts:
+                    self.__drop_cache(fd, 0, 0)
+        finally:
+            # прежде чем закрывать файлы, дожидаемся недописанных блоков
+            for f in pending:
+                f.exception()
+
+            for fd in fdouts:
+                os.close(fd)
+
+            os.close(fdin)
+
+    @staticmethod
+    def __fsync_path(path):
+        """fsync для файла или каталога path."""
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __new_hasher(self):
+        return hashlib.new(self.HASH_ALGORITHM) if self.verify != self.VERIFY_NONE else None
+
+    def __copy_file(self, src, dst, copyStat):
+        """Копирование содержимого файла и его атрибутов
+        (copyStat=True - как shutil.copy2, иначе - как shutil.copy).
+        Возвращает контрольную сумму (bytes) или None (см. verify)."""
+
+        hasher = self.__new_hasher()
+
+        if self.cachePolicy == self.CACHE_NORMAL and hasher is None and self.throttle is None:
+            if copyStat:
+                shutil.copy2(src, dst)
+            else:
+                shutil.copy(src, dst)
+        else:
+            self.copy_data(src, dst, hasher)
+
+            if copyStat:
+                shutil.copystat(src, dst)
+            else:
+                shutil.copymode(src, dst)
+
+        return hasher.digest() if hasher is not None else None
+
+    def __verify_copy(self, path, digest):
+        """Для режима VERIFY_REREAD - перечитывание записанного файла
+        path мимо кэша ОС и сравнение его контрольной суммы с digest.
+        При несовпадении генерирует исключение OSError."""
+
+        hasher = hashlib.new(self.HASH_ALGORITHM)
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                # "грязные" страницы из кэша не выбрасываются -
+                # сначала сбрасываем их на диск
+                os.fdatasync(fd)
+                self.__drop_cache(fd, 0, 0)
+
+            buffer = self.__get_buffer()
+
+            with memoryview(buffer) as bufview:
+                while True:
+                    nread = os.readv(fd, [buffer])
+                    if nread <= 0:
+                        break
+
+                    hasher.update(bufview[:nread])
+
+            if self.cachePolicy != self.CACHE_NORMAL:
+                self.__drop_cache(fd, 0, 0)
+        finally:
+            os.close(fd)
+
+        if hasher.digest() != digest:
+            raise OSError(errno.EIO, 'контрольная сумма копии не совпадает с контрольной суммой исходного файла', path)
+
+    def __temp_name(self, dst):
+        """Имя временного файла для записи файла dst - в том же каталоге,
+        "скрытое", чтобы не попадаться при поиске файлов."""
+
+        dirname, fname = os.path.split(dst)
+        return os.path.join(dirname, TEMP_FNAME_FORMAT % (fname, _HOSTNAME, os.getpid(), next(self.tempCounter)))
+
+    @staticmethod
+    def __rename(src, dst, overwrite):
+        if overwrite:
+            os.replace(src, dst)
+        else:
+            rename_noreplace(src, dst)
+
+    def __write_file(self, src, dst, copyStat, overwrite):
+        """Запись копии файла src во временный файл с последующим
+        переименованием в dst.
+        Возвращает контрольную сумму (bytes) или None."""
+
+        tmpdst = self.__temp_name(dst)
+
+        try:
+            digest = self.__copy_file(src, tmpdst, copyStat)
+
+            if self.durability == self.SYNC_FILE:
+                self.__fsync_path(tmpdst)
+
+            if self.verify == self.VERIFY_REREAD:
+                self.__verify_copy(tmpdst, digest)
+
+            self.__rename(tmpdst, dst, overwrite)
+
+            return digest
+        except BaseException:
+            try:
+                os.remove(tmpdst)
+            except OSError:
+                pass
+
+            raise
+
+    def __write_files(self, src, dsts, copyStat, overwrite):
+        """Запись копий файла src во временные файлы (с однократным
+        чтением src) с последующим переименованием в dsts.
+        Первый файл из dsts переименовывается последним - если он есть,
+        значит, есть и остальные (см. pmvcheckpoint).
+        Если какое-то из переименований не удалось, а перезапись
+        не разрешена - уже переименованные файлы удаляются (они только
+        что созданы), т.е. либо записываются все файлы, либо ни одного.
+        Возвращает контрольную сумму (bytes) или None."""
+
+        tmpdsts = list(map(self.__temp_name, dsts))
+
+        # уже переименованные файлы
+        renamed = []
+
+        hasher = self.__new_hasher()
+
+        try:
+            self.fanout_data(src, tmpdsts, hasher)
+
+            digest = hasher.digest() if hasher is not None else None
+
+            for tmpdst in tmpdsts:
+                if copyStat:
+                    shutil.copystat(src, tmpdst)
+                else:
+                    shutil.copymode(src, tmpdst)
+
+                if self.durability == self.SYNC_FILE:
+                    self.__fsync_path(tmpdst)
+
+                if self.verify == self.VERIFY_REREAD:
+                    self.__verify_copy(tmpdst, digest)
+
+            for tmpdst, dst in reversed(list(zip(tmpdsts, dsts))):
+                self.__rename(tmpdst, dst, overwrite)
+                renamed.append(dst)
+
+            return digest
+        except BaseException:
+            for tmpdst in tmpdsts:
+                try:
+                    os.remove(tmpdst)
+                except OSError:
+                    pass
+
+            if not overwrite:
+                for dst in renamed:
+                    try:
+                        os.remove(dst)
+                    except OSError:
+                        pass
+
+            raise
+
+    def __file_done(self, src, dsts):
+        """Завершение записи файлов dsts в соответствии с режимом durability.
+
+        src     - исходный файл, который следует удалить, или None."""
+
+        if self.durability == self.SYNC_FILE:
+            for dst in dsts:
+                self.__fsync_path(os.path.dirname(dst))
+        elif self.durability == self.SYNC_BATCH:
+            with self.lock:
+                self.nUnsynced += 1
+                self.unsyncedDirs.update(map(os.path.dirname, dsts))
+
+                if src is not None:
+                    self.pendingRemoval.append(src)
+
+            return
+
+        if src is not None:
+            os.remove(src)
+
+    def sync(self, force=False):
+        """Для режима SYNC_BATCH: если с последнего вызова записано
+        не менее syncBatchSize файлов (или force=True) - сброс на диск
+        всех ФС, на которые писались файлы, после чего - удаление
+        соответствующих исходных файлов (для перемещения).
+
+        Метод следует вызывать после каждой файловой операции,
+        и с force=True - по окончании работы.
+
+        Возвращает список строк с сообщениями об ошибках удаления
+        исходных файлов (пустой, если ошибок не было)."""
+
+        with self.lock:
+            if self.nUnsynced == 0 or (not force and self.nUnsynced < self.syncBatchSize):
+                return []
+
+            unsyncedDirs = self.unsyncedDirs
+            pendingRemoval = self.pendingRemoval
+
+            self.nUnsynced = 0
+            self.unsyncedDirs = set()
+            self.pendingRemoval = []
+
+        if _syncfs is None:
+            os.sync()
+        else:
+            # syncfs достаточно вызвать по разу на каждую ФС
+            syncedDevs = set()
+
+            for dirname in unsyncedDirs:
+                fd = os.open(dirname, os.O_RDONLY)
+                try:
+                    dev = os.fstat(fd).st_dev
+                    if dev not in syncedDevs:
+                        if _syncfs(fd) != 0:
+                            en = ctypes.get_errno()
+                            raise OSError(en, os.strerror(en), dirname)
+
+                        syncedDevs.add(dev)
+                finally:
+                    os.close(fd)
+
+        errors = []
+
+        for src in pendingRemoval:
+            try:
+                os.remove(src)
+            except OSError as ex:
+                errors.append('не удалось удалить исходный файл "%s" - %s' % (src, ex))
+
+        return errors
+
+    def copy(self, src, dst, overwrite=False):
+        """Копирование файла src в dst (полный путь с именем файла)
+        вместе с правами доступа - аналог shutil.copy.
+
+        overwrite   - разрешение перезаписи существующего файла dst;
+                      если False и файл существует - генерируется
+                      исключение FileExistsError.
+
+        Возвращает контрольную сумму данных в виде шестнадцатеричной
+        строки, или None (если проверка копий не включена)."""
+
+        self.__start_file()
+
+        digest = self.__write_file(src, dst, False, overwrite)
+        self.__file_done(None, (dst,))
+
+        return self.__hexdigest(digest)
+
+    def __start_file(self):
+        if self.throttle is not None:
+            self.throttle.start_file()
+
+    @staticmethod
+    def __hexdigest(digest):
+        return digest.hex() if digest is not None else None
+
+    def move(self, src, dst, overwrite=False):
+        """Перемещение файла src в dst (полный путь с именем файла) -
+        аналог shutil.move.
+        В режиме SYNC_BATCH исходный файл удаляется не сразу,
+        а при вызове метода sync.
+
+        overwrite   - см. метод copy.
+
+        Возвращает то же, что и метод copy (при переименовании
+        в пределах одной ФС - всегда None)."""
+
+        self.__start_file()
+
+        try:
+            self.__rename(src, dst, overwrite)
+            self.__file_done(None, (dst,))
+            return None
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+
+        # разные ФС - копируем и удаляем исходный файл
+        digest = self.__write_file(src, dst, True, overwrite)
+        self.__file_done(src, (dst,))
+
+        return self.__hexdigest(digest)
+
+    def undo_move(self, src, dst):
+        """Отмена перемещения файла src в dst (методом move).
+        Если удаление src ещё не выполнено (см. sync) - оно отменяется
+        и удаляется dst, иначе dst перемещается обратно в src."""
+
+        with self.lock:
+            pending = src in self.pendingRemoval
+            if pending:
+                self.pendingRemoval.remove(src)
+
+        if pending:
+            os.remove(dst)
+            return
+
+        try:
+            rename_noreplace(dst, src)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+
+            self.__write_file(dst, src, True, False)
+            os.remove(dst)
+
+    def copy_multi(self, src, dsts, overwrite=False):
+        """Копирование файла src в несколько файлов dsts (последовательность
+        полных путей) с однократным чтением src.
+
+        overwrite   - см. метод copy.
+
+        Возвращает то же, что и метод copy."""
+
+        if len(dsts) == 1:
+            return self.copy(src, dsts[0], overwrite)
+
+        self.__start_file()
+
+        digest = self.__write_files(src, dsts, False, overwrite)
+        self.__file_done(None, dsts)
+
+        return self.__hexdigest(digest)
+
+    def move_multi(self, src, dsts, overwrite=False):
+        """Перемещение файла src в несколько файлов dsts (последовательность
+        полных путей): копирование с однократным чтением src и удаление
+        src (в режиме SYNC_BATCH - при вызове метода sync).
+
+        overwrite   - см. метод copy.
+
+        Возвращает то же, что и метод copy."""
+
+        if len(dsts) == 1:
+            return self.move(src, dsts[0], overwrite)
+
+        self.__start_file()
+
+        digest = self.__write_files(src, dsts, True, overwrite)
+        self.__file_done(src, dsts)
+
+        return self.__hexdigest(digest)
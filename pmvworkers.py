@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" This file is part of PhotoMV.
+
+    PhotoMV is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    PhotoMV is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with PhotoMV.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import os, os.path
+import signal
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import deque
+
+from pmvmetadata import FileMetadata
+from pmvfileio import SourceFile
+
+
+def _metadata_worker(conn, ftypes):
+    """Цикл рабочего процесса MetadataWorkerPool.
+
+    Получает из conn полные пути к файлам (None - завершение работы),
+    отправляет обратно кортежи вида (True, FileMetadata.get_record())
+    или (False, 'сообщение об ошибке')."""
+
+    # Ctrl+C обрабатывает основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        try:
+            path = conn.recv()
+        except EOFError:
+            break
+
+        if path is None:
+            break
+
+        try:
+            with SourceFile(path) as source:
+                metadata = FileMetadata(path, ftypes, source)
+
+                # загружаем всё, что берётся из ФС и EXIF
+                metadata.fileSize
+                metadata.model
+
+            conn.send((True, metadata.get_record()))
+        except Exception as ex:
+            conn.send((False, str(ex)))
+
+
+class MetadataWorkerPool():
+    """Извлечение метаданных из файлов в отдельных процессах.
+
+    Библиотека exiv2 на повреждённых файлах может зависнуть или упасть,
+    а с ней - и вся программа. Рабочие процессы изолируют такие сбои:
+    зависший процесс по истечении timeout секунд убивается, упавший -
+    перезапускается, а файл считается непрочитанным (метод get
+    генерирует исключение MetadataWorkerPool.Error).
+    Для борьбы с утечками памяти процессы перезапускаются после
+    обработки recycleAfter файлов.
+
+    Файлы из очереди обработки раздаются процессам заранее (как
+    и в pmvfileio.HeaderPrefetcher), так что метаданные нескольких
+    файлов извлекаются параллельно.
+    Результаты передаются в компактном виде (см. FileMetadata.get_record)."""
+
+    DEFAULT_TIMEOUT = 30
+    DEFAULT_RECYCLE = 1000
+
+    class Error(Exception):
+        pass
+
+    class Worker():
+        __slots__ = 'process', 'conn', 'task', 'deadline', 'nTasks'
+
+        def __init__(self, process, conn):
+            self.process = process
+            self.conn = conn
+
+            # кортеж (индекс элемента очереди, путь) или None
+            self.task = None
+            self.deadline = None
+
+            self.nTasks = 0
+
+    def __init__(self, ftypes, nWorkers, timeout=DEFAULT_TIMEOUT, recycleAfter=DEFAULT_RECYCLE):
+        """ftypes       - экземпляр pmvmetadata.FileTypes;
+        nWorkers        - кол-во рабочих процессов;
+        timeout         - максимальное время обработки одного файла
+                          в секундах;
+        recycleAfter    - кол-во файлов, после обработки которых
+                          рабочий процесс перезапускается."""
+
+        self.ftypes = ftypes
+        self.nWorkers = max(1, nWorkers)
+        self.timeout = timeout
+        self.recycleAfter = max(1, recycleAfter)
+
+        # сколько файлов раздавать заранее
+        self.depth = self.nWorkers * 2
+
+        # индекс последнего элемента очереди, поставленного в обработку
+        self.lastIx = -1
+
+        # ожидающие свободного процесса кортежи (индекс, путь)
+        self.backlog = deque()
+
+        # ключи - индексы элементов очереди, значения - кортежи
+        # (True, запись с метаданными) или (False, 'сообщение об ошибке')
+        self.results = {}
+
+        self.workers = [self.__start_worker() for i in range(self.nWorkers)]
+
+    def __repr__(self):
+        """Для отладки"""
+
+        return '%s(nWorkers=%d, timeout=%s, recycleAfter=%d)' % (
+            self.__class__.__name__,
+            self.nWorkers, self.timeout, self.recycleAfter)
+
+    def __start_worker(self):
+        conn, childconn = multiprocessing.Pipe()
+
+        process = multiprocessing.Process(target=_metadata_worker,
+            args=(childconn, self.ftypes), daemon=True)
+        process.start()
+
+        childconn.close()
+
+        return self.Worker(process, conn)
+
+    def __stop_worker(self, worker, kill):
+        if not kill:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                kill = True
+            else:
+                worker.process.join(self.timeout)
+
+        if kill or worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+
+        worker.conn.close()
+
+    def __restart_worker(self, wix, kill):
+        self.__stop_worker(self.workers[wix], kill)
+        self.workers[wix] = self.__start_worker()
+
+    def __dispatch(self):
+        """Раздача ожидающих файлов свободным процессам."""
+
+        for worker in self.workers:
+            if not self.backlog:
+                break
+
+            if worker.task is None:
+                worker.task = self.backlog.popleft()
+                worker.deadline = time.monotonic() + self.timeout
+                worker.conn.send(worker.task[1])
+
+    def __poll(self):
+        """Ожидание результатов от занятых процессов; обработка
+        зависших и упавших процессов."""
+
+        busy = [w for w in self.workers if w.task is not None]
+        if not busy:
+            return
+
+        waittime = max(0.0, min(w.deadline for w in busy) - time.monotonic())
+        ready = wait([w.conn for w in busy], waittime)
+
+        for wix, worker in enumerate(self.workers):
+            if worker.task is None:
+                continue
+
+            ix, path = worker.task
+
+            if worker.conn in ready:
+                try:
+                    self.results[ix] = worker.conn.recv()
+                except (EOFError, OSError):
+                    self.results[ix] = (False, 'процесс извлечения метаданных аварийно завершился (код %s)' % worker.process.exitcode)
+                    self.__restart_worker(wix, True)
+                    continue
+
+                worker.task = None
+                worker.nTasks += 1
+
+                if worker.nTasks >= self.recycleAfter:
+                    self.__restart_worker(wix, False)
+
+            elif time.monotonic() >= worker.deadline:
+                self.results[ix] = (False, 'превышено время извлечения метаданных (%s с)' % self.timeout)
+                self.__restart_worker(wix, True)
+
+        self.__dispatch()
+
+    def advance(self, queue, ix, skip=None):
+        """Вызывается перед обработкой элемента ix очереди queue;
+        ставит в обработку этот и несколько следующих элементов.
+
+        queue   - последовательность кортежей вида ('каталог', 'имя файла', ...);
+        ix      - индекс текущего элемента;
+        skip    - None или функция, получающая индекс элемента очереди
+                  и возвращающая True, если метаданные элемента
+                  не нужны."""
+
+        lastIx = min(ix + self.depth, len(queue) - 1)
+
+        # ставим в обработку подряд (движок pmvasync обрабатывает
+        # элементы очереди не строго по порядку)
+        for pix in range(self.lastIx + 1, lastIx + 1):
+            if skip is None or not skip(pix):
+                self.backlog.append((pix, os.path.join(queue[pix][0], queue[pix][1])))
+
+        self.lastIx = max(self.lastIx, lastIx)
+
+        self.__dispatch()
+
+    def get(self, ix):
+        """Возвращает метаданные элемента ix очереди (см.
+        FileMetadata.set_record). Элемент должен быть поставлен
+        в обработку методом advance.
+        В случае ошибки генерирует исключение MetadataWorkerPool.Error."""
+
+        while ix not in self.results:
+            if not self.backlog and all(w.task is None for w in self.workers):
+                raise self.Error('элемент очереди %d не был поставлен в обработку' % ix)
+
+            self.__poll()
+
+        ok, value = self.results.pop(ix)
+        if not ok:
+            raise self.Error(value)
+
+        return value
+
+    def close(self):
+        """Останов рабочих процессов."""
+
+        self.backlog.clear()
+
+        for worker in self.workers:
+            self.__stop_worker(worker, worker.task is not None)
+
+        self.workers = []